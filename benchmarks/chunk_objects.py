@@ -0,0 +1,66 @@
+"""
+Microbenchmark of per-chunk cost: building a streaming chunk object and
+serializing it to an SSE frame, for the pydantic ModelResponse, the
+openai SDK's ChatCompletionChunk (what the proxy receives from the client)
+and the dict-backed CompactChunk.
+
+    python -m benchmarks.chunk_objects --chunks 20000
+"""
+import sys
+import json
+import time
+import argparse
+from openai.types.chat import ChatCompletionChunk
+from proxy.protocols import CompactChunk, ModelResponse
+
+RAW = {
+    "id": "chatcmpl-bench",
+    "object": "chat.completion.chunk",
+    "created": 1700000000,
+    "model": "bench-model",
+    "choices": [{"index": 0, "delta": {"content": " token"}, "finish_reason": None}],
+}
+
+def _model_response():
+    return ModelResponse(stream=True, **json.loads(json.dumps(RAW)))
+
+def _sdk_chunk():
+    return ChatCompletionChunk.construct(**json.loads(json.dumps(RAW)))
+
+def _compact_chunk():
+    return CompactChunk(json.loads(json.dumps(RAW)))
+
+CASES = {
+    "ModelResponse": (_model_response, lambda chunk: chunk.model_dump()),
+    "ChatCompletionChunk": (_sdk_chunk, lambda chunk: chunk.to_dict()),
+    "CompactChunk": (_compact_chunk, lambda chunk: chunk.to_dict()),
+}
+
+def _per_chunk_us(fn, n: int) -> float:
+    start = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - start) / n * 1e6
+
+def run(n: int) -> dict:
+    # the json round trip stands in for parsing the upstream event, it is
+    # the same for every case and measured on its own as the baseline
+    results = {"parse_baseline_us": round(_per_chunk_us(lambda: json.loads(json.dumps(RAW)), n), 3)}
+    for name, (build, to_dict) in CASES.items():
+        chunk = build()
+        results[name] = {
+            "build_us": round(_per_chunk_us(build, n), 3),
+            "serialize_us": round(_per_chunk_us(lambda: f"data: {json.dumps(to_dict(chunk))}\n\n", n), 3),
+            "total_us": round(_per_chunk_us(lambda: f"data: {json.dumps(to_dict(build()))}\n\n", n), 3),
+        }
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--chunks", type=int, default=20000)
+    args = parser.parse_args()
+    json.dump({"chunks": args.chunks, "results": run(args.chunks)}, sys.stdout, indent=2)
+    print()
+
+if __name__ == "__main__":
+    main()
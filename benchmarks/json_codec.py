@@ -0,0 +1,103 @@
+"""
+CPU cost of JSON work per request: decoding the request body, encoding a
+non-stream response and encoding the SSE frames of a stream. Compares what
+the proxy did before (request.json(), FastAPI's jsonable_encoder plus
+JSONResponse, json.dumps per chunk) with proxy.codec.
+
+    python -m benchmarks.json_codec --iterations 2000 --chunks 256
+"""
+import sys
+import json
+import time
+import argparse
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from openai.types.chat import ChatCompletion
+from proxy import codec
+
+REQUEST = {
+    "model": "bench-model",
+    "messages": [
+        {"role": "system", "content": "You are a helpful assistant. " * 20},
+        {"role": "user", "content": "Summarize the following text. " + "lorem ipsum dolor sit amet " * 200},
+    ],
+    "temperature": 0.7,
+    "max_tokens": 512,
+    "stream": True,
+}
+RESPONSE = {
+    "id": "chatcmpl-bench",
+    "object": "chat.completion",
+    "created": 1700000000,
+    "model": "bench-model",
+    "choices": [{
+        "index": 0,
+        "message": {"role": "assistant", "content": "word " * 400},
+        "finish_reason": "stop",
+    }],
+    "usage": {"prompt_tokens": 1200, "completion_tokens": 400, "total_tokens": 1600},
+}
+CHUNK = {
+    "id": "chatcmpl-bench",
+    "object": "chat.completion.chunk",
+    "created": 1700000000,
+    "model": "bench-model",
+    "choices": [{"index": 0, "delta": {"content": " word"}, "finish_reason": None}],
+}
+
+def _us(fn, n: int) -> float:
+    start = time.process_time()
+    for _ in range(n):
+        fn()
+    return (time.process_time() - start) / n * 1e6
+
+def run(iterations: int, chunks: int) -> dict:
+    body = json.dumps(REQUEST).encode()
+    completion = ChatCompletion.construct(**RESPONSE)
+    completion_dict = completion.to_dict()
+
+    def stdlib_stream():
+        for _ in range(chunks):
+            f"data: {json.dumps(CHUNK)}\n\n".encode()
+
+    def codec_stream():
+        for _ in range(chunks):
+            codec.sse(CHUNK)
+
+    stdlib = {
+        "decode_request_us": _us(lambda: json.loads(body), iterations),
+        "encode_response_us": _us(lambda: JSONResponse(jsonable_encoder(completion)).body, iterations),
+        "encode_stream_us": _us(stdlib_stream, max(1, iterations // 10)),
+    }
+    fast = {
+        "decode_request_us": _us(lambda: codec.loads(body), iterations),
+        "encode_response_us": _us(lambda: codec.EncodedJSONResponse(completion.to_dict()).body, iterations),
+        "encode_stream_us": _us(codec_stream, max(1, iterations // 10)),
+    }
+    # the encoding alone, without converting the SDK object to a dict
+    fast["encode_dict_us"] = _us(lambda: codec.EncodedJSONResponse(completion_dict).body, iterations)
+    return {
+        "codec": "orjson" if codec.orjson is not None else "json",
+        "chunks_per_stream": chunks,
+        "before": {k: round(v, 2) for k, v in stdlib.items()},
+        "after": {k: round(v, 2) for k, v in fast.items()},
+        "saved_per_request_us": {
+            "non_stream": round(
+                stdlib["decode_request_us"] + stdlib["encode_response_us"]
+                - fast["decode_request_us"] - fast["encode_response_us"], 2),
+            "stream": round(
+                stdlib["decode_request_us"] + stdlib["encode_stream_us"]
+                - fast["decode_request_us"] - fast["encode_stream_us"], 2),
+        },
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--chunks", type=int, default=256, help="SSE frames per streamed response")
+    args = parser.parse_args()
+    json.dump(run(args.iterations, args.chunks), sys.stdout, indent=2)
+    print()
+
+if __name__ == "__main__":
+    main()
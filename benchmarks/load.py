@@ -0,0 +1,253 @@
+"""
+Load driver for the proxy. Starts the mock upstream and the proxy against a
+throwaway SQLite APIKey table (or --database-url), then sends streaming and
+non-streaming chat completions at rising concurrency and reports latency
+percentiles, throughput and the proxy's CPU time per request as JSON.
+
+    python -m benchmarks.load --concurrency 1,8,32,128 --requests 400 --output bench.json
+
+Settings for the proxy under test can be passed with --proxy-env, e.g.
+--proxy-env STREAM_PASSTHROUGH=true --proxy-env ROUTING_MODE=direct.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime
+
+import httpx
+
+BENCH_KEY = "sk-rc-benchmark"
+PLACEHOLDER_ENV = {
+    "AUTH0_DOMAIN": "https://bench.invalid",
+    "AUTH0_API_AUDIENCE": "bench",
+    "AUTH0_ISSUER": "https://bench.invalid/",
+    "AUTH0_ALGORITHMS": "RS256",
+    "AUTH0_CLIENT_ID": "bench",
+    "AUTH0_CLIENT_SECRET": "bench",
+    "AUTH_SECRET": "bench",
+    "VITE_AUTH0_CLIENT_ID": "bench",
+    "VITE_AUTH0_DOMAIN": "bench.invalid",
+    "LOGFIRE_TOKEN": "",
+    "LANGFUSE_PUBLIC_KEY": "pk-bench",
+    "LANGFUSE_SECRET_KEY": "sk-bench",
+}
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def _cpu_seconds(pid: int):
+    # utime + stime of the process, None where /proc is not available
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+def _percentile(values: list, q: float):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+def _summary_ms(values: list) -> dict:
+    return {
+        name: None if value is None else round(value * 1000, 3)
+        for name, value in (
+            ("p50", _percentile(values, 0.50)),
+            ("p90", _percentile(values, 0.90)),
+            ("p99", _percentile(values, 0.99)),
+        )
+    }
+
+def create_apikey(database_url: str):
+    """Insert the benchmark key into the APIKey table, creating it if needed."""
+    from sqlmodel import Session, SQLModel, create_engine
+    from proxy.auth import APIKey
+
+    engine = create_engine(database_url)
+    SQLModel.metadata.create_all(engine, tables=[APIKey.__table__])
+    with Session(engine) as session:
+        api_key = session.get(APIKey, BENCH_KEY) or APIKey(key=BENCH_KEY, owner_email="bench@example.org")
+        api_key.budget = 10**12
+        session.add(api_key)
+        session.commit()
+    engine.dispose()
+
+async def _wait_ready(url: str, process: subprocess.Popen, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"{process.args} exited with {process.returncode}")
+            try:
+                if (await client.get(url)).status_code < 500:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+async def _request(client: httpx.AsyncClient, body: dict, stream: bool) -> tuple:
+    """One chat completion, returns (ok, latency, time to first chunk)."""
+    start = time.perf_counter()
+    first = None
+    if not stream:
+        response = await client.post("/v1/chat/completions", json=body)
+        return response.status_code == 200, time.perf_counter() - start, None
+    async with client.stream("POST", "/v1/chat/completions", json={**body, "stream": True}) as response:
+        ok = response.status_code == 200
+        async for line in response.aiter_lines():
+            if first is None and line.startswith("data:"):
+                first = time.perf_counter() - start
+            if '"upstream_error"' in line:
+                ok = False
+    return ok, time.perf_counter() - start, first
+
+async def run_level(base_url: str, proxy_pid: int, body: dict, stream: bool, concurrency: int, requests: int) -> dict:
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    headers = {"Authorization": f"Bearer {BENCH_KEY}"}
+    async with httpx.AsyncClient(base_url=base_url, headers=headers, limits=limits, timeout=600) as client:
+        # warm up connections and the key cache
+        await asyncio.gather(*(_request(client, body, stream) for _ in range(min(concurrency, 8))))
+        remaining = iter(range(requests))
+        results = []
+
+        async def worker():
+            for _ in remaining:
+                try:
+                    results.append(await _request(client, body, stream))
+                except httpx.HTTPError:
+                    results.append((False, None, None))
+
+        cpu_before = _cpu_seconds(proxy_pid)
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+        cpu_after = _cpu_seconds(proxy_pid)
+
+    ok = [r for r in results if r[0]]
+    cpu = None
+    if cpu_before is not None and cpu_after is not None and results:
+        cpu = round((cpu_after - cpu_before) / len(results) * 1000, 3)
+    level = {
+        "mode": "stream" if stream else "non-stream",
+        "concurrency": concurrency,
+        "requests": len(results),
+        "errors": len(results) - len(ok),
+        "seconds": round(elapsed, 3),
+        "throughput_rps": round(len(ok) / elapsed, 2),
+        "latency_ms": _summary_ms([r[1] for r in ok]),
+        "proxy_cpu_ms_per_request": cpu,
+    }
+    if stream:
+        level["ttft_ms"] = _summary_ms([r[2] for r in ok if r[2] is not None])
+    return level
+
+async def run(args) -> dict:
+    tmp = tempfile.mkdtemp(prefix="fm-bench-")
+    database_url = args.database_url or f"sqlite:///{tmp}/bench.db"
+    create_apikey(database_url)
+    mock_port, proxy_port = _free_port(), _free_port()
+    mock_url = f"http://127.0.0.1:{mock_port}"
+    mock = subprocess.Popen([
+        sys.executable, "-m", "benchmarks.mock_upstream",
+        "--port", str(mock_port),
+        "--ttft", str(args.ttft),
+        "--token-rate", str(args.token_rate),
+        "--tokens", str(args.tokens),
+        "--error-rate", str(args.error_rate),
+        "--hang-rate", str(args.hang_rate),
+        "--models", args.model,
+    ])
+    env = {
+        **os.environ,
+        **PLACEHOLDER_ENV,
+        "DATABASE_URL": database_url,
+        "OCF_HEAD_ADDR": mock_url,
+        "LANGFUSE_HOST": mock_url,
+        "BATCH_STORAGE_DIR": os.path.join(tmp, "batches"),
+        **dict(item.split("=", 1) for item in args.proxy_env),
+    }
+    proxy = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "proxy.main:app", "--port", str(proxy_port), "--log-level", "warning"],
+        env=env,
+    )
+    try:
+        await _wait_ready(mock_url + "/v1/dnt/table", mock)
+        await _wait_ready(f"http://127.0.0.1:{proxy_port}/v1/models", proxy)
+        body = {
+            "model": args.model,
+            "messages": [{"role": "user", "content": "Benchmark prompt."}],
+            "max_tokens": args.tokens,
+        }
+        results = []
+        for stream in (False, True):
+            for concurrency in args.concurrency:
+                level = await run_level(
+                    f"http://127.0.0.1:{proxy_port}",
+                    proxy.pid,
+                    body,
+                    stream,
+                    concurrency,
+                    args.requests,
+                )
+                print(
+                    f"{level['mode']:>10} c={concurrency:<4} {level['throughput_rps']:>8} req/s "
+                    f"p50={level['latency_ms']['p50']}ms p99={level['latency_ms']['p99']}ms "
+                    f"cpu={level['proxy_cpu_ms_per_request']}ms/req errors={level['errors']}",
+                    file=sys.stderr,
+                )
+                results.append(level)
+    finally:
+        for process in (proxy, mock):
+            process.terminate()
+            process.wait(timeout=10)
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "config": {
+            "ttft": args.ttft,
+            "token_rate": args.token_rate,
+            "tokens": args.tokens,
+            "error_rate": args.error_rate,
+            "hang_rate": args.hang_rate,
+            "requests": args.requests,
+            "proxy_env": args.proxy_env,
+            "database": database_url.split(":", 1)[0],
+        },
+        "results": results,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--concurrency", default="1,8,32,128", help="comma separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=200, help="requests per level and mode")
+    parser.add_argument("--model", default="bench-model")
+    parser.add_argument("--ttft", type=float, default=0.05)
+    parser.add_argument("--token-rate", type=float, default=200.0)
+    parser.add_argument("--tokens", type=int, default=32)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--hang-rate", type=float, default=0.0)
+    parser.add_argument("--database-url", default=None, help="defaults to a temporary SQLite database")
+    parser.add_argument("--proxy-env", action="append", default=[], metavar="KEY=VALUE")
+    parser.add_argument("--output", default=None, help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+    args.concurrency = [int(c) for c in args.concurrency.split(",")]
+    report = asyncio.run(run(args))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+if __name__ == "__main__":
+    main()
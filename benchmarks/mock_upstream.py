@@ -0,0 +1,115 @@
+"""
+Mock OpenAI-compatible upstream for benchmarks. It stands in for the OCF
+head: /v1/dnt/table lists fake nodes, and chat completions are served on
+the head and per-node paths with configurable latency and faults.
+
+    python -m benchmarks.mock_upstream --port 9100 --ttft 0.05 --token-rate 100
+"""
+import json
+import time
+import random
+import asyncio
+import argparse
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+def create_app(
+    ttft: float = 0.05,
+    token_rate: float = 100.0,
+    tokens: int = 64,
+    error_rate: float = 0.0,
+    hang_rate: float = 0.0,
+    models=("bench-model",),
+    nodes: int = 2,
+) -> FastAPI:
+    app = FastAPI()
+    interval = 1 / token_rate if token_rate > 0 else 0
+
+    @app.get("/v1/dnt/table")
+    async def table():
+        return {
+            f"node{i}": {
+                "id": f"node{i}",
+                "public_address": "127.0.0.1",
+                "hardware": {"gpus": [{"name": "GH200"}]},
+                "service": [{"name": "llm", "identity_group": [f"model={model}" for model in models]}],
+            }
+            for i in range(nodes)
+        }
+
+    @app.post("/api/public/ingestion")
+    async def langfuse_ingestion():
+        # lets the proxy's Langfuse client flush without a Langfuse server
+        return JSONResponse({"successes": [], "errors": []}, status_code=207)
+
+    def chunk(model: str, created: int, **fields):
+        return "data: " + json.dumps({
+            "id": "chatcmpl-bench",
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            **fields,
+        }) + "\n\n"
+
+    async def chat(request: Request):
+        body = await request.json()
+        model = body.get("model", models[0])
+        created = int(time.time())
+        roll = random.random()
+        if roll < error_rate:
+            return JSONResponse({"error": {"message": "injected error", "type": "server_error"}}, status_code=500)
+        if roll < error_rate + hang_rate:
+            await asyncio.sleep(3600)
+        n = body.get("max_tokens") or tokens
+        usage = {"prompt_tokens": 16, "completion_tokens": n, "total_tokens": 16 + n}
+        if body.get("stream"):
+            async def stream():
+                await asyncio.sleep(ttft)
+                for i in range(n):
+                    if i:
+                        await asyncio.sleep(interval)
+                    yield chunk(model, created, choices=[{"index": 0, "delta": {"content": " tok"}, "finish_reason": None}])
+                yield chunk(model, created, choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}])
+                yield chunk(model, created, choices=[], usage=usage)
+                yield "data: [DONE]\n\n"
+            return StreamingResponse(stream(), media_type="text/event-stream")
+        await asyncio.sleep(ttft + interval * max(0, n - 1))
+        return {
+            "id": "chatcmpl-bench",
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": " tok" * n}, "finish_reason": "stop"}],
+            "usage": usage,
+        }
+
+    app.post("/v1/service/llm/v1/chat/completions")(chat)
+    app.post("/v1/p2p/{node_id}/v1/_service/llm/v1/chat/completions")(chat)
+    return app
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--ttft", type=float, default=0.05, help="seconds before the first token")
+    parser.add_argument("--token-rate", type=float, default=100.0, help="tokens per second after the first")
+    parser.add_argument("--tokens", type=int, default=64, help="completion tokens unless max_tokens is set")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with a 500")
+    parser.add_argument("--hang-rate", type=float, default=0.0, help="fraction of requests that never answer")
+    parser.add_argument("--models", default="bench-model", help="comma separated model names")
+    parser.add_argument("--nodes", type=int, default=2, help="nodes listed in /v1/dnt/table")
+    args = parser.parse_args()
+    app = create_app(
+        ttft=args.ttft,
+        token_rate=args.token_rate,
+        tokens=args.tokens,
+        error_rate=args.error_rate,
+        hang_rate=args.hang_rate,
+        models=tuple(args.models.split(",")),
+        nodes=args.nodes,
+    )
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+import time
+import heapq
+import asyncio
+from proxy.auth import APIKey, is_institutional
+from proxy.metrics import (
+    ADMISSION_INFLIGHT,
+    ADMISSION_QUEUE_DEPTH,
+    ADMISSION_SHED,
+    ADMISSION_WAIT_SECONDS,
+    model_label,
+)
+
+# lower value is served first
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+def priority_for(api_key: APIKey) -> int:
+    if api_key.budget > 0 and is_institutional(api_key.owner_email):
+        return PRIORITY_HIGH
+    return PRIORITY_NORMAL
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason: str, retry_after: int = 1):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+class _ModelQueue:
+    def __init__(self):
+        self.inflight = 0
+        # (priority, seq, future)
+        self.waiters = []
+
+class AdmissionController:
+    """
+    Bounded per-model wait queues in front of the upstream.
+
+    At most `max_inflight` requests per model are forwarded at once, the
+    rest wait in priority order. A full queue sheds its lowest priority
+    waiter (or the newcomer) with a 503, and nobody waits longer than
+    `max_queue_time`. `max_inflight=0` admits everything.
+    """
+    def __init__(self, max_inflight: int = 0, max_queue: int = 256, max_queue_time: float = 30.0):
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self.max_queue_time = max_queue_time
+        self.models = {}
+        self._seq = 0
+
+    def _queue(self, model: str) -> _ModelQueue:
+        queue = self.models.get(model)
+        if queue is None:
+            queue = self.models[model] = _ModelQueue()
+        return queue
+
+    def _update_gauges(self, model: str, queue: _ModelQueue):
+        ADMISSION_INFLIGHT.set(model_label(model), value=queue.inflight)
+        ADMISSION_QUEUE_DEPTH.set(model_label(model), value=len(queue.waiters))
+
+    def _shed(self, model: str, queue: _ModelQueue, priority: int):
+        # make room by dropping the lowest priority, newest waiter if it
+        # ranks below the newcomer, otherwise reject the newcomer
+        worst = max(queue.waiters)
+        if worst[0] <= priority:
+            ADMISSION_SHED.inc(model_label(model), "queue_full")
+            raise AdmissionRejected(f"Model {model} is overloaded, try again later")
+        queue.waiters.remove(worst)
+        heapq.heapify(queue.waiters)
+        worst[2].set_exception(AdmissionRejected(f"Model {model} is overloaded, try again later"))
+        ADMISSION_SHED.inc(model_label(model), "preempted")
+
+    async def admit(self, model: str, priority: int = PRIORITY_NORMAL):
+        """
+        Wait for an upstream slot, returns the callable that frees it.
+        """
+        if not self.max_inflight:
+            return lambda: None
+        queue = self._queue(model)
+        if queue.inflight < self.max_inflight and not queue.waiters:
+            queue.inflight += 1
+            self._update_gauges(model, queue)
+            ADMISSION_WAIT_SECONDS.observe(model_label(model), str(priority), value=0)
+            return lambda: self._release(model, queue)
+        if len(queue.waiters) >= self.max_queue:
+            self._shed(model, queue, priority)
+        future = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        entry = (priority, self._seq, future)
+        heapq.heappush(queue.waiters, entry)
+        self._update_gauges(model, queue)
+        start = time.monotonic()
+        granted = False
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.max_queue_time)
+            granted = True
+        except asyncio.TimeoutError:
+            ADMISSION_SHED.inc(model_label(model), "timeout")
+            raise AdmissionRejected(f"Timed out waiting for model {model}")
+        finally:
+            if not future.done():
+                future.cancel()
+            elif not granted and not future.cancelled() and future.exception() is None:
+                # the slot was handed over just as we gave up, pass it on
+                self._release(model, queue)
+            if entry in queue.waiters:
+                queue.waiters.remove(entry)
+                heapq.heapify(queue.waiters)
+            self._update_gauges(model, queue)
+            ADMISSION_WAIT_SECONDS.observe(model_label(model), str(priority), value=time.monotonic() - start)
+        return lambda: self._release(model, queue)
+
+    def _release(self, model: str, queue: _ModelQueue):
+        # hand the slot straight to the next waiter that is still waiting
+        while queue.waiters:
+            _, _, future = heapq.heappop(queue.waiters)
+            if not future.done():
+                future.set_result(None)
+                self._update_gauges(model, queue)
+                return
+        queue.inflight -= 1
+        self._update_gauges(model, queue)
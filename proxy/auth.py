@@ -3,9 +3,17 @@ import secrets
 import traceback
 import requests
 from datetime import datetime
+from typing import Optional
 from sqlmodel import SQLModel, Field, Session, create_engine, select
+from starlette.concurrency import run_in_threadpool
+from proxy.cache import KeyCache
 
-known_tokens = set()
+key_cache = KeyCache()
+
+INSTITUTION_DOMAINS = [
+    'ethz.ch','cscs.ch','unibas.ch','unibe.ch','uzh.ch',
+    'epfl.ch','unil.ch','unige.ch','hevs.ch',
+]
 
 class APIKey(SQLModel, table=True):
     key: str = Field(primary_key=True)
@@ -14,6 +22,9 @@ class APIKey(SQLModel, table=True):
     updated_at: datetime = Field(default=datetime.now())
     owner_email: str = Field(default="")
 
+def is_institutional(owner_email: str) -> bool:
+    return any([owner_email.lower().endswith(x) for x in INSTITUTION_DOMAINS])
+
 def get_or_create_apikey(engine, owner_email: str) -> APIKey:
     with Session(engine) as session:
         api_key = session.exec(
@@ -21,10 +32,7 @@ def get_or_create_apikey(engine, owner_email: str) -> APIKey:
         ).first()
         if api_key is None:
             key = f"sk-rc-{secrets.token_urlsafe(16)}"
-            if any([owner_email.lower().endswith(x) for x in [
-                'ethz.ch','cscs.ch','unibas.ch','unibe.ch','uzh.ch',
-                'epfl.ch','unil.ch','unige.ch','hevs.ch',
-            ]]):
+            if is_institutional(owner_email):
                 budget = 1000
             else:
                 budget = -1
@@ -45,21 +53,64 @@ def rotate_key(engine, key: str) -> APIKey:
         session.add(api_key)
         session.commit()
         session.refresh(api_key)
+        key_cache.invalidate(key)
         return api_key
 
-def verify_token(engine, token: str) -> APIKey:
-    if token in known_tokens:
-        return True
+def set_budget(engine, key: str, budget: int) -> APIKey:
     with Session(engine) as session:
         api_key = session.exec(
-            select(APIKey).where(APIKey.key == token)
+            select(APIKey).where(APIKey.key == key)
         ).first()
         if api_key is None:
-            return False
-        if api_key.budget <= 0:
-            return False
-        known_tokens.add(token)
-        return True
+            raise ValueError("Invalid key")
+        api_key.budget = budget
+        api_key.updated_at = datetime.now()
+        session.add(api_key)
+        session.commit()
+        session.refresh(api_key)
+        key_cache.invalidate(key)
+        return api_key
+
+def _query_apikey(engine, token: str) -> Optional[APIKey]:
+    # only the DB read, it runs in the threadpool and the cache is not thread-safe
+    with Session(engine) as session:
+        return session.exec(
+            select(APIKey).where(APIKey.key == token)
+        ).first()
+
+def _cache_apikey(token: str, api_key: Optional[APIKey]) -> Optional[APIKey]:
+    if api_key is None or api_key.budget <= 0:
+        key_cache.reject(token)
+        return None
+    key_cache.put(token, api_key)
+    return api_key
+
+def verify_token(engine, token: str) -> Optional[APIKey]:
+    api_key = key_cache.get(token)
+    if api_key is not None:
+        return api_key
+    if key_cache.is_rejected(token):
+        return None
+    return _cache_apikey(token, _query_apikey(engine, token))
+
+async def async_verify_token(engine, token: str) -> Optional[APIKey]:
+    api_key = key_cache.get(token)
+    if api_key is not None:
+        return api_key
+    if key_cache.is_rejected(token):
+        return None
+    found, api_key = await key_cache.get_shared(token)
+    if found:
+        return api_key
+    # keep the DB round trip off the event loop, the cache is updated on it
+    return _cache_apikey(token, await run_in_threadpool(_query_apikey, engine, token))
+
+def encode_apikey(api_key: APIKey) -> dict:
+    # only what requests need, for the shared key cache
+    return {"key": api_key.key, "budget": api_key.budget, "owner_email": api_key.owner_email}
+
+def decode_apikey(data: dict) -> APIKey:
+    return APIKey(**data)
 
 def get_profile_from_accesstoken(access_token: str):
     res = requests.get(
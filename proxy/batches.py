@@ -0,0 +1,483 @@
+import os
+import json
+import anyio
+import hashlib
+import time
+import asyncio
+import secrets
+from typing import Optional
+from starlette.concurrency import run_in_threadpool
+
+# /v1/completions is not offered, batch requests are sent as chat completions
+BATCH_ENDPOINTS = ("/v1/chat/completions",)
+ACTIVE_STATUSES = ("validating", "in_progress", "cancelling")
+# seconds between progress saves, other workers serve polls from disk
+SAVE_INTERVAL = 1.0
+
+def _write_json(path: str, data: dict):
+    # unique, several workers (and threads) may save the same object
+    tmp = f"{path}.{secrets.token_hex(4)}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+def _read_json(path: str) -> Optional[dict]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def _read_jsonl(path: str):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+class BatchStore:
+    """
+    Files and batches of the OpenAI Batch API, kept on the local filesystem:
+
+        {root}/files/{file_id}.json     file object
+        {root}/files/{file_id}.jsonl    file content
+        {root}/batches/{batch_id}.json  batch object
+        {root}/batches/{batch_id}.cancel  cancel request, holds its time
+        {root}/owners/{sha256(owner)}   ids of the owner's batches, one per line
+
+    Objects carry the owning API key in `owner`, which is never returned.
+    Only the worker running a batch writes its object; other workers
+    request a cancel through the marker file. The running worker holds a
+    lease on the batch (`lease_owner`, `lease_expires_at`) that it renews
+    while the batch runs.
+
+    All methods block on the filesystem, call them through the threadpool.
+    """
+    def __init__(self, root: str):
+        self.files_dir = os.path.join(root, "files")
+        self.batches_dir = os.path.join(root, "batches")
+        self.owners_dir = os.path.join(root, "owners")
+        os.makedirs(self.files_dir, exist_ok=True)
+        os.makedirs(self.batches_dir, exist_ok=True)
+        if not os.path.isdir(self.owners_dir):
+            # storage from before the index, build it once
+            os.makedirs(self.owners_dir, exist_ok=True)
+            for batch in self.list_batches():
+                self._index_batch(batch)
+
+    def content_path(self, file_id: str) -> str:
+        return os.path.join(self.files_dir, f"{file_id}.jsonl")
+
+    def create_file(self, owner: str, filename: str, purpose: str) -> dict:
+        file = {
+            "id": f"file-{secrets.token_hex(12)}",
+            "object": "file",
+            "bytes": 0,
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose,
+            "owner": owner,
+        }
+        open(self.content_path(file["id"]), "w").close()
+        self.save_file(file)
+        return file
+
+    def save_file(self, file: dict):
+        _write_json(os.path.join(self.files_dir, f"{file['id']}.json"), file)
+
+    def delete_file(self, file_id: str):
+        for suffix in (".json", ".jsonl"):
+            try:
+                os.unlink(os.path.join(self.files_dir, f"{file_id}{suffix}"))
+            except FileNotFoundError:
+                pass
+
+    def get_file(self, file_id: str, owner: str) -> Optional[dict]:
+        file = _read_json(os.path.join(self.files_dir, f"{os.path.basename(file_id)}.json"))
+        if file is None or file["owner"] != owner:
+            return None
+        return file
+
+    def save_batch(self, batch: dict):
+        _write_json(os.path.join(self.batches_dir, f"{batch['id']}.json"), batch)
+
+    def get_batch(self, batch_id: str) -> Optional[dict]:
+        return _read_json(os.path.join(self.batches_dir, f"{os.path.basename(batch_id)}.json"))
+
+    def _cancel_path(self, batch_id: str) -> str:
+        return os.path.join(self.batches_dir, f"{os.path.basename(batch_id)}.cancel")
+
+    def request_cancel(self, batch_id: str, at: int):
+        with open(self._cancel_path(batch_id), "w") as f:
+            f.write(str(at))
+
+    def cancel_requested(self, batch_id: str) -> Optional[int]:
+        try:
+            with open(self._cancel_path(batch_id)) as f:
+                return int(f.read() or 0)
+        except FileNotFoundError:
+            return None
+
+    def clear_cancel(self, batch_id: str):
+        try:
+            os.unlink(self._cancel_path(batch_id))
+        except FileNotFoundError:
+            pass
+
+    def create_batch(self, batch: dict):
+        self.save_batch(batch)
+        self._index_batch(batch)
+
+    def _owner_path(self, owner: str) -> str:
+        return os.path.join(self.owners_dir, hashlib.sha256(owner.encode()).hexdigest())
+
+    def _index_batch(self, batch: dict):
+        # appends of a line are atomic, workers share the index
+        with open(self._owner_path(batch["owner"]), "a") as f:
+            f.write(batch["id"] + "\n")
+
+    def list_batches(self, owner: Optional[str] = None):
+        if owner is None:
+            names = [name[:-len(".json")] for name in sorted(os.listdir(self.batches_dir)) if name.endswith(".json")]
+        else:
+            try:
+                with open(self._owner_path(owner)) as f:
+                    names = [line.strip() for line in f if line.strip()]
+            except FileNotFoundError:
+                names = []
+        for batch_id in names:
+            batch = self.get_batch(batch_id)
+            if batch is not None and (owner is None or batch["owner"] == owner):
+                yield batch
+
+PRIVATE_FIELDS = ("owner", "lease_owner", "lease_expires_at")
+
+def public(obj: dict) -> dict:
+    return {k: v for k, v in obj.items() if k not in PRIVATE_FIELDS}
+
+class BatchRunner:
+    """
+    Runs batches in the background through `execute(owner, body)`, which
+    returns the response body or raises.
+
+    Every batch runs `max_concurrency` requests at once, every model at
+    most `max_concurrency_per_model` and all batches together at most
+    `max_inflight`, whether or not admission control is enabled. Results
+    are appended to the output and error files as they finish, so a
+    restarted proxy resumes with the requests that have no result yet.
+    Requests still pending at `expires_at` fail with `batch_expired`.
+
+    A running batch is leased to its runner for `lease_ttl` seconds and
+    renewed well before that. `resume()` only picks up batches whose lease
+    ran out, so a batch still running in a worker that is shutting down
+    is not sent (and billed) twice.
+    """
+    def __init__(
+            self,
+            store: BatchStore,
+            execute,
+            max_concurrency: int = 16,
+            max_concurrency_per_model: int = 8,
+            max_inflight: int = 32,
+            lease_ttl: float = 60.0,
+    ):
+        self.store = store
+        self.execute = execute
+        self.max_concurrency = max_concurrency
+        self.max_concurrency_per_model = max_concurrency_per_model
+        # batch_id -> batch object of active batches, served to pollers
+        self.active = {}
+        self._model_slots = {}
+        self._slots = asyncio.Semaphore(max_inflight)
+        self._tasks = {}
+        self._saved_at = {}
+        self.worker_id = secrets.token_hex(8)
+        self.lease_ttl = lease_ttl
+        self._watcher = None
+
+    def _stored(self, batch: dict) -> dict:
+        # a batch of another worker, with a cancel it hasn't picked up yet
+        if batch["status"] in ("validating", "in_progress"):
+            cancelling_at = self.store.cancel_requested(batch["id"])
+            if cancelling_at is not None:
+                batch = {**batch, "status": "cancelling", "cancelling_at": cancelling_at}
+        return batch
+
+    def _load(self, batch_id: str) -> Optional[dict]:
+        batch = self.store.get_batch(batch_id)
+        return None if batch is None else self._stored(batch)
+
+    def _load_all(self, owner: str):
+        return [self._stored(batch) for batch in self.store.list_batches(owner)]
+
+    async def get(self, batch_id: str, owner: str) -> Optional[dict]:
+        batch = self.active.get(batch_id)
+        if batch is None:
+            batch = await run_in_threadpool(self._load, batch_id)
+        if batch is None or batch["owner"] != owner:
+            return None
+        return batch
+
+    async def list(self, owner: str):
+        batches = {batch["id"]: batch for batch in await run_in_threadpool(self._load_all, owner)}
+        batches.update({batch_id: batch for batch_id, batch in self.active.items() if batch["owner"] == owner})
+        return sorted(batches.values(), key=lambda batch: batch["created_at"], reverse=True)
+
+    def _new_batch(self, owner: str, input_file_id: str, endpoint: str, completion_window: str, metadata: Optional[dict]) -> dict:
+        now = int(time.time())
+        batch = {
+            "id": f"batch_{secrets.token_hex(12)}",
+            "object": "batch",
+            "endpoint": endpoint,
+            "errors": None,
+            "input_file_id": input_file_id,
+            "completion_window": completion_window,
+            "status": "validating",
+            "output_file_id": self.store.create_file(owner, "batch_output.jsonl", "batch_output")["id"],
+            "error_file_id": self.store.create_file(owner, "batch_errors.jsonl", "batch_output")["id"],
+            "created_at": now,
+            "in_progress_at": None,
+            "expires_at": now + 24 * 3600,
+            "completed_at": None,
+            "failed_at": None,
+            "expired_at": None,
+            "cancelling_at": None,
+            "cancelled_at": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+            "metadata": metadata,
+            "owner": owner,
+        }
+        # leased before it is written, or a resume could pick it up
+        self._lease(batch)
+        self.store.create_batch(batch)
+        return batch
+
+    async def create(self, owner: str, input_file_id: str, endpoint: str, completion_window: str, metadata: Optional[dict]) -> dict:
+        batch = await run_in_threadpool(self._new_batch, owner, input_file_id, endpoint, completion_window, metadata)
+        self._start(batch)
+        return batch
+
+    async def cancel(self, batch: dict) -> dict:
+        if batch["status"] in ("validating", "in_progress"):
+            now = int(time.time())
+            # the batch may be running in another worker, which picks this up
+            await run_in_threadpool(self.store.request_cancel, batch["id"], now)
+            if batch["id"] in self.active:
+                batch["status"] = "cancelling"
+                batch["cancelling_at"] = now
+                await self._save(batch)
+            else:
+                batch = {**batch, "status": "cancelling", "cancelling_at": now}
+        return batch
+
+    async def _check_cancel(self, batch: dict):
+        if batch["status"] in ("validating", "in_progress"):
+            cancelling_at = await run_in_threadpool(self.store.cancel_requested, batch["id"])
+            if cancelling_at is not None and batch["status"] in ("validating", "in_progress"):
+                batch["status"] = "cancelling"
+                batch["cancelling_at"] = cancelling_at
+
+    async def resume(self):
+        batches = await run_in_threadpool(lambda: list(self.store.list_batches()))
+        now = time.time()
+        for batch in batches:
+            # a live lease means the batch still runs in another worker
+            if batch["status"] in ACTIVE_STATUSES and batch["id"] not in self.active and batch.get("lease_expires_at", 0) <= now:
+                self._start(batch)
+
+    def watch(self):
+        """
+        Resume the batches left over from a restart now, and those of a
+        worker that stopped renewing its leases once they run out.
+        """
+        self._watcher = asyncio.create_task(self._watch())
+
+    async def _watch(self):
+        while True:
+            try:
+                await self.resume()
+            except Exception as e:
+                print(f"Error resuming batches: {e}")
+            await asyncio.sleep(self.lease_ttl)
+
+    def _lease(self, batch: dict):
+        batch["lease_owner"] = self.worker_id
+        batch["lease_expires_at"] = time.time() + self.lease_ttl
+
+    async def _heartbeat(self, batch: dict):
+        """
+        Renew the lease of a running batch. Returns if another worker took
+        the batch over, after this one failed to renew in time.
+        """
+        while True:
+            await asyncio.sleep(self.lease_ttl / 3)
+            try:
+                stored = await run_in_threadpool(self.store.get_batch, batch["id"])
+                if stored is not None and stored.get("lease_owner") != self.worker_id:
+                    return
+                await self._save(batch)
+            except Exception as e:
+                print(f"Error renewing the lease of batch {batch['id']}: {e}")
+
+    def _start(self, batch: dict):
+        self._lease(batch)
+        self.active[batch["id"]] = batch
+        self._tasks[batch["id"]] = asyncio.create_task(self._run(batch))
+
+    def _validate(self, batch: dict):
+        requests, errors, seen = [], [], set()
+        for line, item in enumerate(_read_jsonl(self.store.content_path(batch["input_file_id"])), start=1):
+            if not isinstance(item, dict) or not item.get("custom_id"):
+                errors.append({"code": "missing_custom_id", "message": "custom_id is required", "line": line})
+            elif item["custom_id"] in seen:
+                errors.append({"code": "duplicate_custom_id", "message": f"Duplicate custom_id {item['custom_id']}", "line": line})
+            elif item.get("url") != batch["endpoint"] or not isinstance(item.get("body"), dict):
+                errors.append({"code": "invalid_request", "message": f"Requests must POST a body to {batch['endpoint']}", "line": line})
+            else:
+                seen.add(item["custom_id"])
+                requests.append(item)
+        return requests, errors
+
+    def _results(self, batch: dict):
+        # custom_ids that already have a result, when resuming
+        completed = _read_jsonl(self.store.content_path(batch["output_file_id"]))
+        failed = _read_jsonl(self.store.content_path(batch["error_file_id"]))
+        return {record["custom_id"] for record in completed + failed}, len(completed), len(failed)
+
+    def _model_slot(self, model: str) -> asyncio.Semaphore:
+        slot = self._model_slots.get(model)
+        if slot is None:
+            slot = self._model_slots[model] = asyncio.Semaphore(self.max_concurrency_per_model)
+        return slot
+
+    def _append(self, file_id: str, records):
+        with open(self.store.content_path(file_id), "a") as f:
+            f.writelines(json.dumps(record) + "\n" for record in records)
+
+    async def _save(self, batch: dict):
+        self._lease(batch)
+        # a copy, the batch keeps changing on the event loop while it is written
+        await run_in_threadpool(self.store.save_batch, json.loads(json.dumps(batch)))
+
+    async def _run_request(self, batch: dict, item: dict):
+        record = {"id": f"batch_req_{secrets.token_hex(12)}", "custom_id": item["custom_id"]}
+        async with self._model_slot(item["body"].get("model")), self._slots:
+            try:
+                body = await self.execute(batch["owner"], {**item["body"], "stream": False})
+                record.update(response={"status_code": 200, "request_id": record["id"], "body": body}, error=None)
+            except Exception as e:
+                status_code = getattr(e, "status_code", 500)
+                record.update(
+                    response={"status_code": status_code, "request_id": record["id"], "body": None},
+                    error={"code": type(e).__name__, "message": str(getattr(e, "detail", e))},
+                )
+        if record["error"] is None:
+            await run_in_threadpool(self._append, batch["output_file_id"], [record])
+            batch["request_counts"]["completed"] += 1
+        else:
+            await run_in_threadpool(self._append, batch["error_file_id"], [record])
+            batch["request_counts"]["failed"] += 1
+        now = time.monotonic()
+        if now - self._saved_at.get(batch["id"], 0) >= SAVE_INTERVAL:
+            self._saved_at[batch["id"]] = now
+            await self._save(batch)
+
+    async def _expire(self, batch: dict, items):
+        records = [
+            {
+                "id": f"batch_req_{secrets.token_hex(12)}",
+                "custom_id": item["custom_id"],
+                "response": None,
+                "error": {"code": "batch_expired", "message": "This request could not be executed before the completion window expired."},
+            }
+            for item in items
+        ]
+        await run_in_threadpool(self._append, batch["error_file_id"], records)
+        batch["request_counts"]["failed"] += len(records)
+        batch["status"] = "expired"
+        batch["expired_at"] = int(time.time())
+
+    def _finish(self, batch: dict):
+        for file_id in (batch["output_file_id"], batch["error_file_id"]):
+            file = self.store.get_file(file_id, batch["owner"])
+            if file is not None:
+                file["bytes"] = os.path.getsize(self.store.content_path(file_id))
+                self.store.save_file(file)
+        self.store.save_batch(batch)
+        if batch["status"] not in ACTIVE_STATUSES:
+            self.store.clear_cancel(batch["id"])
+
+    async def _run(self, batch: dict):
+        lost = False
+        try:
+            requests, errors = await run_in_threadpool(self._validate, batch)
+            if errors or not requests:
+                batch["status"] = "failed"
+                batch["failed_at"] = int(time.time())
+                batch["errors"] = {"object": "list", "data": errors or [{"code": "empty_file", "message": "No requests in input file"}]}
+                return
+            done, completed, failed = await run_in_threadpool(self._results, batch)
+            batch["request_counts"] = {"total": len(requests), "completed": completed, "failed": failed}
+            if batch["status"] == "validating":
+                batch["status"] = "in_progress"
+                batch["in_progress_at"] = int(time.time())
+            await self._save(batch)
+            pending = iter([item for item in requests if item["custom_id"] not in done])
+
+            async def worker():
+                while time.time() < batch["expires_at"]:
+                    await self._check_cancel(batch)
+                    if batch["status"] == "cancelling":
+                        return
+                    item = next(pending, None)
+                    if item is None:
+                        return
+                    await self._run_request(batch, item)
+
+            work = asyncio.gather(*[worker() for _ in range(self.max_concurrency)])
+            heartbeat = asyncio.ensure_future(self._heartbeat(batch))
+            try:
+                await asyncio.wait([work, heartbeat], return_when=asyncio.FIRST_COMPLETED)
+                lost = not work.done()
+            finally:
+                work.cancel()
+                heartbeat.cancel()
+                await asyncio.gather(work, heartbeat, return_exceptions=True)
+            if lost:
+                # the other worker writes the results from here on
+                print(f"Batch {batch['id']} was taken over by another worker")
+                return
+            work.result()
+            expired = list(pending)
+            if batch["status"] == "cancelling":
+                batch["status"] = "cancelled"
+                batch["cancelled_at"] = int(time.time())
+            elif expired:
+                await self._expire(batch, expired)
+            else:
+                batch["status"] = "completed"
+                batch["completed_at"] = int(time.time())
+        except asyncio.CancelledError:
+            # shutdown, the batch stays active and is resumed on start
+            raise
+        except Exception as e:
+            print(f"Error running batch {batch['id']}: {e}")
+            batch["status"] = "failed"
+            batch["failed_at"] = int(time.time())
+            batch["errors"] = {"object": "list", "data": [{"code": type(e).__name__, "message": str(e)}]}
+        finally:
+            if not lost:
+                # this worker is done with it, active or not
+                batch["lease_expires_at"] = 0
+                with anyio.CancelScope(shield=True):
+                    await run_in_threadpool(self._finish, json.loads(json.dumps(batch)))
+            self.active.pop(batch["id"], None)
+            self._tasks.pop(batch["id"], None)
+            self._saved_at.pop(batch["id"], None)
+
+    async def stop(self):
+        if self._watcher is not None:
+            self._watcher.cancel()
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
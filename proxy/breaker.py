@@ -0,0 +1,198 @@
+import time
+from collections import deque
+import openai
+from proxy.protocols import FirstChunkTimeout, RetryConstantError, RetryExpoError, UnknownLLMError
+from proxy.metrics import CIRCUIT_STATE, model_label
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+class CircuitOpen(Exception):
+    def __init__(self, model: str, target: str, retry_after: float):
+        super().__init__(f"Upstream {target} for {model} is unavailable")
+        self.model = model
+        self.target = target
+        self.retry_after = retry_after
+
+def is_upstream_failure(e: BaseException) -> bool:
+    """
+    Whether an attempt failed because of the upstream rather than the
+    request: client errors (4xx other than 429) don't count.
+    """
+    if isinstance(e, (RetryConstantError, RetryExpoError, UnknownLLMError)):
+        cause = e.__cause__
+        if isinstance(cause, openai.APIStatusError):
+            return cause.status_code >= 500 or cause.status_code == 429
+        return True
+    return isinstance(e, (openai.APIConnectionError, TimeoutError, FirstChunkTimeout))
+
+class CircuitBreaker:
+    """
+    Closed/open/half-open breaker over a sliding time window of outcomes.
+
+    Opens when at least `min_requests` calls in the last `window` seconds
+    saw an error rate or slow-call rate above the thresholds. After
+    `open_duration` it lets `half_open_probes` calls through; if they all
+    succeed it closes, any failure opens it again.
+    """
+    def __init__(
+        self,
+        window: float = 30.0,
+        min_requests: int = 10,
+        error_threshold: float = 0.5,
+        slow_threshold: float = 0.8,
+        slow_call_duration: float = 120.0,
+        open_duration: float = 30.0,
+        half_open_probes: int = 1,
+    ):
+        self.window = window
+        self.min_requests = min_requests
+        self.error_threshold = error_threshold
+        self.slow_threshold = slow_threshold
+        self.slow_call_duration = slow_call_duration
+        self.open_duration = open_duration
+        self.half_open_probes = half_open_probes
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.probes = 0
+        self.probe_successes = 0
+        # (time, failed, slow)
+        self.outcomes = deque()
+        self.errors = 0
+        self.slow = 0
+
+    def _prune(self, now: float):
+        while self.outcomes and self.outcomes[0][0] < now - self.window:
+            _, failed, slow = self.outcomes.popleft()
+            self.errors -= failed
+            self.slow -= slow
+
+    def _open(self, now: float):
+        self.state = OPEN
+        self.opened_at = now
+        self.outcomes.clear()
+        self.errors = self.slow = 0
+
+    def available(self, now: float = None) -> bool:
+        """Whether a call would be let through, without taking a probe."""
+        now = time.monotonic() if now is None else now
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN:
+            return now - self.opened_at >= self.open_duration
+        return self.probes < self.half_open_probes
+
+    def allow(self, now: float = None) -> bool:
+        now = time.monotonic() if now is None else now
+        if self.state == OPEN and now - self.opened_at >= self.open_duration:
+            self.state = HALF_OPEN
+            self.probes = self.probe_successes = 0
+        if self.state == CLOSED:
+            return True
+        if self.state == HALF_OPEN and self.probes < self.half_open_probes:
+            self.probes += 1
+            return True
+        return False
+
+    def retry_after(self, now: float = None) -> float:
+        now = time.monotonic() if now is None else now
+        return max(1.0, self.opened_at + self.open_duration - now)
+
+    def record(self, success: bool, duration: float, now: float = None):
+        now = time.monotonic() if now is None else now
+        slow = duration >= self.slow_call_duration
+        if self.state == HALF_OPEN:
+            if not success or slow:
+                self._open(now)
+                return
+            self.probe_successes += 1
+            if self.probe_successes >= self.half_open_probes:
+                self.state = CLOSED
+            return
+        if self.state == OPEN:
+            # a call that was let through before the circuit opened
+            return
+        self.outcomes.append((now, not success, slow))
+        self.errors += not success
+        self.slow += slow
+        self._prune(now)
+        total = len(self.outcomes)
+        if total >= self.min_requests and (
+            self.errors / total >= self.error_threshold
+            or self.slow / total >= self.slow_threshold
+        ):
+            self._open(now)
+
+    def snapshot(self) -> dict:
+        self._prune(time.monotonic())
+        return {
+            "state": self.state,
+            "requests": len(self.outcomes),
+            "errors": self.errors,
+            "slow": self.slow,
+        }
+
+class BreakerRegistry:
+    """
+    Circuit breakers per model and upstream target (a node id, or "head").
+    """
+    def __init__(self, **options):
+        self.options = options
+        self.breakers = {}
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(
+            window=settings.breaker_window,
+            min_requests=settings.breaker_min_requests,
+            error_threshold=settings.breaker_error_threshold,
+            slow_threshold=settings.breaker_slow_threshold,
+            slow_call_duration=settings.breaker_slow_call_duration,
+            open_duration=settings.breaker_open_duration,
+            half_open_probes=settings.breaker_half_open_probes,
+        )
+
+    def get(self, model: str, target: str) -> CircuitBreaker:
+        breaker = self.breakers.get((model, target))
+        if breaker is None:
+            breaker = self.breakers[(model, target)] = CircuitBreaker(**self.options)
+        return breaker
+
+    def available(self, model: str, target: str) -> bool:
+        breaker = self.breakers.get((model, target))
+        return breaker is None or breaker.available()
+
+    def guard(self, model: str, target: str, attempt):
+        """
+        Wrap an upstream attempt so it fails fast with CircuitOpen while the
+        circuit is open and its outcome is recorded otherwise.
+        """
+        breaker = self.get(model, target)
+
+        async def guarded():
+            if not breaker.allow():
+                raise CircuitOpen(model, target, breaker.retry_after())
+            start = time.monotonic()
+            try:
+                result = await attempt()
+            except BaseException as e:
+                if is_upstream_failure(e):
+                    breaker.record(False, time.monotonic() - start)
+                elif breaker.state == HALF_OPEN:
+                    # the probe didn't tell us anything, give it back
+                    breaker.probes -= 1
+                raise
+            else:
+                breaker.record(True, time.monotonic() - start)
+                return result
+            finally:
+                CIRCUIT_STATE.set(model_label(model), target, value=STATE_VALUES[breaker.state])
+        return guarded
+
+    def status(self) -> list:
+        return [
+            {"model": model, "target": target, **breaker.snapshot()}
+            for (model, target), breaker in self.breakers.items()
+        ]
@@ -1,5 +1,10 @@
-from cachetools import cached, TTLCache
+import json
+import time
+import asyncio
+import hashlib
+from cachetools import cached, LRUCache, TTLCache
 from auth0.authentication import GetToken
+from proxy.metrics import CACHE_LOOKUPS
 
 @cached(cache=TTLCache(maxsize=1024, ttl=24*60*60))
 def get_auth0_token(domain, client_id, client_secret, audience):
@@ -7,4 +12,242 @@ def get_auth0_token(domain, client_id, client_secret, audience):
     management_token = get_token.client_credentials(
         audience=audience,
     )
-    return management_token
\ No newline at end of file
+    return management_token
+
+class KeyCache:
+    """
+    Bounded cache in front of the APIKey table.
+
+    Accepted keys are kept in an LRU with a TTL. Unknown or exhausted keys
+    are remembered for a shorter time, so repeated guesses don't reach the
+    database.
+
+    With several workers the cache can be backed by the shared state
+    server (attach): local misses are looked up there before the database,
+    and invalidations reach every worker.
+    """
+    def __init__(self, maxsize=10000, ttl=300, negative_maxsize=10000, negative_ttl=30):
+        self.configure(maxsize, ttl, negative_maxsize, negative_ttl)
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.shared_hits = 0
+        self.shared = None
+
+    def configure(self, maxsize, ttl, negative_maxsize, negative_ttl):
+        self._keys = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._rejected = TTLCache(maxsize=negative_maxsize, ttl=negative_ttl)
+
+    async def attach(self, shared, encode, decode):
+        """
+        Share entries through `shared` (a SharedState), `encode` and
+        `decode` convert cached values to and from plain JSON types.
+        """
+        self.shared = shared
+        self._encode, self._decode = encode, decode
+        await shared.call("cache_configure", ns="keys", maxsize=self._keys.maxsize, ttl=self._keys.ttl)
+        await shared.call("cache_configure", ns="rejected", maxsize=self._rejected.maxsize, ttl=self._rejected.ttl)
+
+        def on_event(event):
+            if event.get("event") == "invalidate" and event.get("ns") == ["keys", "rejected"]:
+                self._drop(event["key"])
+        shared.on_event(on_event)
+
+    async def get_shared(self, token):
+        """
+        Look up a local miss in the shared cache. Returns (found, value);
+        found with a None value means the key is rejected.
+        """
+        if self.shared is None:
+            return False, None
+        value = await self.shared.call("cache_get", ns="keys", key=token)
+        if value is not None:
+            self.shared_hits += 1
+            CACHE_LOOKUPS.inc("keys", "shared_hit")
+            api_key = self._decode(value)
+            self._keys[token] = api_key
+            return True, api_key
+        if await self.shared.call("cache_get", ns="rejected", key=token):
+            self.shared_hits += 1
+            CACHE_LOOKUPS.inc("keys", "shared_hit")
+            self._rejected[token] = True
+            return True, None
+        return False, None
+
+    def get(self, token):
+        api_key = self._keys.get(token)
+        if api_key is not None:
+            self.hits += 1
+            CACHE_LOOKUPS.inc("keys", "hit")
+        return api_key
+
+    def is_rejected(self, token) -> bool:
+        if token in self._rejected:
+            self.negative_hits += 1
+            CACHE_LOOKUPS.inc("keys", "negative_hit")
+            return True
+        self.misses += 1
+        CACHE_LOOKUPS.inc("keys", "miss")
+        return False
+
+    def put(self, token, api_key):
+        self._rejected.pop(token, None)
+        self._keys[token] = api_key
+        if self.shared is not None:
+            self.shared.send("cache_set", ns="keys", key=token, value=self._encode(api_key))
+
+    def reject(self, token):
+        self._keys.pop(token, None)
+        self._rejected[token] = True
+        if self.shared is not None:
+            self.shared.send("cache_set", ns="rejected", key=token, value=True)
+
+    def _drop(self, token):
+        self._keys.pop(token, None)
+        self._rejected.pop(token, None)
+
+    def invalidate(self, token):
+        self._drop(token)
+        if self.shared is not None:
+            # also drops it from the other workers' local caches
+            self.shared.send("invalidate", ns=["keys", "rejected"], key=token)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._keys),
+            "rejected_size": len(self._rejected),
+            "hits": self.hits,
+            "misses": self.misses,
+            "negative_hits": self.negative_hits,
+            "shared_hits": self.shared_hits,
+        }
+
+
+# request fields that don't change what the model generates
+RESPONSE_CACHE_IGNORED = ("stream", "stream_options", "user_id", "user")
+
+def is_deterministic(data: dict) -> bool:
+    return data.get("temperature") == 0 or data.get("seed") is not None
+
+def response_cache_key(data: dict) -> str:
+    payload = {k: v for k, v in data.items() if k not in RESPONSE_CACHE_IGNORED}
+    encoded = json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+class ResponseCache:
+    """
+    LRU/TTL cache of upstream responses with single-flight: concurrent
+    callers for the same key wait on one upstream call. `name` labels its
+    lookups in proxy_cache_lookups_total.
+    """
+    def __init__(self, maxsize=1024, ttl=600, name="responses"):
+        self.name = name
+        self.configure(maxsize, ttl)
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def configure(self, maxsize, ttl):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def _compute(self, key, compute):
+        try:
+            value = await compute()
+            self._cache[key] = value
+            return value
+        finally:
+            self._inflight.pop(key, None)
+
+    async def get_or_compute(self, key, compute):
+        """
+        Returns (value, hit). `hit` is False only for the caller whose
+        request went upstream.
+        """
+        value = self._cache.get(key)
+        if value is not None:
+            self.hits += 1
+            CACHE_LOOKUPS.inc(self.name, "hit")
+            return value, True
+        task = self._inflight.get(key)
+        if task is None:
+            self.misses += 1
+            CACHE_LOOKUPS.inc(self.name, "miss")
+            # runs on its own, a disconnecting caller doesn't fail the others
+            task = asyncio.ensure_future(self._compute(key, compute))
+            self._inflight[key] = task
+            hit = False
+        else:
+            self.coalesced += 1
+            CACHE_LOOKUPS.inc(self.name, "coalesced")
+            hit = True
+        return await asyncio.shield(task), hit
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._cache),
+            "inflight": len(self._inflight),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+        }
+
+
+class RefreshAheadCache:
+    """
+    Bounded LRU for slow remote reads.
+
+    - entries younger than `refresh_ahead * ttl` are served as is
+    - older fresh entries are served while a background refresh runs
+    - expired entries are refetched, if that fails or takes longer than
+      `timeout` the stale value is served for up to `stale_ttl`
+    - concurrent fetches of one key share a single call
+    """
+    def __init__(self, maxsize=1024, ttl=3600, stale_ttl=86400, timeout=5.0, refresh_ahead=0.8):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.timeout = timeout
+        self.refresh_ahead = refresh_ahead
+        # key -> (value, fetched_at)
+        self._entries = LRUCache(maxsize=maxsize)
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    async def _fetch(self, key, fetch):
+        try:
+            value = await fetch()
+            self._entries[key] = (value, time.monotonic())
+            return value
+        finally:
+            self._inflight.pop(key, None)
+
+    def _refresh(self, key, fetch):
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(key, fetch))
+            # a background refresh may fail with nobody awaiting it
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            self._inflight[key] = task
+        return task
+
+    async def get(self, key, fetch):
+        entry = self._entries.get(key)
+        if entry is not None:
+            value, fetched_at = entry
+            age = time.monotonic() - fetched_at
+            if age < self.ttl:
+                self.hits += 1
+                if age >= self.refresh_ahead * self.ttl:
+                    self._refresh(key, fetch)
+                return value
+        self.misses += 1
+        task = self._refresh(key, fetch)
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), self.timeout)
+        except Exception:
+            if entry is not None and time.monotonic() - entry[1] < self.stale_ttl:
+                self.stale += 1
+                return entry[0]
+            raise
@@ -0,0 +1,69 @@
+import httpx
+from langfuse.openai import openai
+
+class ClientRegistry:
+    """
+    Long-lived AsyncOpenAI clients, one per upstream base url.
+
+    All clients share the pool limits from Settings. The user api key is
+    not part of the client, it is sent per request (see `auth_headers`).
+    """
+    def __init__(
+        self,
+        max_connections: int = 1000,
+        max_keepalive_connections: int = 100,
+        keepalive_expiry: float = 30.0,
+        http2: bool = False,
+        timeout: float = 600.0,
+    ):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.http2 = http2
+        self.timeout = httpx.Timeout(timeout, connect=5.0)
+        self._clients = {}
+        self._http_clients = {}
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(
+            max_connections=settings.upstream_max_connections,
+            max_keepalive_connections=settings.upstream_max_keepalive_connections,
+            keepalive_expiry=settings.upstream_keepalive_expiry,
+            http2=settings.upstream_http2,
+            timeout=settings.upstream_timeout,
+        )
+
+    def get_http(self, base_url: str) -> httpx.AsyncClient:
+        http_client = self._http_clients.get(base_url)
+        if http_client is None:
+            http_client = httpx.AsyncClient(
+                limits=self.limits,
+                http2=self.http2,
+                timeout=self.timeout,
+            )
+            self._http_clients[base_url] = http_client
+        return http_client
+
+    def get(self, base_url: str) -> openai.AsyncOpenAI:
+        client = self._clients.get(base_url)
+        if client is None:
+            client = openai.AsyncOpenAI(
+                # placeholder, the caller's key goes into every request
+                api_key="-",
+                base_url=base_url,
+                http_client=self.get_http(base_url),
+            )
+            self._clients[base_url] = client
+        return client
+
+    async def aclose(self):
+        self._clients = {}
+        http_clients, self._http_clients = self._http_clients, {}
+        for http_client in http_clients.values():
+            await http_client.aclose()
+
+def auth_headers(api_key: str) -> dict:
+    return {"Authorization": f"Bearer {api_key}"}
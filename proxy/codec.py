@@ -0,0 +1,37 @@
+"""
+JSON for the request path: orjson when it is installed, the standard
+library otherwise. Everything encodes to compact UTF-8 bytes.
+"""
+import json
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    loads = orjson.loads
+
+    def dumps(obj) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+else:
+    loads = json.loads
+
+    def dumps(obj) -> bytes:
+        return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode()
+
+def sse(obj) -> bytes:
+    """One server-sent event carrying `obj`."""
+    return b"data: " + dumps(obj) + b"\n\n"
+
+class EncodedJSONResponse(JSONResponse):
+    """
+    JSONResponse encoded with the codec. Content must already be plain
+    JSON types (or bytes, which are sent as they are), FastAPI's
+    jsonable_encoder is skipped.
+    """
+    def render(self, content) -> bytes:
+        if isinstance(content, bytes):
+            return content
+        return dumps(content)
@@ -17,6 +17,106 @@ class Settings(BaseSettings):
     auth_secret: str
     auth_trust_host: bool = False
     ocf_head_addr: str
+    upstream_max_connections: int = 1000
+    upstream_max_keepalive_connections: int = 100
+    upstream_keepalive_expiry: float = 30.0
+    upstream_http2: bool = False
+    upstream_timeout: float = 600.0
+    # total time for a request including retries, clients can ask for
+    # less (or up to request_deadline_max) with an X-Request-Timeout header
+    request_deadline: float = 600.0
+    request_deadline_max: float = 1800.0
+    retry_max_tries: int = 3
+    # don't retry when less than this is left of the deadline
+    retry_min_attempt_time: float = 1.0
+    # duplicate non-streaming requests slower than the model's recent p95
+    hedge_enabled: bool = False
+    hedge_quantile: float = 0.95
+    hedge_min_delay: float = 0.5
+    hedge_min_samples: int = 20
+    # circuit breakers per model and upstream, over a sliding window
+    breaker_window: float = 30.0
+    breaker_min_requests: int = 10
+    breaker_error_threshold: float = 0.5
+    breaker_slow_threshold: float = 0.8
+    breaker_slow_call_duration: float = 120.0
+    breaker_open_duration: float = 30.0
+    breaker_half_open_probes: int = 1
+    # bearer token for /v1/admin endpoints, which are disabled when empty
+    admin_api_key: str = ""
+    # give up on a stream that sends nothing for this long (0 waits up to
+    # the request deadline) and fail over to another node or the head
+    stream_first_chunk_timeout: float = 0
+    stream_failover_attempts: int = 1
+    # uvicorn workers started by `python -m proxy.main`; with more than one
+    # they share caches, rate limits, the model table and metrics through a
+    # state server on this Unix socket (run `python -m proxy.shared` yourself
+    # when starting the workers another way, e.g. with gunicorn)
+    workers: int = 1
+    state_socket: str = ""
+    metrics_push_interval: float = 5.0
+    metrics_stale_after: float = 30.0
+    # forward raw upstream SSE bytes instead of re-serializing every chunk
+    stream_passthrough: bool = False
+    key_cache_size: int = 10000
+    key_cache_ttl: int = 300
+    key_cache_negative_ttl: int = 30
+    metering_enabled: bool = True
+    metering_flush_interval: float = 10.0
+    # APIKey.budget is counted in units of this many tokens
+    metering_tokens_per_unit: int = 1000
+    model_registry_refresh_interval: float = 15.0
+    model_registry_timeout: float = 5.0
+    # "head" lets the OCF head route, "direct" picks a serving node here
+    routing_mode: str = "head"
+    # "p2c" (power of two choices), "least" (least outstanding requests)
+    # or "prefix" (prompt-prefix affinity with bounded load)
+    routing_policy: str = "p2c"
+    routing_prefix_messages: int = 1
+    routing_prefix_chars: int = 4096
+    routing_prefix_load_factor: float = 1.25
+    # formatted with head, node_id and address (the node's public_address)
+    routing_node_endpoint: str = "{head}/v1/p2p/{node_id}/v1/_service/llm/v1/"
+    # cache responses of temperature=0 / seeded requests
+    response_cache_enabled: bool = False
+    response_cache_size: int = 4096
+    response_cache_ttl: int = 600
+    # per key, and per key and model; 0 disables a limit
+    rate_limit_requests_per_second: float = 0
+    rate_limit_tokens_per_minute: float = 0
+    rate_limit_max_concurrent: int = 0
+    rate_limit_model_requests_per_second: float = 0
+    rate_limit_model_tokens_per_minute: float = 0
+    rate_limit_model_max_concurrent: int = 0
+    # "local" (per process) or "redis" (shared across replicas)
+    rate_limit_backend: str = "local"
+    rate_limit_redis_url: str = "redis://localhost:6379/0"
+    # upstream requests per model at once, 0 disables admission control
+    admission_max_inflight: int = 0
+    admission_max_queue: int = 256
+    admission_max_queue_time: float = 30.0
+    # "local" serves /v1/statistics from the proxy's own usage rollups
+    statistics_source: str = "local"
+    statistics_flush_interval: float = 30.0
+    statistics_retention_days: int = 90
+    # Langfuse source only
+    statistics_cache_size: int = 1024
+    statistics_cache_ttl: int = 3600
+    statistics_stale_ttl: int = 24 * 3600
+    statistics_fetch_timeout: float = 5.0
+    profile_cache_size: int = 10000
+    profile_cache_ttl: int = 300
+    batch_storage_dir: str = "data/batches"
+    batch_max_file_bytes: int = 200 * 1024 * 1024
+    batch_max_concurrency: int = 16
+    batch_max_concurrency_per_model: int = 8
+    # all batches together, applies with admission control disabled too
+    batch_max_inflight: int = 32
+    # a batch whose runner stopped renewing its lease for this long is resumed
+    batch_lease_ttl: float = 60.0
+    batch_retry_interval: float = 5.0
+    embeddings_max_batch_size: int = 64
+    embeddings_max_wait: float = 0.005
     langfuse_host: str
     langfuse_public_key: str
     langfuse_secret_key: str
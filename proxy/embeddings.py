@@ -0,0 +1,86 @@
+import json
+import asyncio
+from proxy.llm_proxy import BYTES_PER_TOKEN
+from proxy.metrics import EMBEDDING_BATCH_SIZE, model_label
+
+def is_single_input(value) -> bool:
+    # one string, or one pre-tokenized input
+    return isinstance(value, str) or (
+        isinstance(value, list) and len(value) > 0 and all(isinstance(v, int) for v in value)
+    )
+
+class EmbeddingBatcher:
+    """
+    Coalesces concurrent single-input embedding requests for the same key,
+    model, options and kind of input (text or tokens) into one upstream request of up to `max_batch_size` inputs.
+    A batch is sent when it is full or `max_wait` seconds after it opened.
+
+    `send(token, model, options, inputs)` makes the upstream call and
+    returns the OpenAI embeddings response.
+    """
+    def __init__(self, send, max_batch_size: int = 64, max_wait: float = 0.005):
+        self.send = send
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        # (token, model, options, kind) -> [(token, input, future)]
+        self._batches = {}
+        self._timers = {}
+        self._tasks = set()
+
+    async def embed(self, token: str, model: str, options: dict, value):
+        """
+        Returns (embedding, prompt_tokens) for one input.
+        """
+        # each key is billed for its own inputs, and text and tokens can't share a request
+        key = (token, model, json.dumps(options, sort_keys=True), isinstance(value, str))
+        batch = self._batches.get(key)
+        if batch is None:
+            batch = self._batches[key] = []
+            self._timers[key] = asyncio.get_running_loop().call_later(self.max_wait, self._flush, key)
+        future = asyncio.get_running_loop().create_future()
+        batch.append((token, value, future))
+        if len(batch) >= self.max_batch_size:
+            self._flush(key)
+        return await future
+
+    def _flush(self, key):
+        batch = self._batches.pop(key, None)
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        if not batch:
+            return
+        task = asyncio.ensure_future(self._send_batch(key, batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send_batch(self, key, batch):
+        _, model, options, _ = key
+        EMBEDDING_BATCH_SIZE.observe(model_label(model), value=len(batch))
+        inputs = [value for _, value, _ in batch]
+        try:
+            response = await self.send(batch[0][0], model, json.loads(options), inputs)
+            embeddings = {item["index"]: item["embedding"] for item in response["data"]}
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        # the upstream reports usage for the whole batch, split it by each
+        # input's share of the tokens, estimated for text
+        total_tokens = (response.get("usage") or {}).get("prompt_tokens", 0)
+        shares = [len(value) / BYTES_PER_TOKEN if isinstance(value, str) else len(value) for value in inputs]
+        total_share = sum(shares) or 1
+        split, share = [], 0
+        for value in shares:
+            # rounded cumulatively, so the parts add up to the total
+            split.append(round(total_tokens * (share + value) / total_share) - round(total_tokens * share / total_share))
+            share += value
+        for index, ((_, _, future), tokens) in enumerate(zip(batch, split)):
+            if future.done():
+                continue
+            if index not in embeddings:
+                # a short response must not leave callers waiting forever
+                future.set_exception(RuntimeError(f"Upstream returned no embedding for input {index}"))
+            else:
+                future.set_result((embeddings[index], tokens))
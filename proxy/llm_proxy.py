@@ -1,7 +1,15 @@
-import json
+import anyio
+import inspect
+import httpx
 import backoff
+from collections import deque
+from starlette.requests import Request
+from langfuse import Langfuse
 from langfuse.openai import openai
-from proxy.protocols import ModelResponse, RetryConstantError, RetryExpoError, UnknownLLMError
+from proxy import codec
+from proxy.clients import auth_headers
+from proxy.metrics import UPSTREAM_ERRORS, StreamTimer, model_label
+from proxy.protocols import CompactResponse, FirstChunkTimeout, ModelResponse, RetryConstantError, RetryExpoError, UnknownLLMError
 
 def response_generator(response, generation):
     for chunk in response:
@@ -11,16 +19,231 @@ def response_generator(response, generation):
                 "promptTokens": data["usage"]["prompt_tokens"],
                 "completionTokens": data["usage"]["completion_tokens"],
             })
-        yield f"data: {json.dumps(data)}\n\n"
+        yield codec.sse(data)
 
-def handle_llm_exception(e: Exception):
-    if isinstance(
-        e,
-        (
-            openai.APIError,
-            openai.Timeout,
-        ),
-    ):
+# rough bytes per token, for prompts whose usage the upstream never reported
+BYTES_PER_TOKEN = 4
+
+def estimate_prompt_tokens(data: dict) -> int:
+    """Estimate the prompt tokens of a request from the length of its text."""
+    size = 0
+    prompt = data.get("prompt")
+    for text in (prompt if isinstance(prompt, list) else [prompt]):
+        if isinstance(text, str):
+            size += len(text)
+    for message in data.get("messages") or []:
+        content = message.get("content") if isinstance(message, dict) else None
+        if isinstance(content, str):
+            size += len(content)
+        elif isinstance(content, list):
+            size += sum(len(part.get("text") or "") for part in content if isinstance(part, dict))
+    return max(1, size // BYTES_PER_TOKEN)
+
+def report_usage(generation, usage, completion_tokens=0, on_usage=None, prompt_estimate=0):
+    """
+    Record the usage of a finished stream. Without a usage event (the
+    client or the upstream went away), the number of streamed chunks
+    stands in for the completion tokens and `prompt_estimate` for the
+    prompt tokens. Returns the completion tokens recorded.
+    """
+    if usage is not None:
+        prompt_tokens, completion_tokens = usage["prompt_tokens"], usage["completion_tokens"]
+        generation.update(usage={
+            "promptTokens": prompt_tokens,
+            "completionTokens": completion_tokens,
+        })
+    elif completion_tokens:
+        prompt_tokens = prompt_estimate
+        generation.update(usage={
+            "promptTokens": prompt_tokens,
+            "completionTokens": completion_tokens,
+        })
+    else:
+        return 0
+    if on_usage is not None:
+        on_usage(prompt_tokens, completion_tokens)
+    return completion_tokens
+
+async def async_response_generator(response, generation, request: Request = None, on_usage=None, timer: StreamTimer = None, prompt_estimate: int = 0):
+    """
+    Forward upstream chunks as SSE. If the client goes away, the upstream
+    stream is closed right away and the usage reached so far is recorded.
+    """
+    chunks = response.__aiter__()
+    usage = None
+    completion_tokens = 0
+    status = "cancelled"
+    try:
+        async for chunk in chunks:
+            if request is not None and await request.is_disconnected():
+                break
+            if timer is not None:
+                timer.chunk()
+            data = chunk.to_dict()
+            if data.get("usage", None) is not None:
+                usage = data["usage"]
+            elif data.get("choices"):
+                # one chunk per token, used when the stream ends early
+                completion_tokens += 1
+            yield codec.sse(data)
+        else:
+            status = "ok"
+    except Exception:
+        status = "error"
+        raise
+    finally:
+        # Starlette cancels the generator on disconnect, cleanup must still run
+        with anyio.CancelScope(shield=True):
+            await chunks.aclose()
+            await response.close()
+            completion_tokens = report_usage(generation, usage, completion_tokens, on_usage, prompt_estimate)
+            if timer is not None:
+                timer.finish(completion_tokens, status)
+
+# kwargs consumed by the langfuse openai wrapper, never sent upstream
+LANGFUSE_KWARGS = ("name", "user_id", "session_id", "trace_id", "tags", "parent_observation_id")
+# raw reads kept around to find the usage event at the end of a stream
+USAGE_SCAN_READS = 8
+
+_langfuse = None
+
+def get_langfuse() -> Langfuse:
+    global _langfuse
+    if _langfuse is None:
+        _langfuse = Langfuse()
+    return _langfuse
+
+def _scan_usage(tail: bytes):
+    idx = tail.rfind(b'"usage"')
+    if idx == -1:
+        return None
+    start = tail.rfind(b"data:", 0, idx)
+    end = tail.find(b"\n", idx)
+    if start == -1:
+        return None
+    try:
+        data = codec.loads(tail[start + len(b"data:"):end if end != -1 else None])
+    except ValueError:
+        return None
+    return data.get("usage", None)
+
+async def passthrough_response_generator(response: httpx.Response, generation, request: Request = None, on_usage=None, timer: StreamTimer = None, prompt_estimate: int = 0):
+    """
+    Forward the upstream SSE bytes unchanged. Only the last few reads are
+    kept, to pick the usage out of the final event once the stream is done.
+    """
+    tail = deque(maxlen=USAGE_SCAN_READS)
+    events = 0
+    status = "cancelled"
+    try:
+        # aiter_bytes undoes any content encoding the upstream applied anyway
+        async for raw in response.aiter_bytes():
+            if request is not None and await request.is_disconnected():
+                break
+            if timer is not None:
+                timer.chunk()
+            tail.append(raw)
+            # one token per content chunk, not counting the usage event or [DONE]
+            events += raw.count(b'"delta"')
+            yield raw
+        else:
+            status = "ok"
+    except Exception:
+        status = "error"
+        raise
+    finally:
+        with anyio.CancelScope(shield=True):
+            await response.aclose()
+            completion_tokens = report_usage(generation, _scan_usage(b"".join(tail)), events, on_usage, prompt_estimate)
+            generation.end()
+            if timer is not None:
+                timer.finish(completion_tokens, status)
+
+def _status_error(response: httpx.Response) -> openai.APIStatusError:
+    message = f"Error code: {response.status_code} - {response.text}"
+    if response.status_code == 401:
+        return openai.AuthenticationError(message, response=response, body=None)
+    if response.status_code == 429:
+        return openai.RateLimitError(message, response=response, body=None)
+    return openai.APIStatusError(message, response=response, body=None)
+
+def stream_error_event(e: Exception) -> bytes:
+    error = {"message": f"Upstream stream failed: {e}", "type": "upstream_error"}
+    return codec.sse({"error": error})
+
+def _ends_event(chunk) -> bool:
+    # passthrough chunks are raw bytes and may split an event
+    if isinstance(chunk, str):
+        chunk = chunk.encode()
+    return chunk.replace(b"\r", b"").endswith(b"\n\n")
+
+async def committed_stream(first, chunks):
+    """
+    A stream whose first chunk has been read. The client has the response
+    headers from here on, so an upstream failure ends the stream with an
+    SSE error event instead of cutting it off.
+    """
+    last = first
+    try:
+        yield first
+        async for chunk in chunks:
+            last = chunk
+            yield chunk
+    except Exception as e:
+        print(f"Error in committed_stream: {e}")
+        if last and not _ends_event(last):
+            # end the partial event, or the client reads the error as part of it
+            yield b"\n\n"
+        yield stream_error_event(e)
+    finally:
+        with anyio.CancelScope(shield=True):
+            await chunks.aclose()
+
+async def _empty_stream():
+    return
+    yield
+
+async def prefetch_stream(chunks):
+    """
+    Read the first chunk of a stream, before anything is sent to the
+    client, so a failing upstream can still be left for another one.
+    How long to wait is up to the caller.
+    """
+    try:
+        first = await chunks.__anext__()
+    except StopAsyncIteration:
+        return _empty_stream()
+    return committed_stream(first, chunks)
+
+async def guard_stream(chunks, on_close):
+    """
+    Pass a stream through and call `on_close` (sync or async) once it is
+    done, also when the client disconnects.
+    """
+    try:
+        async for chunk in chunks:
+            yield chunk
+    finally:
+        with anyio.CancelScope(shield=True):
+            await chunks.aclose()
+            result = on_close()
+            if inspect.isawaitable(result):
+                await result
+
+async def replay_stream(response: dict):
+    """
+    Replay a finished chat completion as SSE chunks, for stream clients
+    served from the response cache.
+    """
+    for chunk in CompactResponse(response).chunks():
+        yield codec.sse(chunk.to_dict())
+    yield b"data: [DONE]\n\n"
+
+def handle_llm_exception(e: Exception, model: str = None):
+    UPSTREAM_ERRORS.inc(model_label(model), type(e).__name__)
+    # most openai errors subclass APIError (and timeouts subclass
+    # APIConnectionError), so the specific classes are checked first
+    if isinstance(e, openai.Timeout):
         raise RetryConstantError from e
     elif isinstance(e, openai.RateLimitError):
         raise RetryExpoError from e
@@ -32,6 +255,8 @@ def handle_llm_exception(e: Exception):
         ),
     ):
         raise e
+    elif isinstance(e, openai.APIError):
+        raise RetryConstantError from e
     else:
         raise UnknownLLMError from e
 
@@ -60,8 +285,66 @@ def llm_proxy(endpoint, api_key, **kwargs) -> ModelResponse:
             return response
         except Exception as e:
             print(f"Error in llm_proxy: {e}")
-            handle_llm_exception(e) # this tries fallback requests
+            handle_llm_exception(e, kwargs.get('model')) # this tries fallback requests
     try:
         return _completion()
     except Exception as e:
-        raise e
\ No newline at end of file
+        raise e
+
+# A single attempt; the async path is retried by proxy.retry.RetryPolicy
+# within the request deadline.
+async def async_llm_proxy(client: openai.AsyncOpenAI, api_key, **kwargs) -> ModelResponse:
+    try:
+        kwargs['name']="chat-generation"
+        kwargs['extra_headers'] = {**(kwargs.get('extra_headers') or {}), **auth_headers(api_key)}
+        response = await client.chat.completions.create(**kwargs)
+        return response
+    except Exception as e:
+        print(f"Error in async_llm_proxy: {e}")
+        handle_llm_exception(e, kwargs.get('model'))
+
+async def async_embeddings_proxy(client: openai.AsyncOpenAI, api_key, **kwargs):
+    try:
+        kwargs['extra_headers'] = {**(kwargs.get('extra_headers') or {}), **auth_headers(api_key)}
+        return await client.embeddings.create(**kwargs)
+    except Exception as e:
+        print(f"Error in async_embeddings_proxy: {e}")
+        handle_llm_exception(e, kwargs.get('model'))
+
+async def passthrough_llm_proxy(http_client: httpx.AsyncClient, endpoint, api_key, **kwargs):
+    """
+    Open a streaming chat completion without the openai client, so the
+    SSE body can be forwarded as is. Returns the open upstream response
+    and the Langfuse generation that the usage is reported to. Like
+    async_llm_proxy this is a single attempt.
+    """
+    body = {k: v for k, v in kwargs.items() if k not in LANGFUSE_KWARGS}
+    try:
+        upstream_request = http_client.build_request(
+            "POST",
+            endpoint + "chat/completions",
+            json=body,
+            # the body is forwarded as is, so it must not be compressed
+            headers={**auth_headers(api_key), "Accept-Encoding": "identity"},
+        )
+        try:
+            response = await http_client.send(upstream_request, stream=True)
+        except httpx.TimeoutException as e:
+            raise openai.APITimeoutError(request=upstream_request) from e
+        except httpx.TransportError as e:
+            raise openai.APIConnectionError(request=upstream_request) from e
+        if response.status_code >= 400:
+            await response.aread()
+            await response.aclose()
+            raise _status_error(response)
+    except Exception as e:
+        print(f"Error in passthrough_llm_proxy: {e}")
+        handle_llm_exception(e, kwargs.get('model'))
+    trace = get_langfuse().trace(name="chat-generation", user_id=kwargs.get("user_id"))
+    generation = trace.generation(
+        name="chat-generation",
+        model=body.get("model"),
+        input=body.get("messages", body.get("prompt")),
+        model_parameters={k: v for k, v in body.items() if k in ("temperature", "top_p", "max_tokens", "seed")},
+    )
+    return response, generation
@@ -1,32 +1,180 @@
 import os
+import math
+import time
+import asyncio
+import inspect
+from functools import partial
 
 import logfire
 from contextlib import asynccontextmanager
 from sqlmodel import create_engine
 from typing import Annotated
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi import FastAPI, HTTPException, Depends, Request
+from fastapi import FastAPI, HTTPException, Depends, Request, UploadFile, Form
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from fastapi.responses import StreamingResponse
-from proxy.llm_proxy import llm_proxy, response_generator
+from fastapi.responses import FileResponse, PlainTextResponse, Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from proxy.llm_proxy import (
+    async_llm_proxy,
+    async_embeddings_proxy,
+    async_response_generator,
+    passthrough_llm_proxy,
+    passthrough_response_generator,
+    replay_stream,
+    guard_stream,
+    prefetch_stream,
+    FirstChunkTimeout,
+    estimate_prompt_tokens,
+)
 from proxy.config import get_settings
-from proxy.auth import get_profile_from_accesstoken, get_or_create_apikey, verify_token
-from proxy.provider import get_all_models
-from proxy.utils import get_statistics, get_ttl_hash
+from proxy.clients import ClientRegistry
+from proxy.metering import budget_meter
+from proxy.usage import usage_store
+from proxy.auth import async_verify_token, decode_apikey, encode_apikey, key_cache
+from proxy.shared import SharedState
+from proxy.profiles import ProfileResolver
+from proxy.provider import ModelRegistry
+from proxy.routing import Router, Target
+from proxy.breaker import BreakerRegistry, CircuitOpen
+from proxy.cache import RefreshAheadCache, ResponseCache, is_deterministic, response_cache_key
+from proxy.ratelimit import RateLimiter, RateLimitExceeded
+from proxy.admission import AdmissionController, AdmissionRejected, priority_for, PRIORITY_LOW
+from proxy.batches import BATCH_ENDPOINTS, BatchRunner, BatchStore, public
+from proxy.protocols import BatchCreateRequest
+from proxy.embeddings import EmbeddingBatcher, is_single_input
+from proxy.retry import Deadline, DeadlineExceeded, LatencyTracker, RetryPolicy
+from proxy import metrics
+from proxy.codec import EncodedJSONResponse
+from proxy import codec
+from proxy.utils import fetch_statistics
 
 engine = None
+clients = None
+model_registry = None
+router = None
+breakers = None
+rate_limiter = None
+admission = None
+# keeps fire-and-forget tasks referenced until they finish
+background_tasks = set()
+response_cache = ResponseCache()
+langfuse_statistics = None
+profiles = None
+batch_store = None
+batch_runner = None
+embedding_batcher = None
+# connection to the state server shared by the workers, None with one worker
+shared_state = None
 settings = get_settings()
 security = HTTPBearer()
+retry_policy = RetryPolicy(
+    max_tries=settings.retry_max_tries,
+    min_attempt_time=settings.retry_min_attempt_time,
+    hedge_quantile=settings.hedge_quantile,
+    hedge_min_delay=settings.hedge_min_delay,
+    latency=LatencyTracker(min_samples=settings.hedge_min_samples),
+)
 optional_security = HTTPBearer(auto_error=False)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global engine
+    global engine, clients, model_registry, router, breakers, rate_limiter, admission, langfuse_statistics, profiles, batch_store, batch_runner, embedding_batcher, shared_state
     engine = create_engine(
         settings.database_url,
         pool_pre_ping=True,
     )
+    clients = ClientRegistry.from_settings(settings)
+    key_cache.configure(
+        maxsize=settings.key_cache_size,
+        ttl=settings.key_cache_ttl,
+        negative_maxsize=settings.key_cache_size,
+        negative_ttl=settings.key_cache_negative_ttl,
+    )
+    metrics_task = None
+    if settings.state_socket:
+        shared_state = SharedState(settings.state_socket)
+        await shared_state.connect()
+        await key_cache.attach(shared_state, encode_apikey, decode_apikey)
+        shared_state.on_event(_on_shared_event)
+        metrics_task = asyncio.create_task(_push_metrics())
+    response_cache.configure(
+        maxsize=settings.response_cache_size,
+        ttl=settings.response_cache_ttl,
+    )
+    budget_meter.flush_interval = settings.metering_flush_interval
+    budget_meter.tokens_per_unit = settings.metering_tokens_per_unit
+    if settings.metering_enabled:
+        budget_meter.start(engine)
+    usage_store.flush_interval = settings.statistics_flush_interval
+    usage_store.retention_days = settings.statistics_retention_days
+    await usage_store.start(engine)
+    profiles = ProfileResolver(
+        settings,
+        cache_size=settings.profile_cache_size,
+        cache_ttl=settings.profile_cache_ttl,
+    )
+    profiles.start(clients.get_http(settings.auth0_domain))
+    batch_store = await run_in_threadpool(BatchStore, settings.batch_storage_dir)
+    batch_runner = BatchRunner(
+        batch_store,
+        _execute_batch_request,
+        max_concurrency=settings.batch_max_concurrency,
+        max_concurrency_per_model=settings.batch_max_concurrency_per_model,
+        max_inflight=settings.batch_max_inflight,
+        lease_ttl=settings.batch_lease_ttl,
+    )
+    # only one worker picks up the batches left over from a restart or
+    # by a worker that went away
+    if shared_state is None or await shared_state.call("claim", role="batches"):
+        batch_runner.watch()
+    embedding_batcher = EmbeddingBatcher(
+        _send_embeddings,
+        max_batch_size=settings.embeddings_max_batch_size,
+        max_wait=settings.embeddings_max_wait,
+    )
+    langfuse_statistics = RefreshAheadCache(
+        maxsize=settings.statistics_cache_size,
+        ttl=settings.statistics_cache_ttl,
+        stale_ttl=settings.statistics_stale_ttl,
+        timeout=settings.statistics_fetch_timeout,
+    )
+    model_registry = ModelRegistry(
+        settings.ocf_head_addr+"/v1/dnt/table",
+        refresh_interval=settings.model_registry_refresh_interval,
+        timeout=settings.model_registry_timeout,
+    )
+    model_registry.start(clients.get_http(settings.ocf_head_addr), shared_state)
+    metrics.models = model_registry
+    breakers = BreakerRegistry.from_settings(settings)
+    router = Router(
+        model_registry,
+        head_addr=settings.ocf_head_addr,
+        node_endpoint=settings.routing_node_endpoint,
+        mode=settings.routing_mode,
+        policy=settings.routing_policy,
+        prefix_messages=settings.routing_prefix_messages,
+        prefix_chars=settings.routing_prefix_chars,
+        prefix_load_factor=settings.routing_prefix_load_factor,
+        breakers=breakers,
+    )
+    rate_limiter = RateLimiter.from_settings(settings, shared_state)
+    admission = AdmissionController(
+        max_inflight=settings.admission_max_inflight,
+        max_queue=settings.admission_max_queue,
+        max_queue_time=settings.admission_max_queue_time,
+    )
     yield
+    await batch_runner.stop()
+    await profiles.stop()
+    await model_registry.stop()
+    await usage_store.stop()
+    await budget_meter.stop()
+    await clients.aclose()
+    if shared_state is not None:
+        metrics_task.cancel()
+        await shared_state.close()
+        shared_state = None
+    clients = None
     engine = None
 
 app = FastAPI(lifespan=lifespan)
@@ -43,20 +191,55 @@ if os.getenv("LOGFIRE_TOKEN", None):
     logfire.configure(token=os.getenv("LOGFIRE_TOKEN"))
     logfire.instrument_fastapi(app, capture_headers=True)
 
-@app.post("/v1/chat/completions")
-async def chat_completion(
-        request: Request, 
-        credentials: Annotated[HTTPAuthorizationCredentials, Depends(security)],
-    ):
-    token = credentials.credentials
-    
-    if not verify_token(engine, token):
+async def _authorize(token: str):
+    api_key = await async_verify_token(engine, token)
+    if not api_key or (settings.metering_enabled and budget_meter.is_exhausted(api_key)):
         raise HTTPException(
             status_code=401,
             detail="Invalid access token",
         )
-    
-    data = await request.json()
+    return api_key
+
+def _spawn(coro):
+    task = asyncio.ensure_future(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+def _record_usage(token: str, model: str, prompt_tokens: int, completion_tokens: int):
+    if settings.metering_enabled:
+        budget_meter.debit(token, prompt_tokens + completion_tokens)
+    _spawn(rate_limiter.record_tokens(token, model, prompt_tokens + completion_tokens))
+    usage_store.record(token, model, prompt_tokens, completion_tokens)
+    label = metrics.model_label(model)
+    metrics.TOKENS.inc(label, "prompt", amount=prompt_tokens)
+    metrics.TOKENS.inc(label, "completion", amount=completion_tokens)
+
+def _add_time(request: Request, name: str, seconds: float):
+    # per-request timings for the overhead metric, batch requests have no request
+    if request is not None:
+        setattr(request.state, name, getattr(request.state, name, 0.0) + seconds)
+
+async def _release_when_done(response, release):
+    # streaming responses hold on until the stream is over
+    if isinstance(response, StreamingResponse):
+        response.body_iterator = guard_stream(response.body_iterator, release)
+        return
+    result = release()
+    if inspect.isawaitable(result):
+        await result
+
+async def _read_json(request: Request) -> dict:
+    try:
+        data = codec.loads(await request.body())
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid JSON body")
+    if not isinstance(data, dict):
+        raise HTTPException(status_code=400, detail="JSON body must be an object")
+    return data
+
+async def _proxy_completion(request: Request, token: str, priority: int):
+    request.state.started = time.perf_counter()
+    data = await _read_json(request)
     data["user_id"] = token
     if 'stream' not in data:
         data['stream'] = False
@@ -65,72 +248,430 @@ async def chat_completion(
             data['stream'] = True # convert to boolean
     if data['stream']:
         data['stream_options'] = {"include_usage": True}
-    
-    response = llm_proxy(
-        endpoint=settings.ocf_head_addr+"/v1/service/llm/v1/",
-        api_key=token,
-        **data,
+
+    try:
+        lease = await rate_limiter.admit(token, data.get("model"))
+    except RateLimitExceeded as e:
+        raise HTTPException(status_code=429, detail=e.reason, headers=e.headers)
+
+    model = data.get("model")
+    label = metrics.model_label(model)
+    on_usage = partial(_record_usage, token, model)
+    try:
+        if settings.response_cache_enabled and is_deterministic(data):
+            response = await _cached_completion(request, token, data, on_usage, priority)
+        else:
+            response = await _routed_completion(request, token, data, on_usage, priority)
+    except BaseException:
+        metrics.REQUESTS.inc(label, "error")
+        await lease.release()
+        raise
+    elapsed = time.perf_counter() - request.state.started
+    metrics.OVERHEAD_SECONDS.observe(
+        label,
+        value=elapsed - getattr(request.state, "upstream_seconds", 0.0) - getattr(request.state, "queued_seconds", 0.0),
     )
-    if 'stream' in data and data['stream'] == True:
-        return StreamingResponse(response_generator(response, response.generation), media_type='text/event-stream')
+    # upstream streams are counted by their StreamTimer once they end
+    if not getattr(request.state, "stream_timer", False):
+        metrics.REQUESTS.inc(label, "ok")
+        metrics.REQUEST_SECONDS.observe(label, "ok", value=elapsed)
+    if not isinstance(response, Response):
+        response = EncodedJSONResponse(response.to_dict())
+    await _release_when_done(response, lease.release)
     return response
 
+async def _cached_completion(request: Request, token: str, data: dict, on_usage, priority: int):
+    # the upstream call is always non-streaming, stream clients get a replay
+    upstream_data = {k: v for k, v in data.items() if k != 'stream_options'}
+    upstream_data['stream'] = False
+
+    async def compute():
+        response = await _routed_completion(request, token, upstream_data, on_usage, priority)
+        return response.to_dict()
+
+    # only the caller that went upstream is debited, via on_usage
+    body, hit = await response_cache.get_or_compute(response_cache_key(data), compute)
+    headers = {"X-Cache": "HIT" if hit else "MISS"}
+    if data['stream'] == True:
+        return StreamingResponse(replay_stream(body), media_type='text/event-stream', headers=headers)
+    return EncodedJSONResponse(body, headers=headers)
+
+async def _routed_completion(request: Request, token: str, data: dict, on_usage, priority: int):
+    queued = time.perf_counter()
+    try:
+        release_slot = await admission.admit(data.get("model"), priority)
+        _add_time(request, "queued_seconds", time.perf_counter() - queued)
+    except AdmissionRejected as e:
+        raise HTTPException(
+            status_code=503,
+            detail=e.reason,
+            headers={"retry-after": str(e.retry_after)},
+        )
+    model = data.get("model")
+    deadline = _deadline(request)
+    failed = set()
+    failovers = 0
+    target = router.pick(model, data)
+    router.acquire(target)
+
+    def release():
+        router.release(target)
+        release_slot()
+
+    try:
+        while True:
+            try:
+                response = await _send_completion(request, target, token, data, on_usage, deadline)
+                break
+            except (CircuitOpen, FirstChunkTimeout) as e:
+                # nothing has been sent to the client, another upstream can take over
+                if isinstance(e, CircuitOpen) and target.node_id is None:
+                    raise
+                failed.add(target.node_id)
+                # the head (node_id None) can be picked again, count the attempts
+                failovers += 1
+                if failovers > settings.stream_failover_attempts:
+                    raise
+                router.release(target)
+                target = router.pick(model, data, exclude=failed)
+                router.acquire(target)
+    except CircuitOpen as e:
+        release()
+        raise HTTPException(
+            status_code=503,
+            detail=str(e),
+            headers={"retry-after": str(int(e.retry_after))},
+        )
+    except FirstChunkTimeout as e:
+        release()
+        raise HTTPException(status_code=504, detail=str(e))
+    except BaseException:
+        release()
+        raise
+    await _release_when_done(response, release)
+    return response
+
+def _deadline(request: Request) -> Deadline:
+    seconds = settings.request_deadline
+    header = request.headers.get("x-request-timeout") if request is not None else None
+    if header:
+        try:
+            seconds = float(header)
+        except ValueError:
+            seconds = math.nan
+        if not math.isfinite(seconds) or seconds <= 0:
+            raise HTTPException(status_code=400, detail="Invalid X-Request-Timeout header")
+        seconds = min(seconds, settings.request_deadline_max)
+    return Deadline(seconds)
+
+def _first_chunk_timeout(attempt, deadline: Deadline):
+    """
+    Bound a stream attempt, from opening the stream to its first chunk, by
+    stream_first_chunk_timeout. A deadline that ends sooner is left to the
+    retry policy.
+    """
+    timeout = settings.stream_first_chunk_timeout
+
+    async def timed():
+        if not timeout or deadline.remaining() <= timeout:
+            return await attempt()
+        try:
+            return await asyncio.wait_for(attempt(), timeout)
+        except asyncio.TimeoutError:
+            raise FirstChunkTimeout(f"No response from upstream within {timeout:.1f}s")
+    return timed
+
+async def _open_stream(request: Request, target: Target, token: str, data: dict, on_usage):
+    """
+    One stream attempt: open the upstream stream and wait for its first
+    chunk. Nothing is sent to the client before it returns.
+    """
+    model = data.get("model")
+    endpoint = target.endpoint
+    timer = metrics.StreamTimer(model, getattr(request.state, "started", None) if request is not None else None)
+    try:
+        if settings.stream_passthrough:
+            response, generation = await passthrough_llm_proxy(clients.get_http(endpoint), endpoint, api_key=token, **data)
+            body = passthrough_response_generator(response, generation, request, on_usage, timer, estimate_prompt_tokens(data))
+        else:
+            response = await async_llm_proxy(clients.get(endpoint), api_key=token, **data)
+            body = async_response_generator(response, response.generation, request, on_usage, timer, estimate_prompt_tokens(data))
+        return await prefetch_stream(body)
+    except BaseException:
+        # the stream never started, it won't finish either
+        timer.finish(0, "error")
+        raise
+
+async def _send_completion(request: Request, target: Target, token: str, data: dict, on_usage, deadline: Deadline):
+    model = data.get("model")
+    endpoint = target.endpoint
+    started = time.perf_counter()
+    stream = data['stream'] == True
+    try:
+        if stream:
+            if request is not None:
+                request.state.stream_timer = True
+            # one breaker outcome per attempt, recorded once the first chunk is in
+            body = await retry_policy.run(
+                breakers.guard(
+                    model,
+                    target.name,
+                    _first_chunk_timeout(partial(_open_stream, request, target, token, data, on_usage), deadline),
+                ),
+                model,
+                deadline,
+            )
+        else:
+            response = await retry_policy.run(
+                breakers.guard(
+                    model,
+                    target.name,
+                    partial(async_llm_proxy, clients.get(endpoint), api_key=token, **data),
+                ),
+                model,
+                deadline,
+                hedge=settings.hedge_enabled,
+            )
+    except DeadlineExceeded as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    finally:
+        upstream = time.perf_counter() - started
+        metrics.UPSTREAM_SECONDS.observe(metrics.model_label(model), value=upstream)
+        _add_time(request, "upstream_seconds", upstream)
+    if stream:
+        return StreamingResponse(body, media_type='text/event-stream')
+    if response.usage is not None:
+        on_usage(response.usage.prompt_tokens, response.usage.completion_tokens)
+        if response.usage.completion_tokens:
+            metrics.TOKENS_PER_SECOND.observe(metrics.model_label(model), value=response.usage.completion_tokens / upstream)
+    return response
+
+async def _execute_batch_request(token: str, body: dict):
+    await _authorize(token)
+    data = {**body, "user_id": token, "stream": False}
+    on_usage = partial(_record_usage, token, data.get("model"))
+    while True:
+        try:
+            response = await _routed_completion(None, token, data, on_usage, PRIORITY_LOW)
+        except HTTPException as e:
+            if e.status_code != 503:
+                raise
+            # shed in favour of interactive traffic, wait for capacity
+            await asyncio.sleep(settings.batch_retry_interval)
+            continue
+        return response.to_dict()
+
+async def _send_embeddings(token: str, model: str, options: dict, inputs, deadline: Deadline = None):
+    # batched inputs come from several requests, they get the default deadline
+    deadline = deadline or Deadline(settings.request_deadline)
+    target = router.pick(model)
+    router.acquire(target)
+    try:
+        response = await retry_policy.run(
+            breakers.guard(
+                model,
+                target.name,
+                partial(async_embeddings_proxy, clients.get(target.endpoint), api_key=token, model=model, input=inputs, **options),
+            ),
+            model,
+            deadline,
+        )
+    finally:
+        router.release(target)
+    return response.to_dict()
+
+@app.post("/v1/embeddings")
+async def create_embeddings(
+        request: Request,
+        credentials: Annotated[HTTPAuthorizationCredentials, Depends(security)],
+    ):
+    token = credentials.credentials
+    await _authorize(token)
+    data = await _read_json(request)
+    model, value = data.get("model"), data.get("input")
+    options = {k: v for k, v in data.items() if k not in ("model", "input", "user")}
+    try:
+        lease = await rate_limiter.admit(token, model)
+    except RateLimitExceeded as e:
+        raise HTTPException(status_code=429, detail=e.reason, headers=e.headers)
+    try:
+        if is_single_input(value):
+            embedding, prompt_tokens = await embedding_batcher.embed(token, model, options, value)
+            response = {
+                "object": "list",
+                "data": [{"object": "embedding", "index": 0, "embedding": embedding}],
+                "model": model,
+                "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens},
+            }
+        else:
+            response = await _send_embeddings(token, model, options, value, _deadline(request))
+    except CircuitOpen as e:
+        raise HTTPException(
+            status_code=503,
+            detail=str(e),
+            headers={"retry-after": str(int(e.retry_after))},
+        )
+    except DeadlineExceeded as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    finally:
+        await lease.release()
+    usage = response.get("usage") or {}
+    _record_usage(token, model, usage.get("prompt_tokens", 0), 0)
+    return EncodedJSONResponse(response)
+
+@app.post("/v1/chat/completions")
+async def chat_completion(
+        request: Request, 
+        credentials: Annotated[HTTPAuthorizationCredentials, Depends(security)],
+    ):
+    token = credentials.credentials
+    api_key = await _authorize(token)
+    return await _proxy_completion(request, token, priority_for(api_key))
+
 @app.post("/v1/completions")
 async def completion(
         request: Request, 
         credentials: Annotated[HTTPAuthorizationCredentials, Depends(security)],
     ):
     token = credentials.credentials
-    
-    if not verify_token(engine, token):
-        raise HTTPException(
-            status_code=401,
-            detail="Invalid access token",
-        )
-    data = await request.json()
-    data["user_id"] = token
-    if 'stream' not in data:
-        data['stream'] = False
-    if type(data['stream']) == str:
-        if data['stream'].lower() == "true":
-            data['stream'] = True
-    if data['stream']:
-        data['stream_options'] = {"include_usage": True}
-    
-    response = llm_proxy(
-        endpoint=settings.ocf_head_addr+"/v1/service/llm/v1/",
-        api_key=token,
-        **data,
-    )
-    if 'stream' in data and data['stream'] == True:
-        return StreamingResponse(response_generator(response, response.generation), media_type='text/event-stream')
-    return response
+    api_key = await _authorize(token)
+    return await _proxy_completion(request, token, priority_for(api_key))
+
+@app.post("/v1/files")
+async def upload_file(
+        credentials: Annotated[HTTPAuthorizationCredentials, Depends(security)],
+        file: UploadFile,
+        purpose: Annotated[str, Form()],
+    ):
+    token = credentials.credentials
+    await _authorize(token)
+    if purpose != "batch":
+        raise HTTPException(status_code=400, detail="Only files with purpose 'batch' are supported")
+    # file I/O runs in the threadpool, uploads can be large
+    stored = await run_in_threadpool(batch_store.create_file, token, file.filename, purpose)
+    size = 0
+    f = await run_in_threadpool(open, batch_store.content_path(stored["id"]), "wb")
+    try:
+        try:
+            while chunk := await file.read(1 << 20):
+                size += len(chunk)
+                if size > settings.batch_max_file_bytes:
+                    raise HTTPException(status_code=413, detail="File too large")
+                await run_in_threadpool(f.write, chunk)
+        finally:
+            await run_in_threadpool(f.close)
+    except BaseException:
+        # no partial uploads are left behind
+        await run_in_threadpool(batch_store.delete_file, stored["id"])
+        raise
+    stored["bytes"] = size
+    await run_in_threadpool(batch_store.save_file, stored)
+    return public(stored)
+
+@app.get("/v1/files/{file_id}")
+async def get_file(
+        file_id: str,
+        credentials: Annotated[HTTPAuthorizationCredentials, Depends(security)],
+    ):
+    file = await run_in_threadpool(batch_store.get_file, file_id, credentials.credentials)
+    if file is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    return public(file)
+
+@app.get("/v1/files/{file_id}/content")
+async def get_file_content(
+        file_id: str,
+        credentials: Annotated[HTTPAuthorizationCredentials, Depends(security)],
+    ):
+    file = await run_in_threadpool(batch_store.get_file, file_id, credentials.credentials)
+    if file is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    return FileResponse(batch_store.content_path(file["id"]), media_type="application/jsonl")
+
+@app.post("/v1/batches")
+async def create_batch(
+        body: BatchCreateRequest,
+        credentials: Annotated[HTTPAuthorizationCredentials, Depends(security)],
+    ):
+    token = credentials.credentials
+    await _authorize(token)
+    if body.endpoint not in BATCH_ENDPOINTS:
+        raise HTTPException(status_code=400, detail=f"Unsupported endpoint {body.endpoint}")
+    if body.completion_window != "24h":
+        raise HTTPException(status_code=400, detail="Only a 24h completion window is supported")
+    if await run_in_threadpool(batch_store.get_file, body.input_file_id, token) is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    batch = await batch_runner.create(token, body.input_file_id, body.endpoint, body.completion_window, body.metadata)
+    return public(batch)
+
+@app.get("/v1/batches")
+async def list_batches(credentials: Annotated[HTTPAuthorizationCredentials, Depends(security)]):
+    batches = [public(batch) for batch in await batch_runner.list(credentials.credentials)]
+    return dict(object="list", data=batches, has_more=False)
+
+@app.get("/v1/batches/{batch_id}")
+async def get_batch(
+        batch_id: str,
+        credentials: Annotated[HTTPAuthorizationCredentials, Depends(security)],
+    ):
+    batch = await batch_runner.get(batch_id, credentials.credentials)
+    if batch is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    return public(batch)
+
+@app.post("/v1/batches/{batch_id}/cancel")
+async def cancel_batch(
+        batch_id: str,
+        credentials: Annotated[HTTPAuthorizationCredentials, Depends(security)],
+    ):
+    batch = await batch_runner.get(batch_id, credentials.credentials)
+    if batch is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    return public(await batch_runner.cancel(batch))
 
 @app.get("/v1/models_detailed")
 async def list_models_detailed():
-    models = get_all_models(settings.ocf_head_addr+"/v1/dnt/table", with_details=True)
-    return dict(
-        object="list",
-        data=models,
-    )
+    return EncodedJSONResponse(await model_registry.get_models_json(with_details=True))
 
 @app.get("/v1/models")
 async def list_models():
-    models = get_all_models(settings.ocf_head_addr+"/v1/dnt/table", with_details=False)
-    return dict(
-        object="list",
-        data=models,
-    )
+    return EncodedJSONResponse(await model_registry.get_models_json(with_details=False))
+
+@app.get("/v1/models_status")
+async def models_status():
+    return model_registry.status()
+
+@app.get("/v1/admin/breakers")
+async def breaker_status(credentials: Annotated[HTTPAuthorizationCredentials, Depends(security)]):
+    if not settings.admin_api_key:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if credentials.credentials != settings.admin_api_key:
+        raise HTTPException(status_code=403, detail="Forbidden")
+    return breakers.status()
+
+def _on_shared_event(event: dict):
+    if event.get("event") == "metrics_request":
+        shared_state.send("metrics_push", worker=os.getpid(), snapshot=metrics.snapshot())
+
+async def _push_metrics():
+    while True:
+        try:
+            await shared_state.call("metrics_push", worker=os.getpid(), snapshot=metrics.snapshot())
+        except Exception as e:
+            print(f"Error pushing metrics: {e}")
+        await asyncio.sleep(settings.metrics_push_interval)
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    if shared_state is None:
+        return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+    # every worker's metrics, collected by the state server
+    return PlainTextResponse(await shared_state.call("metrics_render"), media_type="text/plain; version=0.0.4")
 
 @app.get("/v1/profile")
 async def get_profile(credentials: Annotated[HTTPAuthorizationCredentials, Depends(security)] = None):
     try:
-        user_profile = get_profile_from_accesstoken(credentials.credentials)
-        if user_profile:
-            api_key = get_or_create_apikey(engine, user_profile['email'])
-        user_profile['api_key'] = api_key.key
-        user_profile['budget'] = api_key.budget
-        return user_profile
+        return await profiles.resolve(engine, credentials.credentials)
     except Exception as e:
         return HTTPException(
             status_code=401,
@@ -148,9 +689,34 @@ async def get_statistics_endpoint(
         api_key = credentials.credentials
     else:
         api_key = None
-    stats = get_statistics(api_key, ttl_hash=get_ttl_hash())
-    return stats
+    if settings.statistics_source == "langfuse":
+        try:
+            return EncodedJSONResponse(await langfuse_statistics.get(
+                api_key,
+                partial(fetch_statistics, clients.get_http(settings.langfuse_host), settings.langfuse_host, api_key),
+            ))
+        except Exception as e:
+            print(f"Error fetching statistics: {e}")
+            return {"data": []}
+    if shared_state is not None:
+        # each worker only has its own usage in memory
+        return EncodedJSONResponse(await usage_store.stored_statistics(api_key))
+    return EncodedJSONResponse(usage_store.statistics(api_key))
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8080)
\ No newline at end of file
+    if settings.workers > 1:
+        import multiprocessing
+        from proxy.shared import serve
+        # the workers are new processes that read the socket path from the environment
+        socket_path = settings.state_socket or f"/tmp/fm-proxy-{os.getpid()}.sock"
+        os.environ["STATE_SOCKET"] = socket_path
+        state_server = multiprocessing.Process(
+            target=serve,
+            args=(socket_path, settings.metrics_stale_after),
+            daemon=True,
+        )
+        state_server.start()
+        uvicorn.run("proxy.main:app", host="0.0.0.0", port=8080, workers=settings.workers)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8080)
\ No newline at end of file
@@ -0,0 +1,81 @@
+import asyncio
+from datetime import datetime
+from sqlalchemy import bindparam, update
+from starlette.concurrency import run_in_threadpool
+from proxy.auth import APIKey, key_cache
+
+class BudgetMeter:
+    """
+    Write-behind token metering against APIKey.budget.
+
+    Debits are summed in memory and written to the database in one batched
+    UPDATE per flush interval. One unit of budget is `tokens_per_unit`
+    tokens, leftover tokens are carried to the next flush.
+    """
+    def __init__(self, flush_interval: float = 10.0, tokens_per_unit: int = 1000):
+        self.flush_interval = flush_interval
+        self.tokens_per_unit = tokens_per_unit
+        self.pending = {}
+        self._engine = None
+        self._task = None
+
+    def debit(self, key: str, tokens: int):
+        if tokens > 0:
+            self.pending[key] = self.pending.get(key, 0) + tokens
+
+    def remaining(self, api_key: APIKey) -> float:
+        return api_key.budget - self.pending.get(api_key.key, 0) / self.tokens_per_unit
+
+    def is_exhausted(self, api_key: APIKey) -> bool:
+        return self.remaining(api_key) <= 0
+
+    def _write(self, batch):
+        stmt = (
+            update(APIKey)
+            .where(APIKey.key == bindparam("_key"))
+            .values(budget=APIKey.budget - bindparam("_units"), updated_at=bindparam("_now"))
+        )
+        with self._engine.begin() as conn:
+            conn.execute(stmt, batch)
+
+    async def flush(self):
+        now = datetime.now()
+        batch = [
+            {"_key": key, "_units": tokens // self.tokens_per_unit, "_now": now}
+            for key, tokens in self.pending.items()
+            if tokens >= self.tokens_per_unit
+        ]
+        if not batch:
+            return
+        await run_in_threadpool(self._write, batch)
+        # the cached APIKey budgets are stale from here on, drop them
+        # together with the flushed debits so nothing is counted twice
+        for row in batch:
+            key = row["_key"]
+            self.pending[key] -= row["_units"] * self.tokens_per_unit
+            if self.pending[key] == 0:
+                del self.pending[key]
+            key_cache.invalidate(key)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Error flushing budgets: {e}")
+
+    def start(self, engine):
+        self._engine = engine
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            print(f"Error flushing budgets: {e}")
+
+budget_meter = BudgetMeter()
@@ -0,0 +1,300 @@
+"""
+Minimal in-process metrics, rendered in the Prometheus text format on
+/metrics. Label values are passed positionally in `labelnames` order.
+"""
+import time
+from bisect import bisect_left
+
+REGISTRY = []
+# the ModelRegistry, model label values come from clients and anything it
+# doesn't serve is counted as OTHER_MODEL, so no request adds a label value
+models = None
+OTHER_MODEL = "other"
+
+def model_label(model) -> str:
+    if models is None:
+        return model if isinstance(model, str) else str(model or "")
+    return model if isinstance(model, str) and model in models.index else OTHER_MODEL
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        if registry is not None:
+            registry.append(self)
+
+    def samples(self):
+        for labelvalues, value in self.values.items():
+            yield self.name, _format_labels(self.labelnames, labelvalues), value
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{labels} {value}")
+        return "\n".join(lines)
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labelvalues, amount=1):
+        self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    # how the workers' values are combined, "sum" or "max"
+    def __init__(self, name: str, documentation: str, labelnames=(), registry=REGISTRY, aggregate: str = "sum"):
+        super().__init__(name, documentation, labelnames, registry)
+        self.aggregate = aggregate
+
+    def set(self, *labelvalues, value):
+        self.values[labelvalues] = value
+
+    def inc(self, *labelvalues, amount=1):
+        self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+    def dec(self, *labelvalues, amount=1):
+        self.values[labelvalues] = self.values.get(labelvalues, 0) - amount
+
+class Histogram(Metric):
+    kind = "histogram"
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, *labelvalues, value):
+        # [per-bucket counts..., sum, count], buckets are not cumulative here
+        state = self.values.get(labelvalues)
+        if state is None:
+            state = self.values[labelvalues] = [0] * (len(self.buckets) + 2)
+        i = bisect_left(self.buckets, value)
+        if i < len(self.buckets):
+            state[i] += 1
+        state[-2] += value
+        state[-1] += 1
+
+    def samples(self):
+        for labelvalues, state in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                yield f"{self.name}_bucket", _format_labels(self.labelnames, labelvalues, [("le", bound)]), cumulative
+            yield f"{self.name}_bucket", _format_labels(self.labelnames, labelvalues, [("le", "+Inf")]), state[-1]
+            yield f"{self.name}_sum", _format_labels(self.labelnames, labelvalues), state[-2]
+            yield f"{self.name}_count", _format_labels(self.labelnames, labelvalues), state[-1]
+
+def render(registry=REGISTRY) -> str:
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+def snapshot(registry=REGISTRY) -> list:
+    """This process's metrics as plain JSON types, to be merged with other workers'."""
+    return [
+        {
+            "kind": metric.kind,
+            "name": metric.name,
+            "documentation": metric.documentation,
+            "labelnames": metric.labelnames,
+            "buckets": getattr(metric, "buckets", None),
+            "aggregate": getattr(metric, "aggregate", "sum"),
+            "values": [[labelvalues, value] for labelvalues, value in metric.values.items()],
+        }
+        for metric in registry
+    ]
+
+def merge(snapshots: list, live: list = None) -> str:
+    """
+    Render the snapshots of several workers as one. Counters and histograms
+    are summed; gauges are summed (or maxed) over live workers only, since
+    a worker that stopped reporting holds no streams or slots anymore.
+    """
+    registry, merged = [], {}
+    for i, snapshot in enumerate(snapshots):
+        for entry in snapshot:
+            metric = merged.get(entry["name"])
+            if metric is None:
+                if entry["kind"] == "histogram":
+                    metric = Histogram(entry["name"], entry["documentation"], entry["labelnames"], entry["buckets"], registry=registry)
+                elif entry["kind"] == "gauge":
+                    metric = Gauge(entry["name"], entry["documentation"], entry["labelnames"], registry=registry, aggregate=entry["aggregate"])
+                else:
+                    metric = Counter(entry["name"], entry["documentation"], entry["labelnames"], registry=registry)
+                merged[entry["name"]] = metric
+            if metric.kind == "gauge" and live is not None and not live[i]:
+                continue
+            for labelvalues, value in entry["values"]:
+                labelvalues = tuple(labelvalues)
+                current = metric.values.get(labelvalues)
+                if current is None:
+                    metric.values[labelvalues] = value
+                elif metric.kind == "histogram":
+                    metric.values[labelvalues] = [a + b for a, b in zip(current, value)]
+                elif metric.kind == "gauge" and metric.aggregate == "max":
+                    metric.values[labelvalues] = max(current, value)
+                else:
+                    metric.values[labelvalues] = current + value
+    return render(registry)
+
+ROUTING_AFFINITY = Counter(
+    "proxy_routing_affinity_total",
+    "Prefix-affinity routing decisions, hit when the preferred replica was used.",
+    ("model", "result"),
+)
+
+ADMISSION_QUEUE_DEPTH = Gauge(
+    "proxy_admission_queue_depth",
+    "Requests waiting for an upstream slot.",
+    ("model",),
+)
+ADMISSION_INFLIGHT = Gauge(
+    "proxy_admission_inflight",
+    "Admitted requests holding an upstream slot.",
+    ("model",),
+)
+ADMISSION_WAIT_SECONDS = Histogram(
+    "proxy_admission_wait_seconds",
+    "Time spent queued before admission.",
+    ("model", "priority"),
+)
+ADMISSION_SHED = Counter(
+    "proxy_admission_shed_total",
+    "Requests rejected by admission control.",
+    ("model", "reason"),
+)
+EMBEDDING_BATCH_SIZE = Histogram(
+    "proxy_embeddings_batch_size",
+    "Inputs per upstream embeddings request.",
+    ("model",),
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256),
+)
+UPSTREAM_RETRIES = Counter(
+    "proxy_upstream_retries_total",
+    "Upstream attempts retried, by retry class.",
+    ("model", "reason"),
+)
+UPSTREAM_HEDGES = Counter(
+    "proxy_upstream_hedges_total",
+    "Hedged upstream requests sent, and won by the hedge.",
+    ("model", "result"),
+)
+CIRCUIT_STATE = Gauge(
+    "proxy_circuit_state",
+    "Circuit breaker state per upstream: 0 closed, 1 half-open, 2 open.",
+    ("model", "target"),
+    aggregate="max",
+)
+CACHE_LOOKUPS = Counter(
+    "proxy_cache_lookups_total",
+    "Key, response and profile cache lookups, by result.",
+    ("cache", "result"),
+)
+
+REQUESTS = Counter(
+    "proxy_requests_total",
+    "Completion requests by outcome.",
+    ("model", "status"),
+)
+REQUEST_SECONDS = Histogram(
+    "proxy_request_duration_seconds",
+    "Time from receiving a completion request to its last byte.",
+    ("model", "status"),
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600),
+)
+TIME_TO_FIRST_TOKEN = Histogram(
+    "proxy_time_to_first_token_seconds",
+    "Time from receiving a streaming request to its first chunk.",
+    ("model",),
+)
+INTER_TOKEN_LATENCY = Histogram(
+    "proxy_inter_token_latency_seconds",
+    "Time between consecutive chunks of a stream.",
+    ("model",),
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+TOKENS_PER_SECOND = Histogram(
+    "proxy_tokens_per_second",
+    "Completion tokens per second of generation, per request.",
+    ("model",),
+    buckets=(1, 5, 10, 25, 50, 100, 200, 400, 800, 1600),
+)
+TOKENS = Counter(
+    "proxy_tokens_total",
+    "Tokens processed, by kind (prompt or completion).",
+    ("model", "kind"),
+)
+STREAMS_INFLIGHT = Gauge(
+    "proxy_streams_inflight",
+    "Streaming responses currently open.",
+    ("model",),
+)
+UPSTREAM_ERRORS = Counter(
+    "proxy_upstream_errors_total",
+    "Failed upstream attempts, by exception class.",
+    ("model", "exception"),
+)
+UPSTREAM_SECONDS = Histogram(
+    "proxy_upstream_seconds",
+    "Time waiting on upstream: to the response, or to the first chunk of a stream.",
+    ("model",),
+)
+OVERHEAD_SECONDS = Histogram(
+    "proxy_overhead_seconds",
+    "Time spent in the proxy before the response, excluding upstream and queueing.",
+    ("model",),
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5),
+)
+
+class StreamTimer:
+    """
+    Times one upstream stream: TTFT from `started`, the gap between chunks,
+    and tokens per second once it ends. Streams that never produced a chunk
+    (abandoned before anything reached the client) are not counted as
+    requests.
+    """
+    __slots__ = ("model", "started", "first", "last", "done")
+
+    def __init__(self, model: str, started: float = None):
+        self.model = model_label(model)
+        self.started = time.perf_counter() if started is None else started
+        self.first = None
+        self.last = None
+        self.done = False
+        STREAMS_INFLIGHT.inc(self.model)
+
+    def chunk(self):
+        now = time.perf_counter()
+        if self.first is None:
+            self.first = now
+            TIME_TO_FIRST_TOKEN.observe(self.model, value=now - self.started)
+        else:
+            INTER_TOKEN_LATENCY.observe(self.model, value=now - self.last)
+        self.last = now
+
+    def finish(self, completion_tokens: int, status: str):
+        if self.done:
+            return
+        self.done = True
+        STREAMS_INFLIGHT.dec(self.model)
+        if self.first is None:
+            return
+        REQUESTS.inc(self.model, status)
+        REQUEST_SECONDS.observe(self.model, status, value=time.perf_counter() - self.started)
+        if completion_tokens and self.last > self.first:
+            TOKENS_PER_SECOND.observe(self.model, value=completion_tokens / (self.last - self.first))
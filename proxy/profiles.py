@@ -0,0 +1,132 @@
+import time
+import asyncio
+import hashlib
+import httpx
+import jwt
+from starlette.concurrency import run_in_threadpool
+from proxy.auth import get_or_create_apikey
+from proxy.cache import ResponseCache
+
+def _base_url(domain: str) -> str:
+    domain = domain.rstrip("/")
+    return domain if domain.startswith("http") else f"https://{domain}"
+
+class JWKSCache:
+    """
+    Signing keys of the Auth0 tenant, refreshed in the background and on
+    an unknown `kid` (at most once per `min_refresh_interval`).
+    """
+    def __init__(self, url: str, refresh_interval: float = 3600, min_refresh_interval: float = 60):
+        self.url = url
+        self.refresh_interval = refresh_interval
+        self.min_refresh_interval = min_refresh_interval
+        self.keys = {}
+        self.last_refresh = 0.0
+        self._http_client = None
+        self._task = None
+
+    async def refresh(self):
+        self.last_refresh = time.monotonic()
+        response = await self._http_client.get(self.url)
+        response.raise_for_status()
+        jwks = jwt.PyJWKSet.from_dict(response.json())
+        self.keys = {key.key_id: key for key in jwks.keys}
+
+    async def get_key(self, kid: str):
+        key = self.keys.get(kid)
+        if key is None and time.monotonic() - self.last_refresh > self.min_refresh_interval:
+            await self.refresh()
+            key = self.keys.get(kid)
+        if key is None:
+            raise jwt.InvalidKeyError(f"Unknown signing key {kid}")
+        return key
+
+    async def _run(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                print(f"Error refreshing JWKS: {e}")
+            await asyncio.sleep(self.refresh_interval)
+
+    def start(self, http_client: httpx.AsyncClient):
+        self._http_client = http_client
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+class ProfileResolver:
+    """
+    Resolves an Auth0 access token to the user profile and API key.
+
+    JWT access tokens are verified locally against the cached JWKS and the
+    profile is cached by subject. Only a cache miss (or a token that is not
+    a JWT) calls /userinfo, and it does so asynchronously.
+    """
+    def __init__(self, settings, cache_size: int = 10000, cache_ttl: int = 300):
+        self.audience = settings.auth0_api_audience
+        self.issuer = settings.auth0_issuer
+        self.algorithms = [a.strip() for a in settings.auth0_algorithms.split(",") if a.strip()]
+        self.userinfo_url = _base_url(settings.auth0_domain) + "/userinfo"
+        self.jwks = JWKSCache(_base_url(settings.auth0_domain) + "/.well-known/jwks.json")
+        self.profiles = ResponseCache(maxsize=cache_size, ttl=cache_ttl, name="profiles")
+        self._http_client = None
+
+    async def verify(self, access_token: str):
+        """
+        Returns the verified claims, or None when the token is not a JWT
+        signed with one of our algorithms (e.g. an opaque token).
+        """
+        try:
+            header = jwt.get_unverified_header(access_token)
+        except jwt.DecodeError:
+            return None
+        if header.get("alg") not in self.algorithms:
+            return None
+        key = await self.jwks.get_key(header.get("kid"))
+        return jwt.decode(
+            access_token,
+            key.key,
+            algorithms=self.algorithms,
+            audience=self.audience,
+            issuer=self.issuer,
+        )
+
+    async def _userinfo(self, access_token: str) -> dict:
+        res = await self._http_client.get(
+            self.userinfo_url,
+            headers={
+                "Accept": "application/json",
+                "Authorization": f"Bearer {access_token}",
+            },
+        )
+        if res.status_code != 200:
+            print(f"Invalid access token: {res.status_code} {res.text}")
+            raise Exception(f"Invalid access token: {res.status_code} {res.text}")
+        return res.json()
+
+    async def resolve(self, engine, access_token: str) -> dict:
+        claims = await self.verify(access_token)
+        if claims is not None:
+            cache_key = f"sub:{claims['sub']}"
+        else:
+            cache_key = "token:" + hashlib.sha256(access_token.encode()).hexdigest()
+
+        async def compute():
+            profile = await self._userinfo(access_token)
+            api_key = await run_in_threadpool(get_or_create_apikey, engine, profile['email'])
+            return {**profile, 'api_key': api_key.key, 'budget': api_key.budget}
+
+        profile, _ = await self.profiles.get_or_compute(cache_key, compute)
+        # callers may add to it, keep the cached copy intact
+        return dict(profile)
+
+    def start(self, http_client: httpx.AsyncClient):
+        self._http_client = http_client
+        self.jwks.start(http_client)
+
+    async def stop(self):
+        await self.jwks.stop()
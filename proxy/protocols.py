@@ -456,13 +456,100 @@ class ModelResponse(OpenAIObject):
             # if using pydantic v1
             return self.dict()
         
+class _CompactObject:
+    """
+    Plain-dict backed stand-in for ModelResponse on the hot path: no
+    validation, no nested objects and no generated ids. Fields read like
+    the pydantic classes (attribute, item or .get access) and the full
+    ModelResponse is only built when to_model() is called.
+    """
+    __slots__ = ("data", "_model")
+    _stream = False
+
+    def __init__(self, data: dict):
+        self.data = data
+        self._model = None
+
+    def __getattr__(self, key):
+        try:
+            return self.data[key]
+        except KeyError:
+            raise AttributeError(key) from None
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def to_dict(self) -> dict:
+        return self.data
+
+    def to_model(self) -> ModelResponse:
+        if self._model is None:
+            self._model = ModelResponse(stream=self._stream, **self.data)
+        return self._model
+
+class CompactChunk(_CompactObject):
+    """A chat.completion.chunk, see _CompactObject."""
+    __slots__ = ()
+    _stream = True
+
+    @classmethod
+    def delta(cls, id, created, model, delta: dict, index=0, finish_reason=None):
+        return cls({
+            "id": id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [{"index": index, "delta": delta, "finish_reason": finish_reason}],
+        })
+
+    @classmethod
+    def usage_only(cls, id, created, model, usage: dict):
+        return cls({
+            "id": id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [],
+            "usage": usage,
+        })
+
+class CompactResponse(_CompactObject):
+    """A chat.completion, see _CompactObject."""
+    __slots__ = ()
+
+    def chunks(self):
+        """The response as the chunks a streaming request would have received."""
+        data = self.data
+        id, created, model = data.get("id"), data.get("created"), data.get("model")
+        for choice in data.get("choices", []):
+            message = choice.get("message") or {}
+            index = choice.get("index", 0)
+            yield CompactChunk.delta(id, created, model, {k: v for k, v in message.items() if v is not None}, index)
+            yield CompactChunk.delta(id, created, model, {}, index, choice.get("finish_reason"))
+        if data.get("usage") is not None:
+            yield CompactChunk.usage_only(id, created, model, data["usage"])
+
 class RetryConstantError(Exception):
     pass
 class RetryExpoError(Exception):
     pass
 class UnknownLLMError(Exception):
     pass
+class FirstChunkTimeout(Exception):
+    pass
 
 class ProviderKeySubmission(BaseModel):
     provider: str
     api_key: str
+
+class BatchCreateRequest(BaseModel):
+    input_file_id: str
+    endpoint: str
+    completion_window: str = "24h"
+    metadata: Optional[Dict[str, str]] = None
@@ -1,11 +1,13 @@
+import time
+import asyncio
+import httpx
 import requests
 from proxy.config import parse_hardware_info
+from proxy import codec
 
-def get_all_models(endpoint: str, with_details: bool=False):
-    available_models = []
-    data = requests.get(endpoint).json()
-    models = []
-    for node_info in data.values():
+def _iter_serving_nodes(data: dict):
+    # yields (model, node) for every model served by a node of the DNT table
+    for node_id, node_info in data.items():
         if not node_info.get('service'):
             continue
         device_info = parse_hardware_info(node_info.get("hardware"))
@@ -13,20 +15,136 @@ def get_all_models(endpoint: str, with_details: bool=False):
             if not service.get('identity_group'):
                 continue
             model_names = [identity[len('model='):] for identity in service['identity_group'] if identity.startswith('model=')]
-            # Add each model to the list
-            if with_details:
-                models.extend({
-                    'id': model_name, 
+            for model_name in model_names:
+                yield model_name, {
+                    'node_id': node_info.get('id', node_id),
                     'device': device_info,
-                    'object': 'model',
-                    'created': '0x',
-                    'owner': '0x',
-                    } for model_name in model_names)
-            else:
-                models.extend({
-                    'id': model_name,
-                    'object': 'model',
-                    'created': '0x',
-                    'owner': '0x',
-                } for model_name in model_names)
-    return models
\ No newline at end of file
+                    'node': node_info,
+                    'service': service,
+                }
+
+def _model_entry(model_name: str, node: dict, with_details: bool):
+    if with_details:
+        return {
+            'id': model_name, 
+            'device': node['device'],
+            'object': 'model',
+            'created': '0x',
+            'owner': '0x',
+        }
+    return {
+        'id': model_name,
+        'object': 'model',
+        'created': '0x',
+        'owner': '0x',
+    }
+
+def get_all_models(endpoint: str, with_details: bool=False):
+    data = requests.get(endpoint).json()
+    return [
+        _model_entry(model_name, node, with_details)
+        for model_name, node in _iter_serving_nodes(data)
+    ]
+
+class ModelRegistry:
+    """
+    In-process view of the DNT table, refreshed in the background.
+
+    Readers always get the last good snapshot (stale-while-revalidate),
+    only the very first read waits for the table to be fetched. With a
+    shared state server the table is fetched there, once for all workers.
+    """
+    def __init__(self, endpoint: str, refresh_interval: float = 15.0, timeout: float = 5.0):
+        self.endpoint = endpoint
+        self.refresh_interval = refresh_interval
+        self.timeout = timeout
+        # model -> nodes serving it
+        self.index = {}
+        self.models = []
+        self.models_detailed = []
+        # the /v1/models bodies, encoded once per refresh
+        self.encoded = {}
+        self.last_refresh = None
+        self.last_error = None
+        self._http_client = None
+        self.shared = None
+        self._inflight = None
+        self._task = None
+
+    def load(self, data: dict):
+        index, models, models_detailed = {}, [], []
+        for model_name, node in _iter_serving_nodes(data):
+            index.setdefault(model_name, []).append(node)
+            models.append(_model_entry(model_name, node, with_details=False))
+            models_detailed.append(_model_entry(model_name, node, with_details=True))
+        # swap the whole snapshot at once so readers never see a partial one
+        self.index, self.models, self.models_detailed = index, models, models_detailed
+        self.encoded = {
+            False: codec.dumps({"object": "list", "data": models}),
+            True: codec.dumps({"object": "list", "data": models_detailed}),
+        }
+        self.last_refresh = time.monotonic()
+        self.last_error = None
+
+    async def _fetch(self):
+        try:
+            if self.shared is not None:
+                self.load(await self.shared.call(
+                    "model_table",
+                    endpoint=self.endpoint,
+                    max_age=self.refresh_interval,
+                    timeout=self.timeout,
+                ))
+                return
+            response = await self._http_client.get(self.endpoint, timeout=self.timeout)
+            response.raise_for_status()
+            self.load(response.json())
+        except Exception as e:
+            print(f"Error refreshing model registry: {e}")
+            self.last_error = f"{type(e).__name__}: {e}"
+        finally:
+            self._inflight = None
+
+    async def refresh(self):
+        # concurrent callers share one fetch
+        if self._inflight is None:
+            self._inflight = asyncio.ensure_future(self._fetch())
+        await asyncio.shield(self._inflight)
+
+    async def _run(self):
+        while True:
+            await self.refresh()
+            await asyncio.sleep(self.refresh_interval)
+
+    async def ensure_loaded(self):
+        if self.last_refresh is None:
+            await self.refresh()
+
+    async def get_models(self, with_details: bool = False):
+        await self.ensure_loaded()
+        return self.models_detailed if with_details else self.models
+
+    async def get_models_json(self, with_details: bool = False) -> bytes:
+        await self.ensure_loaded()
+        return self.encoded.get(with_details, b'{"object":"list","data":[]}')
+
+    def nodes_for(self, model: str):
+        return self.index.get(model, [])
+
+    def status(self) -> dict:
+        return {
+            "last_refresh_age": None if self.last_refresh is None else time.monotonic() - self.last_refresh,
+            "last_error": self.last_error,
+            "models": len(self.index),
+            "nodes": len({node['node_id'] for nodes in self.index.values() for node in nodes}),
+        }
+
+    def start(self, http_client: httpx.AsyncClient, shared=None):
+        self._http_client = http_client
+        self.shared = shared
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
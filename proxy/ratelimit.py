@@ -0,0 +1,225 @@
+import math
+import time
+from typing import Optional
+from cachetools import TTLCache
+
+try:
+    import redis.asyncio as redis
+except ImportError:
+    redis = None
+
+class RateLimitExceeded(Exception):
+    def __init__(self, reason: str, retry_after: float, headers: dict):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+        self.headers = headers
+
+class LocalBackend:
+    """
+    In-process token buckets and concurrency counters. Limits only hold
+    per process, use it for a single replica and in tests.
+    """
+    def __init__(self, maxsize=100000, ttl=3600):
+        self.buckets = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.slots = {}
+
+    async def take(self, key: str, rate: float, capacity: float, amount: float, force: bool = False):
+        now = time.monotonic()
+        tokens, last = self.buckets.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - last) * rate)
+        allowed = force or tokens >= amount
+        if allowed:
+            tokens -= amount
+        self.buckets[key] = (tokens, now)
+        return allowed, tokens
+
+    async def acquire(self, key: str, limit: int) -> bool:
+        count = self.slots.get(key, 0)
+        if count >= limit:
+            return False
+        self.slots[key] = count + 1
+        return True
+
+    async def release(self, key: str):
+        count = self.slots.get(key, 0) - 1
+        if count > 0:
+            self.slots[key] = count
+        else:
+            self.slots.pop(key, None)
+
+class SharedBackend:
+    """
+    Token buckets and concurrency counters held by the shared state server,
+    so the limits hold across the workers of one host. Slots of a worker
+    that goes away are released by the server.
+    """
+    def __init__(self, shared):
+        self.shared = shared
+
+    async def take(self, key: str, rate: float, capacity: float, amount: float, force: bool = False):
+        allowed, tokens = await self.shared.call("rl_take", key=key, rate=rate, capacity=capacity, amount=amount, force=force)
+        return allowed, tokens
+
+    async def acquire(self, key: str, limit: int) -> bool:
+        return await self.shared.call("rl_acquire", key=key, limit=limit)
+
+    async def release(self, key: str):
+        await self.shared.call("rl_release", key=key)
+
+# KEYS[1] bucket, ARGV rate, capacity, amount, now, force
+_TAKE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local amount = tonumber(ARGV[3])
+local now = tonumber(ARGV[4])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local last = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - last) * rate)
+local allowed = 0
+if ARGV[5] == '1' or tokens >= amount then
+    tokens = tokens - amount
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+return {allowed, tostring(tokens)}
+"""
+
+class RedisBackend:
+    """
+    Token buckets shared by every replica through Redis. The bucket update
+    runs as one Lua script so concurrent replicas can't race on it.
+    """
+    def __init__(self, url: str, prefix: str = "fm:ratelimit:", slot_ttl: int = 3600):
+        if redis is None:
+            raise RuntimeError("rate_limit_backend=redis requires the `redis` package, see proxy/requirements.txt")
+        self.client = redis.from_url(url)
+        self.prefix = prefix
+        self.slot_ttl = slot_ttl
+        self._take = self.client.register_script(_TAKE_SCRIPT)
+
+    async def take(self, key: str, rate: float, capacity: float, amount: float, force: bool = False):
+        allowed, tokens = await self._take(
+            keys=[self.prefix + key],
+            args=[rate, capacity, amount, time.time(), "1" if force else "0"],
+        )
+        return bool(allowed), float(tokens)
+
+    async def acquire(self, key: str, limit: int) -> bool:
+        key = self.prefix + "slots:" + key
+        count = await self.client.incr(key)
+        # a crashed replica can't leak slots forever
+        await self.client.expire(key, self.slot_ttl)
+        if count > limit:
+            await self.client.decr(key)
+            return False
+        return True
+
+    async def release(self, key: str):
+        await self.client.decr(self.prefix + "slots:" + key)
+
+class Lease:
+    def __init__(self, limiter: "RateLimiter", slots: list):
+        self.limiter = limiter
+        self.slots = slots
+
+    async def release(self):
+        slots, self.slots = self.slots, []
+        for slot in slots:
+            await self.limiter.backend.release(slot)
+
+class RateLimiter:
+    """
+    Per-key and per-key-and-model limits on requests per second, tokens per
+    minute and concurrent requests. A limit of 0 disables it.
+
+    Tokens are only known once a response is done, so a request is admitted
+    while the token bucket is positive and its usage is debited afterwards.
+    """
+    def __init__(
+        self,
+        backend,
+        requests_per_second: float = 0,
+        tokens_per_minute: float = 0,
+        max_concurrent: int = 0,
+        model_requests_per_second: float = 0,
+        model_tokens_per_minute: float = 0,
+        model_max_concurrent: int = 0,
+    ):
+        self.backend = backend
+        self.limits = {
+            "key": (requests_per_second, tokens_per_minute, max_concurrent),
+            "model": (model_requests_per_second, model_tokens_per_minute, model_max_concurrent),
+        }
+
+    @classmethod
+    def from_settings(cls, settings, shared=None):
+        if settings.rate_limit_backend == "redis":
+            backend = RedisBackend(settings.rate_limit_redis_url)
+        elif shared is not None:
+            # "local" limits are per host when the workers share state
+            backend = SharedBackend(shared)
+        else:
+            backend = LocalBackend()
+        return cls(
+            backend,
+            requests_per_second=settings.rate_limit_requests_per_second,
+            tokens_per_minute=settings.rate_limit_tokens_per_minute,
+            max_concurrent=settings.rate_limit_max_concurrent,
+            model_requests_per_second=settings.rate_limit_model_requests_per_second,
+            model_tokens_per_minute=settings.rate_limit_model_tokens_per_minute,
+            model_max_concurrent=settings.rate_limit_model_max_concurrent,
+        )
+
+    def _scopes(self, key: str, model: Optional[str]):
+        yield "key", f"key:{key}"
+        yield "model", f"key:{key}:model:{model}"
+
+    async def admit(self, key: str, model: Optional[str]) -> Lease:
+        lease = Lease(self, [])
+        try:
+            for scope, name in self._scopes(key, model):
+                rps, tpm, concurrent = self.limits[scope]
+                if concurrent:
+                    if not await self.backend.acquire(name, concurrent):
+                        raise RateLimitExceeded(
+                            f"Too many concurrent requests ({concurrent})",
+                            retry_after=1,
+                            headers={"x-ratelimit-limit-concurrent": str(concurrent)},
+                        )
+                    lease.slots.append(name)
+                if rps:
+                    allowed, remaining = await self.backend.take(f"{name}:rps", rps, rps, 1)
+                    if not allowed:
+                        raise RateLimitExceeded(
+                            f"Request rate limit reached ({rps}/s)",
+                            retry_after=(1 - remaining) / rps,
+                            headers={
+                                "x-ratelimit-limit-requests": str(rps),
+                                "x-ratelimit-remaining-requests": "0",
+                            },
+                        )
+                if tpm:
+                    _, remaining = await self.backend.take(f"{name}:tpm", tpm / 60, tpm, 0)
+                    if remaining <= 0:
+                        raise RateLimitExceeded(
+                            f"Token rate limit reached ({tpm}/min)",
+                            retry_after=(1 - remaining) / (tpm / 60),
+                            headers={
+                                "x-ratelimit-limit-tokens": str(tpm),
+                                "x-ratelimit-remaining-tokens": "0",
+                            },
+                        )
+        except RateLimitExceeded as e:
+            await lease.release()
+            e.headers["retry-after"] = str(max(1, math.ceil(e.retry_after)))
+            raise
+        return lease
+
+    async def record_tokens(self, key: str, model: Optional[str], tokens: int):
+        for scope, name in self._scopes(key, model):
+            tpm = self.limits[scope][1]
+            if tpm:
+                await self.backend.take(f"{name}:tpm", tpm / 60, tpm, tokens, force=True)
@@ -0,0 +1,133 @@
+import time
+import random
+import asyncio
+from collections import deque
+from proxy.protocols import RetryConstantError, RetryExpoError
+from proxy.metrics import UPSTREAM_HEDGES, UPSTREAM_RETRIES, model_label
+
+class DeadlineExceeded(Exception):
+    pass
+
+class Deadline:
+    def __init__(self, seconds: float):
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return self.expires_at - time.monotonic()
+
+class LatencyTracker:
+    """
+    Recent successful upstream latencies per model, for the hedge delay.
+    """
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.window = window
+        self.min_samples = min_samples
+        self.samples = {}
+        self._quantiles = {}
+
+    def observe(self, model: str, seconds: float):
+        samples = self.samples.get(model)
+        if samples is None:
+            samples = self.samples[model] = deque(maxlen=self.window)
+        samples.append(seconds)
+        self._quantiles.pop(model, None)
+
+    def quantile(self, model: str, q: float):
+        cached = self._quantiles.get(model, {})
+        if q in cached:
+            return cached[q]
+        samples = self.samples.get(model)
+        if samples is None or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        value = ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+        self._quantiles.setdefault(model, {})[q] = value
+        return value
+
+class RetryPolicy:
+    """
+    Retries an upstream attempt within a per-request deadline.
+
+    RetryConstantError waits `constant_interval`, RetryExpoError backs off
+    exponentially with full jitter. A retry is only made if at least
+    `min_attempt_time` of the deadline is left after waiting. Non-streaming
+    attempts can be hedged: if the first attempt is slower than the model's
+    recent p95, a duplicate is sent and the slower one is cancelled. Only
+    hedged attempts are timed, a stream attempt returns at its headers and
+    would make the p95 far too short for complete responses.
+    """
+    def __init__(
+        self,
+        max_tries: int = 3,
+        constant_interval: float = 3,
+        expo_factor: float = 1.5,
+        expo_max: float = 100,
+        min_attempt_time: float = 1.0,
+        hedge_quantile: float = 0.95,
+        hedge_min_delay: float = 0.5,
+        latency: LatencyTracker = None,
+    ):
+        self.max_tries = max_tries
+        self.constant_interval = constant_interval
+        self.expo_factor = expo_factor
+        self.expo_max = expo_max
+        self.min_attempt_time = min_attempt_time
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_delay = hedge_min_delay
+        self.latency = latency or LatencyTracker()
+
+    def _wait(self, error: Exception, tries: int) -> float:
+        if isinstance(error, RetryExpoError):
+            return random.uniform(0, min(self.expo_max, self.expo_factor * 2 ** (tries - 1)))
+        return self.constant_interval
+
+    async def _hedged(self, attempt, model: str):
+        first = asyncio.ensure_future(attempt())
+        delay = self.latency.quantile(model, self.hedge_quantile)
+        if delay is None:
+            return await first
+        try:
+            done, _ = await asyncio.wait({first}, timeout=max(delay, self.hedge_min_delay))
+        except BaseException:
+            # cancelled by the deadline, the attempt must not keep running upstream
+            first.cancel()
+            raise
+        if done:
+            return first.result()
+        UPSTREAM_HEDGES.inc(model_label(model), "sent")
+        second = asyncio.ensure_future(attempt())
+        pending = {first, second}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            UPSTREAM_HEDGES.inc(model_label(model), "won")
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def run(self, attempt, model: str, deadline: Deadline, hedge: bool = False):
+        tries = 0
+        while True:
+            tries += 1
+            start = time.monotonic()
+            try:
+                call = self._hedged(attempt, model) if hedge else attempt()
+                result = await asyncio.wait_for(call, max(0, deadline.remaining()))
+                if hedge:
+                    self.latency.observe(model, time.monotonic() - start)
+                return result
+            except asyncio.TimeoutError:
+                raise DeadlineExceeded("Upstream did not answer within the request deadline")
+            except (RetryConstantError, RetryExpoError) as e:
+                wait = self._wait(e, tries)
+                if tries >= self.max_tries or deadline.remaining() - wait < self.min_attempt_time:
+                    raise
+                UPSTREAM_RETRIES.inc(model_label(model), type(e).__name__)
+                await asyncio.sleep(wait)
@@ -0,0 +1,124 @@
+import json
+import random
+import hashlib
+from typing import NamedTuple, Optional
+from proxy.provider import ModelRegistry
+from proxy.metrics import ROUTING_AFFINITY, model_label
+
+class Target(NamedTuple):
+    endpoint: str
+    # None when the request goes through the OCF head
+    node_id: Optional[str] = None
+
+    @property
+    def name(self) -> str:
+        return self.node_id or "head"
+
+def prefix_key(data: dict, max_messages: int = 1, max_chars: int = 4096) -> Optional[str]:
+    """
+    Normalized prefix of a request: the system prompt plus the first
+    `max_messages` other messages, cut at `max_chars`. Later turns of a
+    conversation share it, so they land on the replica holding its KV cache.
+    """
+    messages = data.get("messages")
+    if not messages:
+        prompt = data.get("prompt")
+        return prompt[:max_chars] if isinstance(prompt, str) and prompt else None
+    system = [m for m in messages if m.get("role") == "system"]
+    rest = [m for m in messages if m.get("role") != "system"][:max_messages]
+    prefix = json.dumps(
+        [[m.get("role"), m.get("content")] for m in system + rest],
+        separators=(",", ":"),
+        default=str,
+    )
+    return prefix[:max_chars]
+
+def _score(key: str, node_id: str) -> int:
+    digest = hashlib.blake2b(f"{key}|{node_id}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+class Router:
+    """
+    Picks the upstream for a request.
+
+    In "head" mode everything goes to the OCF head, which does its own
+    routing. In "direct" mode a node serving the model is picked from the
+    model registry, balanced on the requests this proxy has in flight.
+    The "prefix" policy sends equal prompt prefixes to the same replica
+    (rendezvous hashing) unless it is over its load bound. Nodes whose
+    circuit breaker is open are skipped.
+    """
+    def __init__(
+        self,
+        registry: ModelRegistry,
+        head_addr: str,
+        node_endpoint: str,
+        mode: str = "head",
+        policy: str = "p2c",
+        prefix_messages: int = 1,
+        prefix_chars: int = 4096,
+        prefix_load_factor: float = 1.25,
+        breakers=None,
+    ):
+        self.registry = registry
+        self.head_addr = head_addr
+        self.head = Target(head_addr + "/v1/service/llm/v1/")
+        self.node_endpoint = node_endpoint
+        self.mode = mode
+        self.policy = policy
+        self.prefix_messages = prefix_messages
+        self.prefix_chars = prefix_chars
+        self.prefix_load_factor = prefix_load_factor
+        self.breakers = breakers
+        self.inflight = {}
+
+    def _target(self, node: dict) -> Target:
+        endpoint = self.node_endpoint.format(
+            head=self.head_addr,
+            node_id=node['node_id'],
+            address=node['node'].get('public_address', ''),
+        )
+        return Target(endpoint, node['node_id'])
+
+    def _load(self, node: dict) -> int:
+        return self.inflight.get(node['node_id'], 0)
+
+    def _pick_prefix(self, model: str, nodes: list, key: str) -> dict:
+        ranked = sorted(nodes, key=lambda node: _score(key, node['node_id']), reverse=True)
+        # bounded load: no replica takes more than its share times the factor
+        total = sum(self._load(node) for node in nodes) + 1
+        bound = max(1, self.prefix_load_factor * total / len(nodes))
+        for rank, node in enumerate(ranked):
+            if self._load(node) + 1 <= bound:
+                ROUTING_AFFINITY.inc(model_label(model), "hit" if rank == 0 else "spill")
+                return node
+        ROUTING_AFFINITY.inc(model_label(model), "spill")
+        return min(nodes, key=self._load)
+
+    def pick(self, model: str, data: dict = None, exclude=()) -> Target:
+        if self.mode != "direct":
+            return self.head
+        nodes = [node for node in self.registry.nodes_for(model) if node['node_id'] not in exclude]
+        if self.breakers is not None:
+            nodes = [node for node in nodes if self.breakers.available(model, node['node_id'])]
+        if not nodes:
+            return self.head
+        key = None
+        if self.policy == "prefix" and data is not None:
+            key = prefix_key(data, self.prefix_messages, self.prefix_chars)
+        if len(nodes) == 1:
+            node = nodes[0]
+        elif key is not None:
+            node = self._pick_prefix(model, nodes, key)
+        elif self.policy == "least":
+            node = min(nodes, key=self._load)
+        else:
+            # power of two choices
+            node = min(random.sample(nodes, 2), key=self._load)
+        return self._target(node)
+
+    def acquire(self, target: Target):
+        self.inflight[target.node_id] = self.inflight.get(target.node_id, 0) + 1
+
+    def release(self, target: Target):
+        self.inflight[target.node_id] -= 1
@@ -0,0 +1,286 @@
+"""
+State shared by the workers of one host, served over a local Unix socket.
+
+With several workers every per-process cache diverges: hit rates drop and
+an invalidation only reaches the worker it happened in. The StateServer
+holds the shared part (the key cache, rate-limit buckets and concurrency
+slots, the DNT table, and each worker's metrics) and broadcasts key
+invalidations. Workers talk to it with a SharedState client.
+
+The messages are newline-delimited JSON. Requests carry an id and get a
+response with the same id; requests without an id are fire-and-forget, so
+they can be sent from sync code and other threads.
+
+    python -m proxy.shared    # for gunicorn, uvicorn --workers starts it itself
+"""
+import os
+import time
+import asyncio
+from collections import Counter
+from cachetools import TTLCache
+import httpx
+from proxy import codec, metrics
+from proxy.ratelimit import LocalBackend
+
+class SharedStateError(Exception):
+    pass
+
+class StateServer:
+    def __init__(self, path: str, metrics_stale_after: float = 30.0):
+        self.path = path
+        self.metrics_stale_after = metrics_stale_after
+        self.caches = {}
+        self.buckets = LocalBackend()
+        self.subscribers = set()
+        self.roles = {}
+        # endpoint -> (fetched at, table), and the fetches in flight
+        self.tables = {}
+        self._table_fetches = {}
+        # worker -> (pushed at, metrics snapshot)
+        self.snapshots = {}
+        self._metrics_pushed = asyncio.Condition()
+        self._http_client = None
+        self._server = None
+
+    # each op gets the connection state and the message fields
+
+    def op_cache_configure(self, conn, ns, maxsize, ttl):
+        if ns not in self.caches:
+            self.caches[ns] = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def op_cache_get(self, conn, ns, key):
+        return self.caches[ns].get(key)
+
+    def op_cache_set(self, conn, ns, key, value):
+        self.caches[ns][key] = value
+
+    def op_invalidate(self, conn, ns, key):
+        for name in (ns if isinstance(ns, list) else [ns]):
+            self.caches[name].pop(key, None)
+        self._broadcast({"event": "invalidate", "ns": ns, "key": key})
+
+    def _broadcast(self, event: dict):
+        data = codec.dumps(event) + b"\n"
+        for writer in self.subscribers:
+            writer.write(data)
+
+    def op_subscribe(self, conn):
+        self.subscribers.add(conn["writer"])
+
+    async def op_rl_take(self, conn, key, rate, capacity, amount, force=False):
+        return await self.buckets.take(key, rate, capacity, amount, force)
+
+    async def op_rl_acquire(self, conn, key, limit):
+        allowed = await self.buckets.acquire(key, limit)
+        if allowed:
+            conn["slots"][key] += 1
+        return allowed
+
+    async def op_rl_release(self, conn, key):
+        if conn["slots"][key] > 0:
+            conn["slots"][key] -= 1
+            await self.buckets.release(key)
+
+    def op_claim(self, conn, role):
+        # held until the claiming worker disconnects
+        if role in self.roles:
+            return self.roles[role] is conn
+        self.roles[role] = conn
+        return True
+
+    async def _fetch_table(self, endpoint, timeout):
+        try:
+            response = await self._http_client.get(endpoint, timeout=timeout)
+            response.raise_for_status()
+            self.tables[endpoint] = (time.monotonic(), response.json())
+        finally:
+            del self._table_fetches[endpoint]
+
+    async def op_model_table(self, conn, endpoint, max_age, timeout):
+        fetched_at, table = self.tables.get(endpoint, (None, None))
+        if fetched_at is None or time.monotonic() - fetched_at >= max_age:
+            # one fetch for all workers
+            if endpoint not in self._table_fetches:
+                self._table_fetches[endpoint] = asyncio.ensure_future(self._fetch_table(endpoint, timeout))
+            try:
+                await asyncio.shield(self._table_fetches[endpoint])
+            except Exception:
+                if table is None:
+                    raise
+                # the last good table is better than none
+                return table
+            table = self.tables[endpoint][1]
+        return table
+
+    async def op_metrics_push(self, conn, worker, snapshot):
+        self.snapshots[worker] = (time.monotonic(), snapshot)
+        async with self._metrics_pushed:
+            self._metrics_pushed.notify_all()
+
+    async def op_metrics_render(self, conn, wait: float = 0.5):
+        # ask every live worker for fresh metrics, and wait a little for them
+        asked = time.monotonic()
+        live = [w for w, (pushed_at, _) in self.snapshots.items() if asked - pushed_at < self.metrics_stale_after]
+        self._broadcast({"event": "metrics_request"})
+        async with self._metrics_pushed:
+            while any(self.snapshots[w][0] < asked for w in live):
+                remaining = asked + wait - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(self._metrics_pushed.wait(), remaining)
+                except asyncio.TimeoutError:
+                    break
+        now = time.monotonic()
+        return metrics.merge(
+            [snapshot for _, snapshot in self.snapshots.values()],
+            live=[now - pushed_at < self.metrics_stale_after for pushed_at, _ in self.snapshots.values()],
+        )
+
+    async def _handle(self, conn, message):
+        id = message.pop("id", None)
+        try:
+            result = getattr(self, "op_" + message.pop("op"))(conn, **message)
+            if asyncio.iscoroutine(result):
+                result = await result
+            response = {"id": id, "result": result}
+        except Exception as e:
+            print(f"Error in shared state op: {e}")
+            response = {"id": id, "error": f"{type(e).__name__}: {e}"}
+        if id is not None:
+            conn["writer"].write(codec.dumps(response) + b"\n")
+
+    async def _serve_connection(self, reader, writer):
+        conn = {"writer": writer, "slots": Counter()}
+        tasks = set()
+        try:
+            while line := await reader.readline():
+                task = asyncio.ensure_future(self._handle(conn, codec.loads(line)))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.subscribers.discard(writer)
+            self.roles = {role: owner for role, owner in self.roles.items() if owner is not conn}
+            for key, count in conn["slots"].items():
+                for _ in range(count):
+                    await self.buckets.release(key)
+            writer.close()
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._http_client = httpx.AsyncClient()
+        self._server = await asyncio.start_unix_server(self._serve_connection, path=self.path, limit=2**24)
+
+    async def serve_forever(self):
+        await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        if self._http_client is not None:
+            await self._http_client.aclose()
+
+def serve(path: str, metrics_stale_after: float = 30.0):
+    asyncio.run(StateServer(path, metrics_stale_after).serve_forever())
+
+class SharedState:
+    """
+    A worker's connection to the StateServer. `call` waits for the result,
+    `send` is fire-and-forget and safe to use from any thread.
+    """
+    def __init__(self, path: str, timeout: float = 5.0):
+        self.path = path
+        self.timeout = timeout
+        self.handlers = []
+        self._next_id = 0
+        self._pending = {}
+        self._writer = None
+        self._events_writer = None
+        self._loop = None
+        self._tasks = []
+
+    async def connect(self, retry_for: float = 10.0):
+        # the server may still be starting next to the workers
+        deadline = time.monotonic() + retry_for
+        while True:
+            try:
+                reader, self._writer = await asyncio.open_unix_connection(self.path, limit=2**24)
+                events, self._events_writer = await asyncio.open_unix_connection(self.path, limit=2**24)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.monotonic() >= deadline:
+                    raise
+                await asyncio.sleep(0.1)
+        self._loop = asyncio.get_running_loop()
+        self._events_writer.write(codec.dumps({"op": "subscribe"}) + b"\n")
+        self._tasks = [
+            asyncio.create_task(self._read_responses(reader)),
+            asyncio.create_task(self._read_events(events)),
+        ]
+
+    async def _read_responses(self, reader):
+        while line := await reader.readline():
+            message = codec.loads(line)
+            future = self._pending.pop(message["id"], None)
+            if future is None or future.done():
+                continue
+            if "error" in message:
+                future.set_exception(SharedStateError(message["error"]))
+            else:
+                future.set_result(message["result"])
+        for future in self._pending.values():
+            future.set_exception(SharedStateError("Connection to the shared state server closed"))
+        self._pending.clear()
+
+    async def _read_events(self, reader):
+        while line := await reader.readline():
+            event = codec.loads(line)
+            for handler in self.handlers:
+                try:
+                    handler(event)
+                except Exception as e:
+                    print(f"Error handling shared state event: {e}")
+
+    def on_event(self, handler):
+        self.handlers.append(handler)
+
+    async def call(self, op: str, **args):
+        self._next_id += 1
+        id = self._next_id
+        future = self._loop.create_future()
+        self._pending[id] = future
+        self._writer.write(codec.dumps({"id": id, "op": op, **args}) + b"\n")
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        finally:
+            self._pending.pop(id, None)
+
+    def send(self, op: str, **args):
+        data = codec.dumps({"op": op, **args}) + b"\n"
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            self._writer.write(data)
+        else:
+            self._loop.call_soon_threadsafe(self._writer.write, data)
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        for writer in (self._writer, self._events_writer):
+            if writer is not None:
+                writer.close()
+
+if __name__ == "__main__":
+    from proxy.config import get_settings
+
+    settings = get_settings()
+    serve(settings.state_socket or "/tmp/fm-proxy.sock", settings.metrics_stale_after)
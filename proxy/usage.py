@@ -0,0 +1,219 @@
+import asyncio
+from datetime import date, timedelta
+from typing import Optional
+from functools import partial
+from sqlmodel import SQLModel, Field, Session, select
+from sqlalchemy import func
+from sqlalchemy.dialects import postgresql, sqlite
+from starlette.concurrency import run_in_threadpool
+from proxy.cache import RefreshAheadCache
+
+class UsageRollup(SQLModel, table=True):
+    day: date = Field(primary_key=True)
+    model: str = Field(primary_key=True)
+    key: str = Field(primary_key=True)
+    requests: int = Field(default=0)
+    prompt_tokens: int = Field(default=0)
+    completion_tokens: int = Field(default=0)
+
+def _insert(engine):
+    if engine.dialect.name == "postgresql":
+        return postgresql.insert
+    if engine.dialect.name == "sqlite":
+        return sqlite.insert
+    raise NotImplementedError(f"Usage rollups are not supported on {engine.dialect.name}")
+
+def _render(rows: dict) -> dict:
+    """
+    Usage in the StatisticsResponse shape of the home app, newest day first.
+    """
+    days = {}
+    for (day, model), (requests, prompt_tokens, completion_tokens) in rows.items():
+        days.setdefault(day, []).append({
+            "model": model,
+            "inputUsage": prompt_tokens,
+            "outputUsage": completion_tokens,
+            "totalUsage": prompt_tokens + completion_tokens,
+            "totalCost": 0,
+            "countObservations": requests,
+            "countTraces": requests,
+        })
+    return {"data": [
+        {
+            "date": day.isoformat(),
+            "countTraces": sum(usage["countTraces"] for usage in days[day]),
+            "countObservations": sum(usage["countObservations"] for usage in days[day]),
+            "totalCost": 0,
+            "usage": days[day],
+        }
+        for day in sorted(days, reverse=True)
+    ]}
+
+class UsageStore:
+    """
+    Daily usage rollups per model and key, aggregated from the usage the
+    proxy sees. The retention window lives in memory and serves
+    /v1/statistics. Increments are upserted to the database on an interval.
+
+    With several workers each one only sees its own requests, so
+    /v1/statistics is served from the database instead (stored_statistics),
+    lagging by up to a flush interval.
+    """
+    def __init__(self, flush_interval: float = 30.0, retention_days: int = 90):
+        self.flush_interval = flush_interval
+        self.retention_days = retention_days
+        # key -> {(day, model): [requests, prompt_tokens, completion_tokens]}
+        self.by_key = {}
+        # {(day, model): [requests, prompt_tokens, completion_tokens]}
+        self.totals = {}
+        # (day, model, key) -> increments not written yet
+        self.pending = {}
+        # rendered responses, dropped when the underlying rollups change
+        self._views = {}
+        self._today = None
+        self._stored_views = None
+        self._engine = None
+        self._task = None
+
+    def _add(self, day: date, model: str, key: str, counts):
+        for table in (self.by_key.setdefault(key, {}), self.totals):
+            row = table.get((day, model))
+            if row is None:
+                table[(day, model)] = list(counts)
+            else:
+                for i, count in enumerate(counts):
+                    row[i] += count
+        self._views.pop(key, None)
+        self._views.pop(None, None)
+
+    def _roll(self, today: date):
+        # drop the days that left the retention window once the date changes
+        if today == self._today:
+            return
+        self._today = today
+        since = today - timedelta(days=self.retention_days)
+        for table in [self.totals, *self.by_key.values()]:
+            for day, model in [k for k in table if k[0] < since]:
+                del table[(day, model)]
+        self.by_key = {key: rows for key, rows in self.by_key.items() if rows}
+        self._views.clear()
+
+    def record(self, key: str, model: Optional[str], prompt_tokens: int, completion_tokens: int):
+        day = date.today()
+        self._roll(day)
+        model = model or "unknown"
+        counts = (1, prompt_tokens, completion_tokens)
+        self._add(day, model, key, counts)
+        row = self.pending.get((day, model, key))
+        if row is None:
+            self.pending[(day, model, key)] = list(counts)
+        else:
+            for i, count in enumerate(counts):
+                row[i] += count
+
+    def statistics(self, key: Optional[str] = None) -> dict:
+        """Usage of `key`, or of all keys, from the in-memory rollups."""
+        self._roll(date.today())
+        view = self._views.get(key)
+        if view is not None:
+            return view
+        if key is not None and key not in self.by_key:
+            # any bearer string ends up here, only keys with usage are cached
+            return {"data": []}
+        view = self._views[key] = _render(self.totals if key is None else self.by_key[key])
+        return view
+
+    def _query(self, key: Optional[str]) -> dict:
+        since = date.today() - timedelta(days=self.retention_days)
+        stmt = select(
+            UsageRollup.day,
+            UsageRollup.model,
+            func.sum(UsageRollup.requests),
+            func.sum(UsageRollup.prompt_tokens),
+            func.sum(UsageRollup.completion_tokens),
+        ).where(UsageRollup.day >= since)
+        if key is not None:
+            stmt = stmt.where(UsageRollup.key == key)
+        stmt = stmt.group_by(UsageRollup.day, UsageRollup.model)
+        with Session(self._engine) as session:
+            return {(day, model): counts for day, model, *counts in session.exec(stmt)}
+
+    async def _load_view(self, key: Optional[str]) -> dict:
+        return _render(await run_in_threadpool(self._query, key))
+
+    async def stored_statistics(self, key: Optional[str] = None) -> dict:
+        """
+        Like statistics, from the rollups all workers write to the database.
+        """
+        return await self._stored_views.get(key, partial(self._load_view, key))
+
+    def _load(self):
+        SQLModel.metadata.create_all(self._engine, tables=[UsageRollup.__table__])
+        since = date.today() - timedelta(days=self.retention_days)
+        with Session(self._engine) as session:
+            return session.exec(select(UsageRollup).where(UsageRollup.day >= since)).all()
+
+    def _write(self, rows):
+        insert = _insert(self._engine)
+        stmt = insert(UsageRollup).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["day", "model", "key"],
+            set_={
+                "requests": UsageRollup.requests + stmt.excluded.requests,
+                "prompt_tokens": UsageRollup.prompt_tokens + stmt.excluded.prompt_tokens,
+                "completion_tokens": UsageRollup.completion_tokens + stmt.excluded.completion_tokens,
+            },
+        )
+        with self._engine.begin() as conn:
+            conn.execute(stmt)
+
+    async def flush(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        rows = [
+            {
+                "day": day,
+                "model": model,
+                "key": key,
+                "requests": requests,
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+            }
+            for (day, model, key), (requests, prompt_tokens, completion_tokens) in pending.items()
+        ]
+        try:
+            await run_in_threadpool(self._write, rows)
+        except Exception:
+            # put the increments back for the next attempt
+            for (day, model, key), counts in pending.items():
+                row = self.pending.setdefault((day, model, key), [0, 0, 0])
+                for i, count in enumerate(counts):
+                    row[i] += count
+            raise
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Error flushing usage rollups: {e}")
+
+    async def start(self, engine):
+        self._engine = engine
+        self._stored_views = RefreshAheadCache(ttl=self.flush_interval)
+        for rollup in await run_in_threadpool(self._load):
+            self._add(rollup.day, rollup.model, rollup.key, (rollup.requests, rollup.prompt_tokens, rollup.completion_tokens))
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            print(f"Error flushing usage rollups: {e}")
+
+usage_store = UsageStore()
@@ -1,4 +1,5 @@
 import os
+import httpx
 import requests
 from typing import Optional
 from functools import lru_cache
@@ -7,7 +8,7 @@ import time
 base_endpoint = "https://cloud.langfuse.com/api/public/metrics/daily"
 
 
-@lru_cache()
+@lru_cache(maxsize=1024)
 def get_statistics(api_key: Optional[str] = None, ttl_hash=None):
     # Parse request body for api_key
     lf_endpoint = base_endpoint
@@ -16,6 +17,7 @@ def get_statistics(api_key: Optional[str] = None, ttl_hash=None):
     # Basic authentication credentials
     username = os.getenv("LANGFUSE_PUBLIC_KEY")
     password = os.getenv("LANGFUSE_SECRET_KEY")
+    data = {"data": []}
     try:
         # Make API request with basic authentication
         response = requests.get(lf_endpoint, auth=(username, password))
@@ -33,6 +35,16 @@ def get_statistics(api_key: Optional[str] = None, ttl_hash=None):
         print(f"Error: {err}")
     return data
 
+async def fetch_statistics(http_client: httpx.AsyncClient, host: str, api_key: Optional[str] = None):
+    params = {"userId": api_key} if api_key is not None else None
+    response = await http_client.get(
+        host.rstrip("/") + "/api/public/metrics/daily",
+        params=params,
+        auth=(os.getenv("LANGFUSE_PUBLIC_KEY"), os.getenv("LANGFUSE_SECRET_KEY")),
+    )
+    response.raise_for_status()
+    return response.json()
+
 def get_ttl_hash(seconds=24 * 3600):
     """Return the same value withing `seconds` time period"""
     return round(time.time() / seconds)
\ No newline at end of file
@@ -0,0 +1,29 @@
+import os
+import importlib
+import pytest
+
+# the settings proxy.main reads on import, placeholders where .env has none
+SETTINGS = {
+    "AUTH0_DOMAIN": "example.auth0.com",
+    "AUTH0_API_AUDIENCE": "audience",
+    "AUTH0_ISSUER": "https://example.auth0.com/",
+    "AUTH0_ALGORITHMS": "RS256",
+    "AUTH0_CLIENT_ID": "client",
+    "AUTH0_CLIENT_SECRET": "secret",
+    "LOGFIRE_TOKEN": "",
+    "DATABASE_URL": "sqlite://",
+    "AUTH_SECRET": "secret",
+    "OCF_HEAD_ADDR": "http://127.0.0.1:9",
+    "LANGFUSE_HOST": "http://127.0.0.1:9",
+    "LANGFUSE_PUBLIC_KEY": "pk",
+    "LANGFUSE_SECRET_KEY": "sk",
+    "VITE_AUTH0_CLIENT_ID": "client",
+    "VITE_AUTH0_DOMAIN": "example.auth0.com",
+}
+
+@pytest.fixture
+def main(monkeypatch):
+    for name, value in SETTINGS.items():
+        if name not in os.environ:
+            monkeypatch.setenv(name, value)
+    return importlib.import_module("proxy.main")
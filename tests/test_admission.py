@@ -0,0 +1,40 @@
+import asyncio
+import pytest
+from proxy.admission import AdmissionController, AdmissionRejected, PRIORITY_HIGH, PRIORITY_LOW
+
+def test_waiters_are_served_by_priority():
+    async def run():
+        admission = AdmissionController(max_inflight=1, max_queue=4, max_queue_time=1)
+        release = await admission.admit("m")
+        order = []
+
+        async def wait(name, priority):
+            done = await admission.admit("m", priority)
+            order.append(name)
+            done()
+
+        low = asyncio.ensure_future(wait("low", PRIORITY_LOW))
+        high = asyncio.ensure_future(wait("high", PRIORITY_HIGH))
+        await asyncio.sleep(0)
+        release()
+        await asyncio.gather(low, high)
+        assert order == ["high", "low"]
+        assert admission.models["m"].inflight == 0
+    asyncio.run(run())
+
+def test_full_queue_sheds_lowest_priority():
+    async def run():
+        admission = AdmissionController(max_inflight=1, max_queue=1, max_queue_time=1)
+        release = await admission.admit("m")
+        low = asyncio.ensure_future(admission.admit("m", PRIORITY_LOW))
+        await asyncio.sleep(0)
+        high = asyncio.ensure_future(admission.admit("m", PRIORITY_HIGH))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected):
+            await low
+        with pytest.raises(AdmissionRejected):
+            await admission.admit("m", PRIORITY_LOW)
+        release()
+        (await high)()
+        assert admission.models["m"].inflight == 0
+    asyncio.run(run())
@@ -0,0 +1,145 @@
+import json
+import time
+import shutil
+import asyncio
+from proxy import batches
+from proxy.batches import BatchRunner, BatchStore
+
+def _input_file(store: BatchStore, n: int) -> str:
+    file = store.create_file("sk-rc-a", "input.jsonl", "batch")
+    with open(store.content_path(file["id"]), "w") as f:
+        for i in range(n):
+            body = {"model": "m", "messages": [{"role": "user", "content": str(i)}]}
+            f.write(json.dumps({"custom_id": str(i), "method": "POST", "url": "/v1/chat/completions", "body": body}) + "\n")
+    return file["id"]
+
+def test_other_worker_sees_progress_and_cancels(tmp_path, monkeypatch):
+    monkeypatch.setattr(batches, "SAVE_INTERVAL", 0.05)
+
+    async def execute(owner, body):
+        await asyncio.sleep(0.02)
+        return {"ok": True}
+
+    async def run():
+        store = BatchStore(str(tmp_path))
+        # two workers sharing the storage, the batch runs in the first
+        running, other = BatchRunner(store, execute, max_concurrency=1), BatchRunner(store, execute)
+        batch = await running.create("sk-rc-a", _input_file(store, 100), "/v1/chat/completions", "24h", None)
+        await asyncio.sleep(0.5)
+        polled = await other.get(batch["id"], "sk-rc-a")
+        assert polled["request_counts"]["completed"] > 0
+        assert (await other.cancel(polled))["status"] == "cancelling"
+        assert (await other.get(batch["id"], "sk-rc-a"))["status"] == "cancelling"
+        await asyncio.wait_for(running._tasks[batch["id"]], 5)
+        final = await other.get(batch["id"], "sk-rc-a")
+        assert final["status"] == "cancelled"
+        assert final["request_counts"]["completed"] < 100
+    asyncio.run(run())
+
+def test_expired_batch_fails_pending_requests(tmp_path):
+    async def execute(owner, body):
+        await asyncio.sleep(0.02)
+        return {"ok": True}
+
+    async def run():
+        store = BatchStore(str(tmp_path))
+        runner = BatchRunner(store, execute, max_concurrency=1)
+        batch = await runner.create("sk-rc-a", _input_file(store, 100), "/v1/chat/completions", "24h", None)
+        batch["expires_at"] = time.time() + 0.2
+        await asyncio.wait_for(runner._tasks[batch["id"]], 5)
+        final = await runner.get(batch["id"], "sk-rc-a")
+        assert final["status"] == "expired"
+        counts = final["request_counts"]
+        assert 0 < counts["completed"] < 100
+        assert counts["completed"] + counts["failed"] == 100
+        errors = [json.loads(line) for line in open(store.content_path(final["error_file_id"]))]
+        assert {error["error"]["code"] for error in errors} == {"batch_expired"}
+    asyncio.run(run())
+
+def test_max_inflight_caps_all_batches(tmp_path):
+    running, peak = 0, 0
+
+    async def execute(owner, body):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        return {"ok": True}
+
+    async def run():
+        store = BatchStore(str(tmp_path))
+        runner = BatchRunner(store, execute, max_concurrency=4, max_inflight=3)
+        created = [await runner.create("sk-rc-a", _input_file(store, 20), "/v1/chat/completions", "24h", None) for _ in range(2)]
+        await asyncio.wait_for(asyncio.gather(*[runner._tasks[batch["id"]] for batch in created]), 5)
+        assert peak == 3
+    asyncio.run(run())
+
+def test_batches_listed_per_owner(tmp_path):
+    async def execute(owner, body):
+        return {"ok": True}
+
+    async def run():
+        store = BatchStore(str(tmp_path))
+        runner = BatchRunner(store, execute)
+        batch = await runner.create("sk-rc-a", _input_file(store, 1), "/v1/chat/completions", "24h", None)
+        await asyncio.wait_for(runner._tasks[batch["id"]], 5)
+        assert [b["id"] for b in await runner.list("sk-rc-a")] == [batch["id"]]
+        assert await runner.list("sk-rc-b") == []
+        # the index is rebuilt for storage written before it existed
+        shutil.rmtree(tmp_path / "owners")
+        assert [b["id"] for b in BatchStore(str(tmp_path)).list_batches("sk-rc-a")] == [batch["id"]]
+    asyncio.run(run())
+
+def test_resume_waits_for_the_lease_to_run_out(tmp_path):
+    sent = []
+
+    async def execute(owner, body):
+        sent.append(body["messages"][0]["content"])
+        await asyncio.sleep(0.02)
+        return {"ok": True}
+
+    async def run():
+        store = BatchStore(str(tmp_path))
+        # the first worker is shutting down and still sends its requests
+        dying = BatchRunner(store, execute, max_concurrency=1, lease_ttl=0.3)
+        batch = await dying.create("sk-rc-a", _input_file(store, 20), "/v1/chat/completions", "24h", None)
+        await asyncio.sleep(0.1)
+        successor = BatchRunner(store, execute, max_concurrency=1, lease_ttl=0.3)
+        await successor.resume()
+        assert batch["id"] not in successor.active
+        # it dies without giving the lease back
+        dying._tasks[batch["id"]].cancel()
+        await asyncio.sleep(0.05)
+        stored = store.get_batch(batch["id"])
+        stored["lease_expires_at"] = time.time() + 0.3
+        store.save_batch(stored)
+        await successor.resume()
+        assert batch["id"] not in successor.active
+        await asyncio.sleep(0.35)
+        await successor.resume()
+        await asyncio.wait_for(successor._tasks[batch["id"]], 5)
+        final = await successor.get(batch["id"], "sk-rc-a")
+        assert final["status"] == "completed"
+        assert final["request_counts"] == {"total": 20, "completed": 20, "failed": 0}
+    asyncio.run(run())
+    # only the request cut off by the kill is sent again
+    assert set(sent) == {str(i) for i in range(20)} and len(sent) <= 21
+
+def test_runner_stops_when_its_lease_is_taken_over(tmp_path):
+    async def execute(owner, body):
+        await asyncio.sleep(0.02)
+        return {"ok": True}
+
+    async def run():
+        store = BatchStore(str(tmp_path))
+        runner = BatchRunner(store, execute, max_concurrency=1, lease_ttl=0.15)
+        batch = await runner.create("sk-rc-a", _input_file(store, 100), "/v1/chat/completions", "24h", None)
+        await asyncio.sleep(0.1)
+        stored = store.get_batch(batch["id"])
+        stored["lease_owner"] = "other-worker"
+        store.save_batch(stored)
+        await asyncio.wait_for(runner._tasks[batch["id"]], 1)
+        assert store.get_batch(batch["id"])["lease_owner"] == "other-worker"
+        assert batch["request_counts"]["completed"] < 100
+    asyncio.run(run())
@@ -0,0 +1,44 @@
+import asyncio
+import pytest
+from proxy.breaker import CLOSED, HALF_OPEN, OPEN, BreakerRegistry, CircuitBreaker, CircuitOpen
+from proxy.protocols import RetryConstantError
+
+def test_breaker_opens_and_recovers_through_half_open():
+    breaker = CircuitBreaker(window=10, min_requests=4, error_threshold=0.5, open_duration=5)
+    for failed in (False, True, False, True):
+        assert breaker.allow(now=1)
+        breaker.record(not failed, 0.1, now=1)
+    assert breaker.state == OPEN
+    assert not breaker.allow(now=2)
+    assert breaker.available(now=6)
+    assert breaker.allow(now=6)
+    assert breaker.state == HALF_OPEN
+    assert not breaker.allow(now=6)
+    breaker.record(True, 0.1, now=6)
+    assert breaker.state == CLOSED
+
+def test_old_outcomes_leave_the_window():
+    breaker = CircuitBreaker(window=10, min_requests=3, error_threshold=0.5)
+    breaker.record(False, 0.1, now=0)
+    breaker.record(False, 0.1, now=0)
+    breaker.record(True, 0.1, now=20)
+    breaker.record(True, 0.1, now=20)
+    breaker.record(False, 0.1, now=20)
+    assert breaker.state == CLOSED
+
+def test_guard_fails_fast_when_open():
+    async def run():
+        breakers = BreakerRegistry(min_requests=1, open_duration=60)
+        calls = []
+
+        async def attempt():
+            calls.append(1)
+            raise RetryConstantError()
+
+        with pytest.raises(RetryConstantError):
+            await breakers.guard("m", "head", attempt)()
+        with pytest.raises(CircuitOpen):
+            await breakers.guard("m", "head", attempt)()
+        assert len(calls) == 1
+        assert breakers.status()[0]["state"] == OPEN
+    asyncio.run(run())
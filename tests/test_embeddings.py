@@ -0,0 +1,75 @@
+import asyncio
+from proxy.embeddings import EmbeddingBatcher
+
+def test_concurrent_inputs_are_coalesced():
+    calls = []
+
+    async def send(token, model, options, inputs):
+        calls.append(inputs)
+        return {
+            "data": [{"index": i, "embedding": [float(i)]} for i in reversed(range(len(inputs)))],
+            "usage": {"prompt_tokens": 30},
+        }
+
+    async def run():
+        batcher = EmbeddingBatcher(send, max_batch_size=8, max_wait=0.01)
+        return await asyncio.gather(*(batcher.embed("sk-rc-a", "m", {}, text) for text in ("a", "bb", "ccc")))
+    results = asyncio.run(run())
+    assert calls == [["a", "bb", "ccc"]]
+    # usage is split by each input's share of the tokens
+    assert results == [([0.0], 5), ([1.0], 10), ([2.0], 15)]
+
+def test_full_batch_is_split():
+    calls = []
+
+    async def send(token, model, options, inputs):
+        calls.append(inputs)
+        return {"data": [{"index": i, "embedding": [0.0]} for i in range(len(inputs))]}
+
+    async def run():
+        batcher = EmbeddingBatcher(send, max_batch_size=2, max_wait=0.01)
+        await asyncio.gather(*(batcher.embed("sk-rc-a", "m", {}, text) for text in ("a", "b", "c")))
+    asyncio.run(run())
+    assert calls == [["a", "b"], ["c"]]
+
+def test_partial_response_fails_unmatched_inputs():
+    async def send(token, model, options, inputs):
+        return {"data": [{"index": 0, "embedding": [0.0]}]}
+
+    async def run():
+        batcher = EmbeddingBatcher(send, max_batch_size=8, max_wait=0.01)
+        first = batcher.embed("sk-rc-a", "m", {}, "a")
+        second = batcher.embed("sk-rc-a", "m", {}, "b")
+        return await asyncio.wait_for(asyncio.gather(first, second, return_exceptions=True), 1)
+    first, second = asyncio.run(run())
+    assert first == ([0.0], 0)
+    assert isinstance(second, RuntimeError)
+
+def test_keys_and_input_kinds_are_batched_apart():
+    calls = []
+
+    async def send(token, model, options, inputs):
+        calls.append((token, inputs))
+        return {"data": [{"index": i, "embedding": [0.0]} for i in range(len(inputs))]}
+
+    async def run():
+        batcher = EmbeddingBatcher(send, max_batch_size=8, max_wait=0.01)
+        await asyncio.gather(
+            batcher.embed("sk-rc-a", "m", {}, "a"),
+            batcher.embed("sk-rc-b", "m", {}, "b"),
+            batcher.embed("sk-rc-a", "m", {}, [1, 2]),
+            batcher.embed("sk-rc-a", "m", {}, "c"),
+        )
+    asyncio.run(run())
+    assert len(calls) == 3
+    assert ("sk-rc-a", ["a", "c"]) in calls and ("sk-rc-a", [[1, 2]]) in calls and ("sk-rc-b", ["b"]) in calls
+
+def test_usage_split_adds_up_to_the_total():
+    async def send(token, model, options, inputs):
+        return {"data": [{"index": i, "embedding": [0.0]} for i in range(len(inputs))], "usage": {"prompt_tokens": 10}}
+
+    async def run():
+        batcher = EmbeddingBatcher(send, max_batch_size=8, max_wait=0.01)
+        return await asyncio.gather(*(batcher.embed("sk-rc-a", "m", {}, text) for text in ("aaaa", "bbbb", "cccc")))
+    tokens = [prompt_tokens for _, prompt_tokens in asyncio.run(run())]
+    assert sum(tokens) == 10 and max(tokens) - min(tokens) <= 1
@@ -0,0 +1,32 @@
+from proxy.cache import KeyCache
+from proxy.metrics import CACHE_LOOKUPS, render
+
+def test_key_cache_hits_and_rejections():
+    cache = KeyCache(maxsize=2, ttl=60, negative_maxsize=2, negative_ttl=60)
+    assert cache.get("sk-rc-a") is None
+    assert not cache.is_rejected("sk-rc-a")
+    cache.put("sk-rc-a", "key-a")
+    assert cache.get("sk-rc-a") == "key-a"
+    cache.reject("sk-rc-b")
+    assert cache.is_rejected("sk-rc-b")
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+    assert cache.stats()["negative_hits"] == 1
+
+def test_key_cache_invalidate_and_evict():
+    cache = KeyCache(maxsize=2, ttl=60, negative_maxsize=2, negative_ttl=60)
+    cache.put("sk-rc-a", "key-a")
+    cache.invalidate("sk-rc-a")
+    assert cache.get("sk-rc-a") is None
+    for name in ("a", "b", "c"):
+        cache.put(f"sk-rc-{name}", name)
+    assert cache.get("sk-rc-a") is None
+    assert cache.get("sk-rc-c") == "c"
+
+def test_key_cache_lookups_exported():
+    cache = KeyCache(maxsize=2, ttl=60, negative_maxsize=2, negative_ttl=60)
+    before = CACHE_LOOKUPS.values.get(("keys", "hit"), 0)
+    cache.put("sk-rc-a", "key-a")
+    cache.get("sk-rc-a")
+    assert CACHE_LOOKUPS.values[("keys", "hit")] == before + 1
+    assert 'proxy_cache_lookups_total{cache="keys",result="hit"}' in render()
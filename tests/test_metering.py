@@ -0,0 +1,63 @@
+import asyncio
+import pytest
+from sqlalchemy.exc import OperationalError
+from sqlmodel import Session, SQLModel, create_engine
+from proxy.auth import APIKey
+from proxy.llm_proxy import estimate_prompt_tokens, report_usage
+from proxy.metering import BudgetMeter
+
+def _meter(tmp_path):
+    meter = BudgetMeter(tokens_per_unit=1000)
+    meter._engine = create_engine(f"sqlite:///{tmp_path}/meter.db")
+    return meter
+
+def _budget(engine, key):
+    with Session(engine) as session:
+        return session.get(APIKey, key).budget
+
+def test_leftover_tokens_carry_over(tmp_path):
+    meter = _meter(tmp_path)
+    SQLModel.metadata.create_all(meter._engine, tables=[APIKey.__table__])
+    with Session(meter._engine) as session:
+        session.add(APIKey(key="sk-rc-a", budget=10))
+        session.commit()
+    meter.debit("sk-rc-a", 1500)
+    asyncio.run(meter.flush())
+    assert _budget(meter._engine, "sk-rc-a") == 9
+    assert meter.pending == {"sk-rc-a": 500}
+    meter.debit("sk-rc-a", 600)
+    asyncio.run(meter.flush())
+    assert _budget(meter._engine, "sk-rc-a") == 8
+    assert meter.pending == {"sk-rc-a": 100}
+
+def test_is_exhausted_counts_pending_debits():
+    meter = BudgetMeter(tokens_per_unit=1000)
+    api_key = APIKey(key="sk-rc-a", budget=2)
+    meter.debit("sk-rc-a", 1999)
+    assert not meter.is_exhausted(api_key)
+    meter.debit("sk-rc-a", 1)
+    assert meter.is_exhausted(api_key)
+
+def test_failed_write_keeps_debits(tmp_path):
+    meter = _meter(tmp_path)
+    meter.debit("sk-rc-a", 2000)
+    # no table yet, the write fails
+    with pytest.raises(OperationalError):
+        asyncio.run(meter.flush())
+    assert meter.pending == {"sk-rc-a": 2000}
+    SQLModel.metadata.create_all(meter._engine, tables=[APIKey.__table__])
+    with Session(meter._engine) as session:
+        session.add(APIKey(key="sk-rc-a", budget=10))
+        session.commit()
+    asyncio.run(meter.flush())
+    assert _budget(meter._engine, "sk-rc-a") == 8
+    assert meter.pending == {}
+
+def test_stream_without_usage_charges_estimated_prompt():
+    class Generation:
+        def update(self, **kwargs):
+            pass
+    charged = []
+    data = {"messages": [{"role": "user", "content": "x" * 40000}]}
+    report_usage(Generation(), None, 1, lambda p, c: charged.append((p, c)), estimate_prompt_tokens(data))
+    assert charged == [(10000, 1)]
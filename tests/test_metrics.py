@@ -0,0 +1,20 @@
+from proxy import metrics
+
+def test_label_values_are_escaped():
+    registry = []
+    errors = metrics.Counter("test_errors_total", "Errors.", ["model"], registry=registry)
+    errors.inc('a\\b"c\nd')
+    assert 'test_errors_total{model="a\\\\b\\"c\\nd"} 1' in metrics.render(registry)
+
+def test_unknown_models_share_one_label(monkeypatch):
+    class Registry:
+        index = {"m1": []}
+
+    monkeypatch.setattr(metrics, "models", Registry())
+    assert metrics.model_label("m1") == "m1"
+    assert metrics.model_label("made-up") == metrics.OTHER_MODEL
+    assert metrics.model_label(["not", "hashable"]) == metrics.OTHER_MODEL
+    timer = metrics.StreamTimer("made-up")
+    timer.finish(0, "error")
+    assert metrics.STREAMS_INFLIGHT.values[(metrics.OTHER_MODEL,)] == 0
+    assert ("made-up",) not in metrics.STREAMS_INFLIGHT.values
@@ -0,0 +1,24 @@
+from proxy.protocols import CompactChunk, CompactResponse, ModelResponse
+
+def test_compact_chunk_converts_lazily():
+    chunk = CompactChunk.delta("id-1", 1, "m", {"content": "hi"})
+    assert chunk.choices[0]["delta"]["content"] == "hi"
+    assert chunk.get("usage") is None and "usage" not in chunk
+    model = chunk.to_model()
+    assert isinstance(model, ModelResponse) and model is chunk.to_model()
+    assert model.choices[0].delta.content == "hi"
+    assert model.object == "chat.completion.chunk"
+
+def test_compact_response_replays_as_chunks():
+    response = CompactResponse({
+        "id": "id-1",
+        "created": 1,
+        "model": "m",
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": "hi", "tool_calls": None}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+    })
+    chunks = [chunk.to_dict() for chunk in response.chunks()]
+    assert chunks[0]["choices"][0]["delta"] == {"role": "assistant", "content": "hi"}
+    assert chunks[1]["choices"][0]["finish_reason"] == "stop"
+    assert chunks[2]["usage"]["total_tokens"] == 2
+    assert response.to_model().choices[0].message.content == "hi"
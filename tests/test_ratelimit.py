@@ -0,0 +1,36 @@
+import asyncio
+import pytest
+from proxy.ratelimit import LocalBackend, RateLimiter, RateLimitExceeded
+
+def test_requests_per_second():
+    async def run():
+        limiter = RateLimiter(LocalBackend(), requests_per_second=2)
+        await limiter.admit("sk-rc-a", "m")
+        await limiter.admit("sk-rc-a", "m")
+        with pytest.raises(RateLimitExceeded) as exc:
+            await limiter.admit("sk-rc-a", "m")
+        assert exc.value.headers["retry-after"] == "1"
+        # other keys have their own bucket
+        await limiter.admit("sk-rc-b", "m")
+    asyncio.run(run())
+
+def test_concurrency_slots_are_released():
+    async def run():
+        limiter = RateLimiter(LocalBackend(), model_max_concurrent=1)
+        lease = await limiter.admit("sk-rc-a", "m")
+        with pytest.raises(RateLimitExceeded):
+            await limiter.admit("sk-rc-a", "m")
+        await limiter.admit("sk-rc-a", "other")
+        await lease.release()
+        await limiter.admit("sk-rc-a", "m")
+    asyncio.run(run())
+
+def test_tokens_are_debited_after_the_fact():
+    async def run():
+        limiter = RateLimiter(LocalBackend(), tokens_per_minute=100)
+        await limiter.admit("sk-rc-a", "m")
+        await limiter.record_tokens("sk-rc-a", "m", 150)
+        with pytest.raises(RateLimitExceeded) as exc:
+            await limiter.admit("sk-rc-a", "m")
+        assert exc.value.headers["x-ratelimit-limit-tokens"] == "100"
+    asyncio.run(run())
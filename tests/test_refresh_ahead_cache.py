@@ -0,0 +1,41 @@
+import asyncio
+import pytest
+from proxy.cache import RefreshAheadCache
+
+def test_single_flight_and_stale_on_error():
+    async def run():
+        cache = RefreshAheadCache(maxsize=4, ttl=0.05, stale_ttl=60, timeout=1)
+        calls = []
+
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return len(calls)
+
+        async def failing():
+            raise RuntimeError("langfuse is down")
+
+        assert await asyncio.gather(*[cache.get("k", fetch) for _ in range(3)]) == [1, 1, 1]
+        assert len(calls) == 1
+        await asyncio.sleep(0.06)
+        assert await cache.get("k", failing) == 1
+        assert cache.stale == 1
+        with pytest.raises(RuntimeError):
+            await cache.get("other", failing)
+    asyncio.run(run())
+
+def test_slow_fetch_serves_stale_within_timeout():
+    async def run():
+        cache = RefreshAheadCache(maxsize=4, ttl=0.01, stale_ttl=60, timeout=0.02)
+
+        async def slow():
+            await asyncio.sleep(1)
+            return "new"
+
+        async def fast():
+            return "old"
+
+        await cache.get("k", fast)
+        await asyncio.sleep(0.02)
+        assert await cache.get("k", slow) == "old"
+    asyncio.run(run())
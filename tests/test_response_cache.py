@@ -0,0 +1,43 @@
+import asyncio
+from proxy.cache import ResponseCache, is_deterministic, response_cache_key
+
+def test_response_cache_key_ignores_streaming_fields():
+    data = {"model": "m", "messages": [{"role": "user", "content": "hi"}], "temperature": 0}
+    assert is_deterministic(data)
+    assert not is_deterministic({**data, "temperature": 0.7})
+    assert response_cache_key(data) == response_cache_key({**data, "stream": True, "user_id": "sk-rc-a"})
+    assert response_cache_key(data) != response_cache_key({**data, "model": "n"})
+
+def test_response_cache_single_flight():
+    cache = ResponseCache(maxsize=8, ttl=60)
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {"id": "x"}
+
+    async def run():
+        results = await asyncio.gather(*[cache.get_or_compute("k", compute) for _ in range(5)])
+        cached = await cache.get_or_compute("k", compute)
+        return results, cached
+
+    results, cached = asyncio.run(run())
+    assert len(calls) == 1
+    assert [hit for _, hit in results].count(False) == 1
+    assert cached == ({"id": "x"}, True)
+    assert cache.stats()["coalesced"] == 4
+
+def test_lookups_are_labelled_by_cache_name():
+    from proxy.metrics import CACHE_LOOKUPS
+
+    async def run():
+        cache = ResponseCache(name="profiles-test")
+
+        async def compute():
+            return "value"
+        await cache.get_or_compute("k", compute)
+        await cache.get_or_compute("k", compute)
+    asyncio.run(run())
+    assert CACHE_LOOKUPS.values[("profiles-test", "miss")] == 1
+    assert CACHE_LOOKUPS.values[("profiles-test", "hit")] == 1
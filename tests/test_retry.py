@@ -0,0 +1,98 @@
+import asyncio
+import pytest
+from proxy.protocols import RetryConstantError
+from proxy.retry import Deadline, DeadlineExceeded, LatencyTracker, RetryPolicy
+
+def test_retries_stop_when_the_deadline_is_too_close():
+    async def run():
+        calls = []
+
+        async def attempt():
+            calls.append(1)
+            raise RetryConstantError()
+
+        policy = RetryPolicy(max_tries=5, constant_interval=0.1, min_attempt_time=0.2)
+        with pytest.raises(RetryConstantError):
+            await policy.run(attempt, "m", Deadline(0.45))
+        assert len(calls) == 3
+    asyncio.run(run())
+
+def test_slow_attempt_exceeds_deadline():
+    async def run():
+        async def attempt():
+            await asyncio.sleep(1)
+
+        with pytest.raises(DeadlineExceeded):
+            await RetryPolicy().run(attempt, "m", Deadline(0.05))
+    asyncio.run(run())
+
+def test_hedge_wins_and_loser_is_cancelled():
+    async def run():
+        latency = LatencyTracker(min_samples=1)
+        latency.observe("m", 0.01)
+        delays = [1, 0]
+        cancelled = []
+
+        async def attempt():
+            delay = delays.pop(0)
+            try:
+                await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                cancelled.append(delay)
+                raise
+            return delay
+
+        policy = RetryPolicy(hedge_min_delay=0.02, latency=latency)
+        assert await policy.run(attempt, "m", Deadline(5), hedge=True) == 0
+        await asyncio.sleep(0)
+        assert cancelled == [1]
+    asyncio.run(run())
+
+def test_only_hedged_attempts_are_timed():
+    async def run():
+        async def attempt():
+            return "ok"
+
+        policy = RetryPolicy(latency=LatencyTracker(min_samples=1))
+        await policy.run(attempt, "m", Deadline(5))
+        assert policy.latency.quantile("m", 0.95) is None
+        await policy.run(attempt, "m", Deadline(5), hedge=True)
+        assert policy.latency.quantile("m", 0.95) is not None
+    asyncio.run(run())
+
+def test_deadline_cancels_the_first_attempt_while_waiting_to_hedge():
+    async def run():
+        latency = LatencyTracker(min_samples=1)
+        latency.observe("m", 1)
+        cancelled = []
+
+        async def attempt():
+            try:
+                await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+
+        policy = RetryPolicy(latency=latency)
+        with pytest.raises(DeadlineExceeded):
+            await policy.run(attempt, "m", Deadline(0.05), hedge=True)
+        await asyncio.sleep(0)
+        assert cancelled == [True]
+    asyncio.run(run())
+
+@pytest.mark.parametrize("header", ["soon", "nan", "inf", "0", "-5"])
+def test_invalid_request_timeout_is_rejected(main, header):
+    from fastapi import HTTPException
+    from starlette.requests import Request
+
+    request = Request({"type": "http", "headers": [(b"x-request-timeout", header.encode())]})
+    with pytest.raises(HTTPException) as e:
+        main._deadline(request)
+    assert e.value.status_code == 400
+
+def test_request_timeout_is_capped(main, monkeypatch):
+    from starlette.requests import Request
+
+    monkeypatch.setattr(main.settings, "request_deadline_max", 60.0)
+    request = Request({"type": "http", "headers": [(b"x-request-timeout", b"600")]})
+    assert 59 < main._deadline(request).remaining() <= 60
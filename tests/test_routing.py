@@ -0,0 +1,38 @@
+from proxy.routing import Router, prefix_key
+
+class StaticRegistry:
+    def __init__(self, nodes):
+        self.nodes = nodes
+
+    def nodes_for(self, model):
+        return self.nodes.get(model, [])
+
+def _router(policy):
+    nodes = [{'node_id': f"peer{i}", 'node': {}} for i in range(4)]
+    return Router(
+        StaticRegistry({"m": nodes}),
+        head_addr="http://head",
+        node_endpoint="{head}/v1/p2p/{node_id}/",
+        mode="direct",
+        policy=policy,
+    )
+
+def test_unknown_model_goes_to_head():
+    router = _router("p2c")
+    assert router.pick("unknown").endpoint == "http://head/v1/service/llm/v1/"
+    assert router.pick("m").node_id.startswith("peer")
+
+def test_prefix_affinity_is_stable_across_turns():
+    router = _router("prefix")
+    first = {"messages": [{"role": "system", "content": "S"}, {"role": "user", "content": "hi"}]}
+    later = {"messages": first["messages"] + [{"role": "assistant", "content": "a"}, {"role": "user", "content": "b"}]}
+    assert prefix_key(first) == prefix_key(later)
+    assert router.pick("m", first) == router.pick("m", later)
+
+def test_prefix_affinity_spills_when_overloaded():
+    router = _router("prefix")
+    data = {"messages": [{"role": "user", "content": "hi"}]}
+    preferred = router.pick("m", data)
+    for _ in range(5):
+        router.acquire(preferred)
+    assert router.pick("m", data) != preferred
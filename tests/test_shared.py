@@ -0,0 +1,58 @@
+import asyncio
+from proxy import metrics
+from proxy.cache import KeyCache
+from proxy.shared import SharedState, StateServer
+
+def test_key_cache_shared_between_workers(tmp_path):
+    async def main():
+        server = StateServer(str(tmp_path / "state.sock"))
+        await server.start()
+        workers = []
+        for _ in range(2):
+            shared = SharedState(server.path)
+            await shared.connect()
+            cache = KeyCache(maxsize=8, ttl=60, negative_maxsize=8, negative_ttl=60)
+            await cache.attach(shared, encode=str, decode=str)
+            workers.append((shared, cache))
+        (_, a), (_, b) = workers
+        a.put("sk-rc-a", "key-a")
+        await asyncio.sleep(0.05)
+        assert await b.get_shared("sk-rc-a") == (True, "key-a")
+        assert b.get("sk-rc-a") == "key-a"
+        a.invalidate("sk-rc-a")
+        await asyncio.sleep(0.05)
+        assert b.get("sk-rc-a") is None
+        assert await b.get_shared("sk-rc-a") == (False, None)
+        for shared, _ in workers:
+            await shared.close()
+        await server.stop()
+    asyncio.run(main())
+
+def test_slots_released_when_worker_disconnects(tmp_path):
+    async def main():
+        server = StateServer(str(tmp_path / "state.sock"))
+        await server.start()
+        first, second = SharedState(server.path), SharedState(server.path)
+        await first.connect()
+        await second.connect()
+        assert await first.call("rl_acquire", key="user", limit=1)
+        assert not await second.call("rl_acquire", key="user", limit=1)
+        await first.close()
+        await asyncio.sleep(0.05)
+        assert await second.call("rl_acquire", key="user", limit=1)
+        await second.close()
+        await server.stop()
+    asyncio.run(main())
+
+def test_merge_sums_counters_and_skips_stale_gauges():
+    registry = []
+    requests = metrics.Counter("test_requests_total", "Requests.", ["model"], registry=registry)
+    inflight = metrics.Gauge("test_inflight", "In flight.", registry=registry)
+    requests.inc("m1", amount=2)
+    inflight.set(value=3)
+    live = metrics.snapshot(registry)
+    requests.inc("m1", amount=3)
+    stale = metrics.snapshot(registry)
+    text = metrics.merge([live, stale], live=[True, False])
+    assert 'test_requests_total{model="m1"} 7' in text
+    assert "test_inflight 3" in text
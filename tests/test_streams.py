@@ -0,0 +1,97 @@
+import asyncio
+import pytest
+from proxy.llm_proxy import FirstChunkTimeout, prefetch_stream
+
+def test_stalled_target_fails_over_to_the_next(main, monkeypatch):
+    from proxy.admission import AdmissionController
+    from proxy.breaker import BreakerRegistry
+    from proxy.routing import Target
+
+    class Router:
+        def __init__(self):
+            self.inflight = {}
+
+        def pick(self, model, data=None, exclude=()):
+            return Target("http://node/v1/", "n2" if "n1" in exclude else "n1")
+
+        def acquire(self, target):
+            self.inflight[target.node_id] = self.inflight.get(target.node_id, 0) + 1
+
+        def release(self, target):
+            self.inflight[target.node_id] -= 1
+
+    async def open_stream(request, target, token, data, on_usage):
+        async def chunks():
+            if target.node_id == "n1":
+                await asyncio.sleep(10)
+            yield "data: one\n\n"
+        return await prefetch_stream(chunks())
+
+    monkeypatch.setattr(main.settings, "stream_first_chunk_timeout", 0.05)
+    monkeypatch.setattr(main, "_open_stream", open_stream)
+    monkeypatch.setattr(main, "admission", AdmissionController())
+    monkeypatch.setattr(main, "breakers", BreakerRegistry.from_settings(main.settings))
+    monkeypatch.setattr(main, "router", Router())
+
+    async def run():
+        data = {"model": "m", "stream": True, "messages": []}
+        response = await main._routed_completion(None, "sk-rc-a", data, None, main.PRIORITY_LOW)
+        assert [chunk async for chunk in response.body_iterator] == ["data: one\n\n"]
+    asyncio.run(asyncio.wait_for(run(), 5))
+    assert main.router.inflight == {"n1": 0, "n2": 0}
+    assert main.breakers.get("m", "n1").snapshot()["errors"] == 1
+
+def test_failure_after_first_chunk_ends_with_error_event():
+    async def run():
+        async def failing():
+            yield "data: one\n\n"
+            raise RuntimeError("boom")
+
+        stream = await prefetch_stream(failing())
+        chunks = [chunk async for chunk in stream]
+        assert chunks[0] == "data: one\n\n"
+        assert b'"upstream_error"' in chunks[-1] and b"boom" in chunks[-1]
+    asyncio.run(run())
+
+def test_error_event_starts_on_an_event_boundary():
+    async def run():
+        async def failing():
+            yield b"data: one\n\n"
+            yield b'data: {"partial'
+            raise RuntimeError("boom")
+
+        stream = await prefetch_stream(failing())
+        return b"".join([chunk async for chunk in stream])
+    events = asyncio.run(run()).split(b"\n\n")
+    assert events[1] == b'data: {"partial'
+    assert b'"upstream_error"' in events[2]
+
+def test_stream_timer_counts_only_started_streams():
+    from proxy import metrics
+
+    abandoned = metrics.StreamTimer("timer-test", started=0)
+    abandoned.finish(0, "cancelled")
+    abandoned.finish(0, "error")
+    timer = metrics.StreamTimer("timer-test")
+    timer.chunk()
+    timer.chunk()
+    timer.finish(2, "ok")
+    assert metrics.STREAMS_INFLIGHT.values[("timer-test",)] == 0
+    assert metrics.REQUESTS.values[("timer-test", "ok")] == 1
+    assert ("timer-test", "cancelled") not in metrics.REQUESTS.values
+    assert metrics.TIME_TO_FIRST_TOKEN.values[("timer-test",)][-1] == 1
+
+def test_first_chunk_timeout_is_one_breaker_failure():
+    from proxy.breaker import BreakerRegistry
+
+    async def run():
+        async def attempt():
+            raise FirstChunkTimeout("No response from upstream within 0.5s")
+
+        breakers = BreakerRegistry(window=30, min_requests=10, error_threshold=0.5, slow_threshold=0.8,
+                                   slow_call_duration=120, open_duration=30, half_open_probes=1)
+        with pytest.raises(FirstChunkTimeout):
+            await breakers.guard("m", "head", attempt)()
+        assert breakers.get("m", "head").snapshot()["requests"] == 1
+        assert breakers.get("m", "head").snapshot()["errors"] == 1
+    asyncio.run(run())
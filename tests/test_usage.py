@@ -0,0 +1,35 @@
+import asyncio
+from datetime import date, timedelta
+from proxy.usage import UsageStore
+
+def test_statistics_only_caches_known_keys():
+    store = UsageStore()
+    store.record("sk-rc-a", "m1", 10, 5)
+    assert store.statistics("sk-rc-a")["data"][0]["usage"][0]["totalUsage"] == 15
+    for i in range(100):
+        assert store.statistics(f"sk-rc-random-{i}") == {"data": []}
+    assert set(store._views) == {"sk-rc-a"}
+
+def test_days_past_retention_are_dropped():
+    store = UsageStore(retention_days=7)
+    old = date.today() - timedelta(days=8)
+    store._add(old, "m1", "sk-rc-old", (1, 10, 5))
+    store.record("sk-rc-a", "m1", 10, 5)
+    assert "sk-rc-old" not in store.by_key
+    assert [day for day, _ in store.totals] == [date.today()]
+
+def test_stored_statistics_sum_all_workers(tmp_path):
+    from sqlmodel import create_engine
+
+    async def run():
+        engine = create_engine(f"sqlite:///{tmp_path}/usage.db")
+        workers = [UsageStore(), UsageStore()]
+        for store in workers:
+            await store.start(engine)
+            store.record("sk-rc-a", "m1", 10, 5)
+            await store.stop()
+        view = await workers[0].stored_statistics("sk-rc-a")
+        assert view["data"][0]["usage"][0]["totalUsage"] == 30
+        assert view["data"][0]["countTraces"] == 2
+        assert await workers[0].stored_statistics("sk-rc-unknown") == {"data": []}
+    asyncio.run(run())